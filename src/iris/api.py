@@ -3,9 +3,8 @@
 
 from __future__ import absolute_import
 
-from gevent import spawn, sleep, socket
+from gevent import spawn, sleep
 
-import msgpack
 import time
 import hmac
 import hashlib
@@ -36,6 +35,7 @@ from . import ui
 from . import app_stats
 from .config import load_config
 from iris.sender import auditlog
+from iris.sender import client as sender_client
 from iris.sender.quota import (get_application_quotas_query, insert_application_quota_query,
                                required_quota_keys, quota_int_keys)
 
@@ -1586,6 +1586,9 @@ class Incidents(object):
 
             session.commit()
             session.close()
+
+        sender_client.notify_new_incident(incident_id)
+
         resp.status = HTTP_201
         resp.set_header('Location', '/incidents/%s' % incident_id)
         resp.body = ujson.dumps(incident_id)
@@ -1723,6 +1726,8 @@ class Incident(object):
                 raise HTTPBadRequest('Invalid claim: no matching owner')
                 # claim_incident will close the session
         is_active = utils.claim_incident(incident_id, owner)[0]
+        if not is_active:
+            sender_client.notify_incidents_claimed([incident_id])
         resp.status = HTTP_200
         resp.body = ujson.dumps({'incident_id': incident_id,
                                  'owner': owner,
@@ -1756,6 +1761,7 @@ class ClaimIncidents(object):
             if not owner_valid:
                 raise HTTPBadRequest('Invalid claim: no matching owner')
         claimed, unclaimed = utils.claim_bulk_incidents(incident_ids, owner)
+        sender_client.notify_incidents_claimed(claimed)
         resp.status = HTTP_200
         resp.body = ujson.dumps({'owner': owner,
                                  'claimed': claimed,
@@ -1884,21 +1890,63 @@ class Messages(object):
         connection.close()
 
 
+notification_required_attrs = frozenset(['target', 'role', 'subject'])
+MAX_NOTIFICATION_BATCH_SIZE = 1000
+
+
+def validate_notification(message):
+    msg_attrs = set(message)
+    if not msg_attrs >= notification_required_attrs:
+        raise HTTPBadRequest('Missing required atrributes',
+                             ', '.join(notification_required_attrs - msg_attrs))
+
+    # If both priority and mode are passed in, priority overrides mode
+    if 'priority' in message:
+        priority = cache.priorities.get(message['priority'])
+        if not priority:
+            raise HTTPBadRequest('Invalid priority', message['priority'])
+        message['priority_id'] = priority['id']
+    elif 'mode' in message:
+        mode_id = cache.modes.get(message['mode'])
+        if not mode_id:
+            raise HTTPBadRequest('Invalid mode', message['mode'])
+        message['mode_id'] = mode_id
+    else:
+        raise HTTPBadRequest(
+            'Both priority and mode are missing, at least one of it is required')
+    if message['role'] == 'literal_target':
+        # target_literal requires that a mode be set and no priority be defined
+        if 'mode' not in message:
+            raise HTTPBadRequest('INVALID mode not set for literal_target role')
+        if 'priority' in message:
+            raise HTTPBadRequest('INVALID role literal_target does not support priority')
+        message['unexpanded'] = True
+
+    # Avoid problems down the line if we have no way of creating the
+    # message body, which happens if both body and template are not
+    # specified, or if we don't have email_html
+    if 'template' in message:
+        if not isinstance(message['template'], basestring):
+            raise HTTPBadRequest('template needs to be a string')
+    elif 'body' in message:
+        if not isinstance(message['body'], basestring):
+            raise HTTPBadRequest('body needs to be a string')
+    elif 'email_html' in message:
+        if not isinstance(message['email_html'], basestring):
+            raise HTTPBadRequest('email_html needs to be a string')
+        # Handle the edge-case where someone is only specifying email_html
+        # and not the others. Avoid KeyError's later on in sender
+        if message.get('body') is None:
+            message['body'] = ''
+    else:
+        raise HTTPBadRequest(
+            'body, template, and email_html are missing, so we cannot construct message.')
+
+    utils.sanitize_unicode_dict(message)
+
+
 class Notifications(object):
     allow_read_no_auth = False
-    required_attrs = frozenset(['target', 'role', 'subject'])
-
-    def __init__(self, zk_hosts, default_sender_addr):
-        self.default_sender_addr = default_sender_addr
-        if zk_hosts:
-            from iris.coordinator.kazoo import Coordinator
-            self.coordinator = Coordinator(zk_hosts=zk_hosts,
-                                           hostname=None,
-                                           port=None,
-                                           join_cluster=False)
-        else:
-            logger.info('Not using ZK to get senders. Using host %s for master instead.', default_sender_addr)
-            self.coordinator = None
 
     def on_post(self, req, resp):
         '''
@@ -1980,94 +2028,15 @@ class Notifications(object):
         '''
 
         message = ujson.loads(req.context['body'])
-        msg_attrs = set(message)
-        if not msg_attrs >= self.required_attrs:
-            raise HTTPBadRequest('Missing required atrributes',
-                                 ', '.join(self.required_attrs - msg_attrs))
-
-        # If both priority and mode are passed in, priority overrides mode
-        if 'priority' in message:
-            priority = cache.priorities.get(message['priority'])
-            if not priority:
-                raise HTTPBadRequest('Invalid priority', message['priority'])
-            message['priority_id'] = priority['id']
-        elif 'mode' in message:
-            mode_id = cache.modes.get(message['mode'])
-            if not mode_id:
-                raise HTTPBadRequest('Invalid mode', message['mode'])
-            message['mode_id'] = mode_id
-        else:
-            raise HTTPBadRequest(
-                'Both priority and mode are missing, at least one of it is required')
-        if message['role'] == 'literal_target':
-            # target_literal requires that a mode be set and no priority be defined
-            if 'mode' not in message:
-                raise HTTPBadRequest('INVALID mode not set for literal_target role')
-            if 'priority' in message:
-                raise HTTPBadRequest('INVALID role literal_target does not support priority')
-            message['unexpanded'] = True
-
-        # Avoid problems down the line if we have no way of creating the
-        # message body, which happens if both body and template are not
-        # specified, or if we don't have email_html
-        if 'template' in message:
-            if not isinstance(message['template'], basestring):
-                raise HTTPBadRequest('template needs to be a string')
-        elif 'body' in message:
-            if not isinstance(message['body'], basestring):
-                raise HTTPBadRequest('body needs to be a string')
-        elif 'email_html' in message:
-            if not isinstance(message['email_html'], basestring):
-                raise HTTPBadRequest('email_html needs to be a string')
-            # Handle the edge-case where someone is only specifying email_html
-            # and not the others. Avoid KeyError's later on in sender
-            if message.get('body') is None:
-                message['body'] = ''
-        else:
-            raise HTTPBadRequest(
-                'body, template, and email_html are missing, so we cannot construct message.')
-
-        utils.sanitize_unicode_dict(message)
-
+        validate_notification(message)
         message['application'] = req.context['app']['name']
 
-        # If we're using ZK, try that to get master
-        if self.coordinator:
-            sender_addr = self.coordinator.get_current_master()
-            if sender_addr:
-                logger.info('Relaying message to current master sender: %s', sender_addr)
-            else:
-                sender_addr = self.default_sender_addr
-                logger.error('Failed getting current sender master. Falling back to %s', sender_addr)
-        else:
-            sender_addr = self.default_sender_addr
-
-        s = None
-
-        # First try master
         try:
-            s = socket.create_connection(sender_addr)
-
-        # Then try slaves
-        except Exception:
-            if self.coordinator:
-                logger.exception('Failed contacting master (%s). Resorting to slaves.', sender_addr)
-                for slave_address in self.coordinator.get_current_slaves():
-                    try:
-                        logger.info('Trying slave %s..', slave_address)
-                        s = socket.create_connection(slave_address)
-                        break
-                    except Exception:
-                        logger.exception('Failed reaching slave %s', slave_address)
-
-        # If none of that works, bail
-        if not s:
-            logger.error('Failed reaching any senders. Bailing.')
+            sender_resp = sender_client.send_request('v0/send', message)
+        except sender_client.RPCError as e:
+            logger.error('Failed reaching any senders: %s. Bailing.', e)
             raise HTTPInternalServerError('Failed reaching any senders')
 
-        s.send(msgpack.packb({'endpoint': 'v0/send', 'data': message}))
-        sender_resp = utils.msgpack_unpack_msg_from_socket(s)
-        s.close()
         if sender_resp == 'OK':
             resp.status = HTTP_200
             resp.body = '[]'
@@ -2076,6 +2045,82 @@ class Notifications(object):
             raise HTTPBadRequest('Request rejected by sender', sender_resp)
 
 
+class NotificationsBatch(object):
+    allow_read_no_auth = False
+
+    def on_post(self, req, resp):
+        '''
+        Create many out of band notifications in one request. Takes a list of
+        notifications, each as described for POST /v0/notifications, and relays
+        them to the sender together. The response lists the sender's verdict
+        for each notification, in order.
+
+        **Example request**:
+
+        .. sourcecode:: http
+
+           POST /v0/notifications/batch HTTP/1.1
+           Content-Type: application/json
+
+           [
+               {
+                   "role": "user",
+                   "target": "test_user",
+                   "subject": "wake up",
+                   "body": "something is on fire",
+                   "mode": "email"
+               },
+               {
+                   "role": "user",
+                   "target": "no_such_user",
+                   "subject": "wake up",
+                   "body": "something is on fire",
+                   "mode": "email"
+               }
+           ]
+
+        **Example response**:
+
+        .. sourcecode:: http
+
+           HTTP/1.1 200 OK
+           Content-Type: application/json
+
+           ["OK", "INVALID role:target"]
+
+        :statuscode 200: batch relayed to sender; see the response for which notifications were queued
+        :statuscode 400: invalid request, or invalid notification in the batch
+        :statuscode 401: application is not allowed to create out of band notification
+        '''
+        messages = ujson.loads(req.context['body'])
+        if not isinstance(messages, list) or not messages:
+            raise HTTPBadRequest('Expected a non-empty list of notifications')
+        if len(messages) > MAX_NOTIFICATION_BATCH_SIZE:
+            raise HTTPBadRequest('Too many notifications',
+                                 'at most %s notifications per batch' % MAX_NOTIFICATION_BATCH_SIZE)
+
+        for idx, message in enumerate(messages):
+            if not isinstance(message, dict):
+                raise HTTPBadRequest('Invalid notification %s' % idx, 'notification needs to be an object')
+            try:
+                validate_notification(message)
+            except HTTPBadRequest as e:
+                raise HTTPBadRequest('Invalid notification %s: %s' % (idx, e.title), e.description)
+            message['application'] = req.context['app']['name']
+
+        try:
+            sender_resp = sender_client.send_request('v0/send_batch', messages)
+        except sender_client.RPCError as e:
+            logger.error('Failed reaching any senders: %s. Bailing.', e)
+            raise HTTPInternalServerError('Failed reaching any senders')
+
+        if not isinstance(sender_resp, list):
+            logger.warning('OOB message batch rejected by sender because %s', sender_resp)
+            raise HTTPBadRequest('Request rejected by sender', sender_resp)
+        resp.status = HTTP_200
+        resp.body = ujson.dumps(sender_resp)
+
+
 class Template(object):
     allow_read_no_auth = True
 
@@ -2325,6 +2370,7 @@ class UserModes(object):
             modes.update(list(result))
             session.close()
 
+        sender_client.notify_contacts_changed(users=[username])
         resp.status = HTTP_200
         resp.body = ujson.dumps(modes)
 
@@ -2696,6 +2742,7 @@ class Application(object):
             session.commit()
             session.close()
 
+            sender_client.notify_contacts_changed(applications=[app_name])
             resp.body = '[]'
 
     def on_delete(self, req, resp, app_name):
@@ -3172,6 +3219,7 @@ class ApplicationRename(object):
         if not affected:
             raise HTTPBadRequest('No rows changed; old app name incorrect')
 
+        sender_client.notify_contacts_changed(applications=[app_name, new_name])
         resp.body = '[]'
 
 
@@ -3321,6 +3369,7 @@ class Applications(object):
                 session.close()
 
         logger.info('Created application "%s" with id %s', app_name, app_id)
+        sender_client.notify_contacts_changed(applications=[app_name])
         resp.status = HTTP_201
         resp.body = ujson.dumps({'id': app_id})
 
@@ -3784,6 +3833,7 @@ class ResponseEmail(ResponseMixin):
                         incident_info).lastrowid
                     session.commit()
                     session.close()
+                    sender_client.notify_new_incident(incident_id)
                     resp.status = HTTP_204
                     # Pass the new incident id back through a header so we can test this
                     resp.set_header('X-IRIS-INCIDENT', incident_id)
@@ -4247,6 +4297,8 @@ class Devices(object):
             cursor.close()
             conn.close()
 
+        # Have senders look up this user's devices again
+        sender_client.notify_contacts_changed(users=[user])
         resp.status = HTTP_201
 
 
@@ -4334,7 +4386,9 @@ def construct_falcon_api(debug, healthcheck_path, allowed_origins, iris_sender_a
     api.add_route('/v0/messages/{message_id}/auditlog', MessageAuditLog())
     api.add_route('/v0/messages', Messages())
 
-    api.add_route('/v0/notifications', Notifications(zk_hosts, default_sender_addr))
+    sender_client.init(zk_hosts, default_sender_addr)
+    api.add_route('/v0/notifications', Notifications())
+    api.add_route('/v0/notifications/batch', NotificationsBatch())
 
     api.add_route('/v0/targets/{target_type}', Target())
     api.add_route('/v0/targets', Targets())
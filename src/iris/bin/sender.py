@@ -8,6 +8,7 @@ import logging
 import time
 import ujson
 import os
+import sys
 import socket
 import gevent
 import signal
@@ -15,8 +16,11 @@ import setproctitle
 import copy
 
 from collections import defaultdict
+from gevent.lock import Semaphore
 from iris.plugins import init_plugins
+from iris.custom_import import import_custom_module
 from iris.vendors import IrisVendorManager, iris_smtp
+from iris.push import devices as push_devices
 from iris.sender import auditlog
 from iris import metrics
 from uuid import uuid4
@@ -24,15 +28,22 @@ from iris.gmail import Gmail
 from iris import db
 from iris.api import load_config
 from iris.utils import sanitize_unicode_dict
-from iris.sender import rpc, cache
+from iris.sender import rpc, cache, client as sender_client
 from iris.sender.message import update_message_mode
 from iris.sender.oneclick import oneclick_email_markup, generate_oneclick_url
 from iris import cache as api_cache
 from iris.sender.quota import ApplicationQuota
+from iris.sender.escalation import EscalationScheduler
+from iris.sender.aggregation import TimerWheel
+from iris.sender.rate import RateCounter
+from iris.sender.sendqueue import PrioritySendQueue, LANES
+from iris.sender.writeback import MessageWriteback
+from iris.sender.journal import MessageJournal
+from iris.sender.workerproc import WorkerProcess, WorkerProcessError, Channel
+from iris.sender.autoscale import WorkerAutoscaler
 from iris.role_lookup import IrisRoleLookupException
-from pymysql import DataError, IntegrityError, InternalError
 # queue for sending messages
-from iris.sender.shared import per_mode_send_queues, add_mode_stat
+from iris.sender.shared import per_mode_send_queues, add_mode_stat, mode_latencies
 
 # sql
 
@@ -47,90 +58,41 @@ JOIN `application`
 ON `incident`.`application_id`=`application`.`id`
 WHERE `current_step`=0 AND `active`=1'''
 
+NEW_INCIDENT_SQL = NEW_INCIDENTS + ''' AND `incident`.`id`=%s'''
+
 INACTIVE_SQL = '''UPDATE
 `incident`
 SET `active`=0
 WHERE `id` IN %s'''
 
-GET_INACTIVE_IDS_SQL = '''SELECT
-distinct `incident_id`
-FROM (
-    SELECT
-        `incident_id`,
-        `max`,
-        `age`,
-        MAX(`count`) as max_count
-        FROM (
-            SELECT
-            `message`.`incident_id` as `incident_id`,
-            `message`.`plan_notification_id` as `plan_notification_id`,
-            count(`message`.`id`) as `count`,
-            `plan_notification`.`repeat` + 1 as `max`,
-            TIMESTAMPDIFF(SECOND, MAX(`message`.`sent`), NOW()) as `age`,
-            `plan_notification`.`wait` as `wait`,
-            `plan_notification`.`step` as `step`,
-            `incident`.`current_step`,
-            `plan`.`step_count`,
-            `message`.`plan_id`,
-            `message`.`application_id`,
-            `incident`.`context`
-            FROM `message`
-            JOIN `incident` ON `message`.`incident_id` = `incident`.`id`
-            JOIN `plan_notification` ON `message`.`plan_notification_id` = `plan_notification`.`id`
-            JOIN `plan` ON `message`.`plan_id` = `plan`.`id`
-            WHERE `incident`.`active` = 1
-            AND `incident`.`current_step`=`plan`.`step_count`
-            AND `step` = `incident`.`current_step`
-            GROUP BY `incident`.`id`, `message`.`plan_notification_id`, `message`.`target_id`
-        ) as `inner`
-        GROUP BY `incident_id`, `plan_notification_id`
-        HAVING `max_count` = `max` AND BIT_AND(`age` > `wait`) = 1
-    ) as `exhausted_incidents`'''
-
-QUEUE_SQL = '''SELECT
-`incident_id`,
-`plan_id`,
-`plan_notification_id`,
-max(`count`) as `count`,
-`max`,
-`age`,
-`wait`,
-`step`,
-`current_step`,
-`step_count`
+UPDATE_INCIDENTS_SQL = '''UPDATE `incident` SET `current_step`=%s WHERE `id` IN %s'''
+
+# Senders can briefly disagree on who owns an incident while they join or leave, so moving one
+# to its next step or repeating a notification is claimed in the DB first
+CLAIM_INCIDENT_STEP_SQL = '''UPDATE `incident` SET `current_step`=%s WHERE `id`=%s AND `current_step`=%s AND `active`=1'''
+
+LOCK_INCIDENTS_SQL = '''SELECT `id` FROM `incident` WHERE `id` IN %s FOR UPDATE'''
+
+NOTIFICATION_ROUNDS_SQL = '''SELECT `incident_id`, `plan_notification_id`, max(`count`)
 FROM (
-    SELECT
-        `message`.`incident_id` as `incident_id`,
-        `message`.`plan_notification_id` as `plan_notification_id`,
-        count(`message`.`id`) as `count`,
-        `plan_notification`.`repeat` + 1 as `max`,
-        TIMESTAMPDIFF(SECOND, max(`message`.`created`), NOW()) as `age`,
-        `plan_notification`.`wait` as `wait`,
-        `plan_notification`.`step` as `step`,
-        `incident`.`current_step`,
-        `plan`.`step_count`,
-        `message`.`plan_id`,
-        `message`.`application_id`,
-        `incident`.`context`
+    SELECT `incident_id`, `plan_notification_id`, count(`id`) as `count`
     FROM `message`
-    JOIN `incident` ON `message`.`incident_id` = `incident`.`id`
-    JOIN `plan_notification` ON `message`.`plan_notification_id` = `plan_notification`.`id`
-    JOIN `plan` ON `message`.`plan_id` = `plan`.`id`
-    WHERE `incident`.`active` = 1
-    GROUP BY `incident`.`id`, `message`.`plan_notification_id`, `message`.`target_id`
+    WHERE `incident_id` IN %s
+    GROUP BY `incident_id`, `plan_notification_id`, `target_id`
 ) as `inner`
-GROUP BY `incident_id`, `plan_notification_id`
-HAVING `age` > `wait` AND (`count` < `max`
-                           OR (`count` = `max` AND `step` = `current_step`
-                               AND `step` < `step_count`))'''
-
-UPDATE_INCIDENT_SQL = '''UPDATE `incident` SET `current_step`=%s WHERE `id`=%s'''
+GROUP BY `incident_id`, `plan_notification_id`'''
 
-INVALIDATE_INCIDENT = '''UPDATE `incident` SET `active`=0 WHERE `id`=%s'''
+INVALIDATE_INCIDENTS_SQL = '''UPDATE `incident` SET `active`=0 WHERE `id` IN %s'''
 
-INSERT_MESSAGE_SQL = '''INSERT INTO `message`
+INSERT_MESSAGES_SQL = '''INSERT INTO `message`
     (`created`, `plan_id`, `plan_notification_id`, `incident_id`, `application_id`, `target_id`, `priority_id`, `body`)
-VALUES (NOW(), %s,%s,%s,%s,%s,%s,%s)'''
+VALUES %s'''
+
+INSERT_MESSAGE_VALUES = '''(NOW(), %s,%s,%s,%s,%s,%s,%s)'''
+
+CREATED_MESSAGES_SQL = '''SELECT `id`, `incident_id`, `plan_notification_id`
+FROM `message`
+WHERE `id` >= %s AND `incident_id` IN %s'''
 
 UNSENT_MESSAGES_SQL = '''SELECT
     `message`.`body`,
@@ -158,33 +120,19 @@ LEFT OUTER JOIN `dynamic_plan_map` ON `incident`.`id` = `dynamic_plan_map`.`inci
 LEFT OUTER JOIN `target` `dynamic_target` ON `dynamic_target`.`id` = `dynamic_plan_map`.`target_id`
 WHERE `message`.`active`=1'''
 
-SENT_MESSAGE_BATCH_SQL = '''UPDATE `message`
-SET `destination`=%%s,
-    `mode_id`=%%s,
-    `template_id`=%%s,
-    `batch`=%%s,
-    `active`=FALSE,
-    `sent`=NOW()
-WHERE `id` IN %s'''
-
-SENT_MESSAGE_SQL = '''UPDATE `message`
-SET `destination`=%s,
-    `mode_id`=%s,
-    `template_id`=%s,
-    `active`=FALSE,
-    `sent`=NOW()
-WHERE `id`=%s'''
+UNSENT_INCIDENT_MESSAGES_SQL = UNSENT_MESSAGES_SQL + ''' AND `message`.`incident_id`=%s'''
 
-UPDATE_MESSAGE_BODY_SQL = '''UPDATE `message`
-                             SET `body`=%s,
-                                 `subject`=%s
-                             WHERE `id` IN %s'''
+ACTIVE_MESSAGES_SQL = '''SELECT `id` FROM `message` WHERE `active`=1 AND `id` IN %s'''
 
 PRUNE_OLD_AUDIT_LOGS_SQL = '''DELETE FROM `message_changelog` WHERE `date` < DATE_SUB(CURDATE(), INTERVAL 3 MONTH)'''
 
 # When a rendered message body is longer than this number of characters, drop it.
 MAX_MESSAGE_BODY_LENGTH = 40000
 MAX_MESSAGE_RETRIES = 2
+# Rows per multi-row message insert, to keep each statement well under max_allowed_packet
+MAX_MESSAGE_INSERT_ROWS = 500
+# How often worker processes pass their metrics back to the sender
+WORKER_PROCESS_STATS_INTERVAL = 5
 
 # logging
 logger = logging.getLogger()
@@ -210,7 +158,7 @@ if pidfile:
         logger.exception('Failed writing pid to %s', pidfile)
 
 
-# rate limiting data structure message key -> minute -> count
+# rate limiting data structure message key -> RateCounter over the plan's threshold_window
 # used to calcuate if a new message exceeds the rate limit
 # and needs to be queued
 plan_aggregate_windows = {}
@@ -229,13 +177,32 @@ aggregation = {}
 # used to determine if it's time to send the next batch
 sent = {}
 
+# batch flushes for keys with queued messages, due when their aggregation_window runs out
+aggregation_timers = TimerWheel()
+
+# ids of queued messages by incident, so claimed incidents can be dropped from the queues
+aggregated_incidents = defaultdict(set)
+
 # queue for messages entering the system
 # this sets the ground work for not having to poll the DB for messages
 message_queue = queue.Queue()
 
+# held while moving incidents past step 0, so incidents pushed to us by the API
+# and the periodic escalate run don't both create messages for the same step
+escalation_lock = Semaphore()
+
 # Quota object used for rate limiting
 quota = None
 
+# In-memory escalation state used by the master to fire repeats, escalations and deactivations
+escalation_scheduler = None
+
+# Write-behind buffer for the updates made to messages once they're sent
+message_writeback = None
+
+# Optional on disk journal of the messages in the send queues
+journal = None
+
 # Coordinator object for sender master election
 coordinator = None
 
@@ -245,6 +212,15 @@ worker_tasks = defaultdict(list)
 # MX -> [{'greenlet': greenlet, 'kill_set': gevent.Event}]
 autoscale_email_worker_tasks = defaultdict(list)
 
+# Mode -> [WorkerProcess], for modes whose workers send from child processes
+worker_processes = defaultdict(list)
+
+# Mode -> WorkerAutoscaler, for modes whose worker count follows their queue
+worker_autoscalers = {}
+
+# Config autoscaled workers get spawned with
+autoscale_worker_config = None
+
 # support the 2nd control+c force exiting sender without waiting for tasks to finish
 shutdown_started = False
 
@@ -267,11 +243,11 @@ default_sender_metrics = {
     'rpc_message_pass_success_cnt': 0, 'rpc_message_pass_fail_cnt': 0,
     'slave_message_send_success_cnt': 0, 'slave_message_send_fail_cnt': 0,
     'msg_drop_length_cnt': 0, 'send_queue_gets_cnt': 0, 'send_queue_puts_cnt': 0,
-    'send_queue_email_size': 0, 'send_queue_im_size': 0, 'send_queue_slack_size': 0, 'send_queue_call_size': 0,
-    'send_queue_sms_size': 0, 'send_queue_drop_size': 0, 'new_incidents_cnt': 0, 'workers_respawn_cnt': 0,
+    'new_incidents_cnt': 0, 'workers_respawn_cnt': 0,
     'message_retry_cnt': 0, 'message_ids_being_sent_cnt': 0, 'notifications': 0, 'deactivation': 0,
     'new_msg_count': 0, 'poll': 0, 'queue': 0, 'aggregations': 0, 'hipchat_cnt': 0, 'hipchat_fail': 0,
-    'hipchat_total': 0, 'hipchat_sent': 0, 'hipchat_max': 0, 'hipchat_min': 0
+    'hipchat_total': 0, 'hipchat_sent': 0, 'hipchat_max': 0, 'hipchat_min': 0,
+    'new_incident_push_cnt': 0, 'escalation_claim_lost_cnt': 0, 'repeat_claim_lost_cnt': 0
 }
 
 # TODO: make this configurable
@@ -280,8 +256,10 @@ should_mock_gwatch_renewer = False
 config = None
 
 
-def create_messages(incident_id, plan_notification_id):
-    application_id = cache.incidents[incident_id]['application_id']
+def resolve_notification(incident_id, plan_notification_id):
+    # figure out who to message for a plan notification. Returns None if nobody could be
+    # found, otherwise (names, priority_id, body, redirect) where redirect holds the
+    # (old, description) of the target change to audit when falling back to the plan creator
     plan_notification = cache.plan_notifications[plan_notification_id]
     if plan_notification['role_id'] is None and plan_notification['target_id'] is None:
         dynamic_info = cache.dynamic_plan_map[incident_id][plan_notification['dynamic_index']]
@@ -302,99 +280,192 @@ def create_messages(incident_id, plan_notification_id):
         lookup_fail_reason = None
 
     priority_id = plan_notification['priority_id']
-    redirect_to_plan_owner = False
-    body = ''
 
-    if not names:
+    if names:
+        return names, priority_id, '', None
 
-        # if message is optional don't bother the creator, simply return true instead
-        if plan_notification['optional']:
-            return True
+    # if message is optional don't bother the creator, simply report success instead
+    if plan_notification['optional']:
+        return [], priority_id, '', None
 
-        # Try to get creator of the plan and nag them instead
-        name = None
-        try:
-            name = cache.plans[plan_notification['plan_id']]['creator']
-        except (KeyError, TypeError):
-            pass
-
-        if not name:
-            logger.error(('Failed to find targets for incident %s, plan_notification_id: %s, '
-                          'role: %s, target: %s, result: %s and failed looking '
-                          'up the plan\'s creator'),
-                         incident_id, plan_notification_id, role, target, names)
-            return False
-
-        try:
-            priority_id = api_cache.priorities['low']['id']
-        except KeyError:
-            logger.error(('Failed to find targets for incident %s, plan_notification_id: %s, '
-                          'role: %s, target: %s, result: %s and failed looking '
-                          'up ID for low priority'),
-                         incident_id, plan_notification_id, role, target, names)
-            return False
+    # Try to get creator of the plan and nag them instead
+    name = None
+    try:
+        name = cache.plans[plan_notification['plan_id']]['creator']
+    except (KeyError, TypeError):
+        pass
 
+    if not name:
         logger.error(('Failed to find targets for incident %s, plan_notification_id: %s, '
-                      'role: %s, target: %s, result: %s. '
-                      'Reaching out to %s instead and lowering priority to low (%s)'),
-                     incident_id, plan_notification_id, role, target, names, name, priority_id)
+                      'role: %s, target: %s, result: %s and failed looking '
+                      'up the plan\'s creator'),
+                     incident_id, plan_notification_id, role, target, names)
+        return None
 
-        body = ('You are receiving this as you created this plan and we can\'t resolve'
-                ' %s of %s at this time%s.\n\n') % (role, target, ': %s' % lookup_fail_reason if lookup_fail_reason else '')
+    try:
+        priority_id = api_cache.priorities['low']['id']
+    except KeyError:
+        logger.error(('Failed to find targets for incident %s, plan_notification_id: %s, '
+                      'role: %s, target: %s, result: %s and failed looking '
+                      'up ID for low priority'),
+                     incident_id, plan_notification_id, role, target, names)
+        return None
+
+    logger.error(('Failed to find targets for incident %s, plan_notification_id: %s, '
+                  'role: %s, target: %s, result: %s. '
+                  'Reaching out to %s instead and lowering priority to low (%s)'),
+                 incident_id, plan_notification_id, role, target, names, name, priority_id)
+
+    body = ('You are receiving this as you created this plan and we can\'t resolve'
+            ' %s of %s at this time%s.\n\n') % (role, target, ': %s' % lookup_fail_reason if lookup_fail_reason else '')
+
+    redirect = (role + '|' + target,
+                lookup_fail_reason or 'Changing target to plan owner as we failed resolving original target')
+    return [name], priority_id, body, redirect
+
+
+def claim_repeats(cursor, created_counts):
+    # Returns the notifications somebody else repeated since we last created messages for them.
+    # The incidents stay locked until we commit, so a sender repeating them at the same time
+    # waits for us and then sees our messages.
+    incident_ids = tuple({incident_id for incident_id, _ in created_counts})
+    cursor.execute(LOCK_INCIDENTS_SQL, [incident_ids])
+    cursor.execute(NOTIFICATION_ROUNDS_SQL, [incident_ids])
+    rounds = {(incident_id, plan_notification_id): count for incident_id, plan_notification_id, count in cursor}
+    return {key for key, count in created_counts.iteritems() if rounds.get(key, 0) > count}
+
+
+def create_messages(notifications, created_counts=None):
+    '''
+    Create the messages for a batch of (incident_id, plan_notification_id) pairs with
+    multi-row inserts, so a whole escalation pass costs a handful of queries instead of
+    one per target. Returns the set of pairs that were handled successfully.
+
+    For repeats, created_counts holds the number of times we know each pair was notified
+    already; pairs another sender notified again since are skipped.
+    '''
+    handled = set()
+    resolved = []
+    redirects = {}
+    for key in notifications:
+        result = resolve_notification(*key)
+        if result is None:
+            continue
+        handled.add(key)
+        names, priority_id, body, redirect = result
+        if redirect:
+            redirects[key] = (redirect[0], names[0], redirect[1])
+        resolved.append((key, names, priority_id, body))
+
+    cache.target_names.prefetch({name for _, names, _, _ in resolved for name in names})
+
+    rows = []
+    created = set()
+    for (incident_id, plan_notification_id), names, priority_id, body in resolved:
+        plan_id = cache.plan_notifications[plan_notification_id]['plan_id']
+        application_id = cache.incidents[incident_id]['application_id']
+        for name in names:
+            t = cache.target_names[name]
+            if t:
+                rows.append((plan_id, plan_notification_id, incident_id, application_id, t['id'], priority_id, body))
+                created.add((incident_id, plan_notification_id))
+            else:
+                metrics.incr('target_not_found')
+                logger.warn('Failed to notify plan creator; no active target found: %s', name)
 
-        names = [name]
-        redirect_to_plan_owner = True
+    if not rows:
+        return handled
 
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
 
-    for name in names:
-        t = cache.target_names[name]
-        if t:
-            target_id = t['id']
-            cursor.execute(INSERT_MESSAGE_SQL,
-                           (plan_notification['plan_id'], plan_notification_id, incident_id,
-                            application_id, target_id, priority_id, body))
-
-            if redirect_to_plan_owner:
-                # needed for the lastrowid to exist in the DB to satisfy the constraint
-                connection.commit()
-                auditlog.message_change(
-                    cursor.lastrowid,
-                    auditlog.TARGET_CHANGE,
-                    role + '|' + target,
-                    name,
-                    lookup_fail_reason or 'Changing target to plan owner as we failed resolving original target')
+    if created_counts:
+        repeated = claim_repeats(cursor, created_counts)
+        if repeated:
+            metrics.incr('repeat_claim_lost_cnt', len(repeated))
+            logger.info('%s notifications were already repeated by another sender', len(repeated))
+            rows = [row for row in rows if (row[2], row[1]) not in repeated]
+            created -= repeated
+            handled -= repeated
+            escalation_scheduler.invalidate()
+        if not rows:
+            connection.commit()
+            cursor.close()
+            connection.close()
+            return handled
+
+    first_id = None
+    for i in xrange(0, len(rows), MAX_MESSAGE_INSERT_ROWS):
+        chunk = rows[i:i + MAX_MESSAGE_INSERT_ROWS]
+        cursor.execute(INSERT_MESSAGES_SQL % ', '.join([INSERT_MESSAGE_VALUES] * len(chunk)),
+                       [field for row in chunk for field in row])
+        if first_id is None:
+            first_id = cursor.lastrowid
+    # needed for the message ids to exist in the DB to satisfy the changelog constraint
+    connection.commit()
 
-        else:
-            metrics.incr('target_not_found')
-            logger.warn('Failed to notify plan creator; no active target found: %s', name)
+    redirects = {key: change for key, change in redirects.iteritems() if key in created}
+    if redirects:
+        # ids of a multi-row insert aren't guaranteed to be contiguous, so look them up
+        cursor.execute(CREATED_MESSAGES_SQL, (first_id, tuple({incident_id for incident_id, _ in redirects})))
+        changes = []
+        for message_id, incident_id, plan_notification_id in cursor:
+            change = redirects.get((incident_id, plan_notification_id))
+            if change:
+                changes.append((message_id, auditlog.TARGET_CHANGE) + change)
+        auditlog.message_changes(changes)
 
-    connection.commit()
     cursor.close()
     connection.close()
-    return True
+
+    for incident_id, plan_notification_id in created:
+        escalation_scheduler.messages_created(incident_id, plan_notification_id)
+    return handled
 
 
-def deactivate():
-    # deactivate incidents that have expired
+def repeat_notifications(notifications):
+    # repeat plan notifications whose wait expired and that have repeats left
+    created_counts = {}
+    for key in notifications:
+        count = escalation_scheduler.created_count(key)
+        if count is not None:
+            created_counts[key] = count
+    msg_count = len(create_messages(notifications, created_counts))
+    logger.info('[*] %s repeated notifications', msg_count)
+
+
+def escalate_incidents(escalations):
+    # move incidents to their next step once a notification of the current step is exhausted
+    with escalation_lock:
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        claimed = claim_escalations(connection, escalations)
+        if len(claimed) < len(escalations):
+            # Whoever did already may have created messages we don't know of
+            escalation_scheduler.invalidate()
+        msg_count = apply_escalations(connection, cursor, claimed)
+        cursor.close()
+        connection.close()
+    logger.info('[*] escalated %s incidents, %s new messages', len(claimed), msg_count)
+
+
+def deactivate_incidents(incident_ids):
+    # deactivate incidents that have exhausted their last step
     logger.info('[-] start deactivate task...')
     start_deactivation = time.time()
 
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
 
+    ids = tuple(incident_ids)
     max_retries = 3
 
     # this deadlocks sometimes. try until it doesn't.
     for i in xrange(1, max_retries + 1):
         try:
-            cursor.execute(GET_INACTIVE_IDS_SQL)
-            ids = tuple(r[0] for r in cursor)
-            if ids:
-                cursor.execute(INACTIVE_SQL, (ids,))
-                connection.commit()
-                break
+            cursor.execute(INACTIVE_SQL, (ids,))
+            connection.commit()
+            break
         except Exception:
             if i == max_retries:
                 logger.exception('Failed running deactivate query. (Try %s/%s)', i, max_retries)
@@ -405,172 +476,380 @@ def deactivate():
     cursor.close()
     connection.close()
 
+    drop_claimed_incidents(ids)
+
     metrics.set('deactivation', time.time() - start_deactivation)
-    logger.info('[*] deactivate task finished')
+    logger.info('[*] deactivate task finished - deactivated %s incidents', len(ids))
 
 
-def escalate():
-    # make notifications for things that should repeat or escalate
-    logger.info('[-] start escalate task...')
+def send_tracking_message(incident_id, created, plan_id, context, application):
+    # create tracking message if configured
+    plan = cache.plans[plan_id]
+    tracking_type = plan['tracking_type']
+    tracking_key = plan['tracking_key']
+    tracking_template = plan['tracking_template']
+    app_tracking_template = tracking_template.get(application) if tracking_template else None
+    if not (tracking_type and tracking_key and app_tracking_template):
+        return
 
-    # first, handle new incidents
-    start_notifications = time.time()
+    # plan defines tracking notifications
+    context = ujson.loads(context)
+    context['iris'] = {
+        'incident_id': incident_id,
+        'plan': plan['name'],
+        'plan_id': plan_id,
+        'application': application,
+        'incident_created': created,
+    }
+    if tracking_type == 'email':
+        tracking_message = {
+            'noreply': True,
+            'destination': tracking_key,
+            'mode': tracking_type
+        }
 
-    connection = db.engine.raw_connection()
-    cursor = connection.cursor()
-    cursor.execute(NEW_INCIDENTS)
+        try:
+            subject = app_tracking_template['email_subject'].render(**context)
+        except Exception as e:
+            subject = 'plan %s - tracking notification subject failed to render: %s' % (plan['name'], e)
+            logger.exception(subject)
+        tracking_message['email_subject'] = subject
 
-    escalations = {}
-    for incident_id, created, plan_id, context, application in cursor:
-        escalations[incident_id] = (plan_id, 1)
-        # create tracking message if configured
-        plan = cache.plans[plan_id]
-        tracking_type = plan['tracking_type']
-        tracking_key = plan['tracking_key']
-        tracking_template = plan['tracking_template']
-        app_tracking_template = tracking_template.get(application) if tracking_template else None
-        if tracking_type and tracking_key and app_tracking_template:
-            # plan defines tracking notifications
-            context = ujson.loads(context)
-            context['iris'] = {
-                'incident_id': incident_id,
-                'plan': plan['name'],
-                'plan_id': plan_id,
-                'application': application,
-                'incident_created': created,
-            }
-            if tracking_type == 'email':
-                tracking_message = {
-                    'noreply': True,
-                    'destination': tracking_key,
-                    'mode': tracking_type
-                }
+        try:
+            body = app_tracking_template['email_text'].render(**context)
+        except Exception as e:
+            body = 'plan %s - tracking notification body failed to render: %s' % (plan['name'], e)
+            logger.exception(body)
+        tracking_message['email_text'] = body
+
+        email_html_tpl = app_tracking_template.get('email_html')
+        if email_html_tpl:
+            try:
+                html_body = email_html_tpl.render(**context)
+            except Exception as e:
+                html_body = 'plan %s - tracking notification html body failed to render: %s' % (plan['name'], e)
+                logger.exception(html_body)
+            tracking_message['email_html'] = html_body
+    else:
+        tracking_message = {
+            'noreply': True,
+            'destination': tracking_key,
+            'mode': tracking_type
+        }
+        try:
+            body = app_tracking_template['body'].render(**context)
+        except Exception as e:
+            body = 'plan %s - tracking notification body failed to render: %s' % (plan['name'], e)
+            logger.exception(body)
+        tracking_message['body'] = body
 
-                try:
-                    subject = app_tracking_template['email_subject'].render(**context)
-                except Exception as e:
-                    subject = 'plan %s - tracking notification subject failed to render: %s' % (plan['name'], e)
-                    logger.exception(subject)
-                tracking_message['email_subject'] = subject
+    message_send_enqueue(tracking_message)
 
-                try:
-                    body = app_tracking_template['email_text'].render(**context)
-                except Exception as e:
-                    body = 'plan %s - tracking notification body failed to render: %s' % (plan['name'], e)
-                    logger.exception(body)
-                tracking_message['email_text'] = body
-
-                email_html_tpl = app_tracking_template.get('email_html')
-                if email_html_tpl:
-                    try:
-                        html_body = email_html_tpl.render(**context)
-                    except Exception as e:
-                        html_body = 'plan %s - tracking notification html body failed to render: %s' % (plan['name'], e)
-                        logger.exception(html_body)
-                    tracking_message['email_html'] = html_body
-            else:
-                tracking_message = {
-                    'noreply': True,
-                    'destination': tracking_key,
-                    'mode': tracking_type
-                }
-                try:
-                    body = app_tracking_template['body'].render(**context)
-                except Exception as e:
-                    body = 'plan %s - tracking notification body failed to render: %s' % (plan['name'], e)
-                    logger.exception(body)
-                tracking_message['body'] = body
 
-            message_send_enqueue(tracking_message)
+def claim_escalations(connection, escalations):
+    # Move incidents to their next step, unless somebody else got there first. Returns the
+    # escalations that are ours to create the messages of.
+    cursor = connection.cursor()
+    claimed = {}
+    for incident_id, (plan_id, step) in escalations.iteritems():
+        cursor.execute(CLAIM_INCIDENT_STEP_SQL, (step, incident_id, step - 1))
+        if cursor.rowcount:
+            claimed[incident_id] = (plan_id, step)
+    connection.commit()
     cursor.close()
 
-    new_incidents_count = len(escalations)
-    metrics.set('new_incidents_cnt', new_incidents_count)
-    logger.info('[*] %s new incidents', new_incidents_count)
+    lost = len(escalations) - len(claimed)
+    if lost:
+        metrics.incr('escalation_claim_lost_cnt', lost)
+        logger.info('%s incidents were already escalated by another sender', lost)
+    return claimed
 
-    # then, fetch message count for current incidents
-    msg_count = 0
-    cursor = connection.cursor(db.dict_cursor)
-    cursor.execute(QUEUE_SQL)
-    for n in cursor.fetchall():
-        if n['count'] < n['max']:
-            if create_messages(n['incident_id'], n['plan_notification_id']):
-                msg_count += 1
-        else:
-            escalations[n['incident_id']] = (n['plan_id'], n['current_step'] + 1)
 
+def start_new_incidents(connection, rows):
+    # new incidents go straight to their first step
+    rows = list(rows)
+    escalations = claim_escalations(connection, {row[0]: (row[2], 1) for row in rows})
+    for incident_id, created, plan_id, context, application in rows:
+        if incident_id in escalations:
+            send_tracking_message(incident_id, created, plan_id, context, application)
+    return escalations
+
+
+def apply_escalations(connection, cursor, escalations):
+    incident_steps = {}
+    invalid = []
     for incident_id, (plan_id, step) in escalations.iteritems():
         plan = cache.plans[plan_id]
         steps = plan['steps'].get(step, [])
         if steps:
-            step_msg_cnt = 0
-            for plan_notification_id in steps:
-                if create_messages(incident_id, plan_notification_id):
-                    step_msg_cnt += 1
-            if step == 1 and step_msg_cnt == 0:
-                # no message created due to role look up failure, reset step to
-                # 0 for retry
-                step = 0
-            cursor.execute(UPDATE_INCIDENT_SQL, (step, incident_id))
-            msg_count += step_msg_cnt
+            incident_steps[incident_id] = steps
         else:
             logger.error('plan id %d has no steps, incident id %d is invalid', plan_id, incident_id)
-            cursor.execute(INVALIDATE_INCIDENT, incident_id)
-        connection.commit()
-    cursor.close()
-    connection.close()
+            invalid.append(incident_id)
+
+    try:
+        handled = create_messages([(incident_id, plan_notification_id)
+                                   for incident_id, plan_notification_ids in incident_steps.iteritems()
+                                   for plan_notification_id in plan_notification_ids])
+    except Exception:
+        # Give our claims back, so these get escalated again rather than stuck without messages
+        try:
+            for incident_id, (plan_id, step) in escalations.iteritems():
+                cursor.execute(CLAIM_INCIDENT_STEP_SQL, (step - 1, incident_id, step))
+            connection.commit()
+        except Exception:
+            logger.exception('Failed giving back claims of %s incidents', len(escalations))
+        raise
+
+    msg_count = 0
+    step_updates = defaultdict(list)
+    for incident_id, steps in incident_steps.iteritems():
+        plan_id, step = escalations[incident_id]
+        step_msg_cnt = sum(1 for plan_notification_id in steps if (incident_id, plan_notification_id) in handled)
+        if step == 1 and step_msg_cnt == 0:
+            # no message created due to role look up failure, reset step to
+            # 0 for retry
+            step = 0
+        step_updates[step].append(incident_id)
+        msg_count += step_msg_cnt
+
+    # Claiming already moved the rest to their step
+    if step_updates[0]:
+        cursor.execute(UPDATE_INCIDENTS_SQL, (0, tuple(step_updates[0])))
+    if invalid:
+        cursor.execute(INVALIDATE_INCIDENTS_SQL, [tuple(invalid)])
+    connection.commit()
+
+    for step, incident_ids in step_updates.iteritems():
+        for incident_id in incident_ids:
+            escalation_scheduler.step_changed(incident_id, escalations[incident_id][0], step)
+    for incident_id in invalid:
+        escalation_scheduler.forget_incident(incident_id)
+    return msg_count
+
+
+def escalate():
+    # make notifications for new incidents. repeats and escalations of existing
+    # incidents are fired by the escalation scheduler when they're due
+    logger.info('[-] start escalate task...')
+    start_notifications = time.time()
+
+    with escalation_lock:
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        cursor.execute(NEW_INCIDENTS)
+        escalations = start_new_incidents(connection, [row for row in cursor if coordinator.owns_incident(row[0])])
+
+        new_incidents_count = len(escalations)
+        metrics.set('new_incidents_cnt', new_incidents_count)
+        logger.info('[*] %s new incidents', new_incidents_count)
+
+        msg_count = apply_escalations(connection, cursor, escalations)
+        cursor.close()
+        connection.close()
 
     logger.info('[*] %s new messages', msg_count)
     logger.info('[*] escalate task finished')
     metrics.set('notifications', time.time() - start_notifications)
 
 
-def aggregate(now):
-    # see if it's time to send the batches
-    logger.info('[-] start aggregate task - queued: %s', len(messages))
-    start_aggregations = time.time()
+def escalate_incident(incident_id):
+    # run the first step for a single new incident and queue its messages right away
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
-    cursor.execute('SELECT `id` FROM `message` WHERE active=1')
-    all_actives = {r[0] for r in cursor}
+
+    with escalation_lock:
+        cursor.execute(NEW_INCIDENT_SQL, incident_id)
+        escalations = start_new_incidents(connection, cursor.fetchall())
+        msg_count = apply_escalations(connection, cursor, escalations)
+    cursor.close()
+
+    if not escalations:
+        # already picked up by the periodic escalate run, or gone inactive
+        logger.info('Pushed incident %s is not new anymore; skipping', incident_id)
+        connection.close()
+        return
+
+    logger.info('[*] %s new messages for pushed incident %s', msg_count, incident_id)
+
+    cursor = connection.cursor(db.dict_cursor)
+    cursor.execute(UNSENT_INCIDENT_MESSAGES_SQL, incident_id)
+    unwritten = message_writeback.unwritten()
+    for m in cursor:
+        if m['message_id'] not in messages and m['message_id'] not in unwritten:
+            queue_unsent_message(m)
     cursor.close()
     connection.close()
-    for key in queues.keys():
-        aggregation_window = cache.plans[key[0]]['aggregation_window']
-        if now - sent.get(key, 0) >= aggregation_window:
-            aggregated_message_ids = queues[key]
-            active_message_ids = aggregated_message_ids & all_actives
-            l = len(active_message_ids)
-
-            if l == 1:
-                m = messages.pop(next(iter(active_message_ids)))
-                logger.info('aggregate - %(message_id)s pushing to send queue', m)
-                message_send_enqueue(m)
-            elif l > 1:
-                uuid = uuid4().hex
-                m = messages[next(iter(active_message_ids))]
-                logger.info('aggregate - %s pushing to send queue', uuid)
-                m['batch_id'] = uuid
-
-                # Cast from set to list, as sets are not msgpack serializable
-                m['aggregated_ids'] = list(active_message_ids)
-                message_send_enqueue(m)
-
-                for message_id in aggregated_message_ids:
-                    messages.pop(message_id, None)
-                logger.info('[-] purged %s from messages %s remaining', active_message_ids, len(messages))
-            del queues[key]
-            sent[key] = now
-    inactive_message_ids = messages.viewkeys() - all_actives
-    logger.info('[x] dropped %s inactive messages from claimed incidents, %s remain',
-                len(inactive_message_ids), len(messages))
 
-    # remove inactive message from the queue
-    for message_id in inactive_message_ids:
-        messages.pop(message_id, None)
 
+def escalate_new_incident(incident_id, forwarded=False):
+    # called over RPC by the API after it commits a new incident, or by a sender that got it
+    # for a shard it doesn't own. Only the incident's owner escalates; the periodic escalate
+    # run covers anything we miss here.
+    if not coordinator.owns_incident(incident_id):
+        owner = None if forwarded else coordinator.incident_owner(incident_id)
+        if owner is None:
+            return False
+        spawn(sender_client.send_incident_notification, incident_id, owner, True)
+        return True
+    metrics.incr('new_incident_push_cnt')
+    spawn(escalate_incident, incident_id)
+    return True
+
+
+def get_active_message_ids(message_ids):
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(ACTIVE_MESSAGES_SQL, [tuple(message_ids)])
+    active_message_ids = {r[0] for r in cursor}
+    cursor.close()
+    connection.close()
+    return active_message_ids
+
+
+def queue_aggregated_message(key, m, now):
+    queues.setdefault(key, set()).add(m['message_id'])
+    messages[m['message_id']] = m
+    aggregated_incidents[m.get('incident_id')].add(m['message_id'])
+    if key not in aggregation_timers:
+        aggregation_timers.schedule(key, sent.get(key, now) + cache.plans[key[0]]['aggregation_window'])
+
+
+def pop_aggregated_message(message_id):
+    m = messages.pop(message_id, None)
+    if m:
+        incident_id = m.get('incident_id')
+        incident_message_ids = aggregated_incidents.get(incident_id)
+        if incident_message_ids is not None:
+            incident_message_ids.discard(message_id)
+            if not incident_message_ids:
+                del aggregated_incidents[incident_id]
+    return m
+
+
+def send_aggregation(key, now):
+    aggregated_message_ids = queues.pop(key, set())
+    sent[key] = now
+    if not aggregated_message_ids:
+        return
+
+    # Claim events should have taken these out already, but incidents also go
+    # inactive in ways nobody tells us about
+    active_message_ids = get_active_message_ids(aggregated_message_ids)
+    aggregated_messages = {}
+    for message_id in aggregated_message_ids:
+        m = pop_aggregated_message(message_id)
+        if m and message_id in active_message_ids:
+            aggregated_messages[message_id] = m
+    l = len(aggregated_messages)
+
+    if l == 1:
+        m = next(aggregated_messages.itervalues())
+        logger.info('aggregate - %(message_id)s pushing to send queue', m)
+        message_send_enqueue(m)
+    elif l > 1:
+        uuid = uuid4().hex
+        m = next(aggregated_messages.itervalues())
+        logger.info('aggregate - %s pushing to send queue', uuid)
+        m['batch_id'] = uuid
+
+        # Cast from set to list, as sets are not msgpack serializable
+        m['aggregated_ids'] = list(aggregated_messages)
+        message_send_enqueue(m)
+        logger.info('[-] purged %s from messages %s remaining', aggregated_messages.keys(), len(messages))
+
+    if len(aggregated_message_ids) > l:
+        logger.info('[x] dropped %s inactive messages of key (%s, %s, %s, %s)',
+                    len(aggregated_message_ids) - l, *key)
+
+
+def aggregate(now):
+    # send the batches whose aggregation window just ran out
+    due = aggregation_timers.advance(now)
+    if not due:
+        return
+    start_aggregations = time.time()
+    for key in due:
+        try:
+            send_aggregation(key, now)
+        except Exception:
+            metrics.incr('task_failure')
+            logger.exception('Failed sending aggregated messages of key (%s, %s, %s, %s)', *key)
     metrics.set('aggregations', time.time() - start_aggregations)
-    logger.info('[*] aggregate task finished - queued: %s', len(messages))
+    metrics.set('queue', len(messages))
+    logger.info('[*] sent %s aggregated batches - queued: %s', len(due), len(messages))
+
+
+def aggregation_flusher():
+    while True:
+        sleep(aggregation_timers.tick)
+        aggregate(time.time())
+
+
+def drop_claimed_incidents(incident_ids):
+    # take messages of claimed or deactivated incidents out of the aggregation queues
+    dropped = 0
+    for incident_id in incident_ids:
+        for message_id in list(aggregated_incidents.get(incident_id, ())):
+            m = pop_aggregated_message(message_id)
+            key = (m['plan_id'], m['application'], m['priority'], m['target'])
+            key_queue = queues.get(key)
+            if key_queue is not None:
+                key_queue.discard(message_id)
+                if not key_queue:
+                    del queues[key]
+                    aggregation_timers.cancel(key)
+            dropped += 1
+    if dropped:
+        logger.info('[x] dropped %s queued messages of claimed incidents, %s remain', dropped, len(messages))
+
+
+def invalidate_contacts(users, applications):
+    cache.target_contacts.invalidate(users, applications)
+    # Users registering a device for push notifications get them on their next message
+    push_devices.invalidate(users)
+
+
+def incidents_claimed(incident_ids, forwarded=False):
+    # called over RPC by the API. With sharding, the messages of these incidents are held
+    # by whoever owns them, so pass the ones we don't own on
+    if coordinator.sharded and not forwarded:
+        owned_elsewhere = defaultdict(list)
+        for incident_id in incident_ids:
+            if not coordinator.owns_incident(incident_id):
+                owner = coordinator.incident_owner(incident_id)
+                if owner is not None:
+                    owned_elsewhere[owner].append(incident_id)
+        for owner, owner_incident_ids in owned_elsewhere.iteritems():
+            spawn(sender_client.send_incidents_claimed, owner_incident_ids, owner, True)
+    drop_claimed_incidents(incident_ids)
+
+
+def reassign_shards():
+    # Senders joined or left, so incidents changed hands. Stop escalating what we had straight
+    # away and pick up the escalation state of whatever we own now
+    logger.info('Incident shards changed; reloading escalation state')
+    escalation_scheduler.reset()
+    if coordinator.has_shard():
+        spawn(escalation_scheduler.rebuild)
+
+    # The new owners find these in the DB on their next poll
+    drop_claimed_incidents([incident_id for incident_id in aggregated_incidents
+                            if not coordinator.owns_incident(incident_id)])
+
+
+def queue_unsent_message(m):
+    # Set dynamic target as target if applicable
+    if m.get('dynamic_target') and m.get('target') is None:
+        m['target'] = m['dynamic_target']
+    # iris's own email response does not have context since content and
+    # subject are already set
+    if m.get('context'):
+        context = ujson.loads(m['context'])
+        # inject meta variables
+        context['iris'] = {k: m[k] for k in m if k != 'context'}
+        m['context'] = context
+    message_queue.put(m)
 
 
 def poll():
@@ -580,8 +859,10 @@ def poll():
 
     connection = db.engine.raw_connection()
     cursor = connection.cursor(db.dict_cursor)
-    if messages:
-        cursor.execute(UNSENT_MESSAGES_SQL + ' AND `message`.`id` NOT IN %s', [tuple(messages)])
+    # skip ones we have queued, or sent but not yet written back as such
+    skip_message_ids = messages.viewkeys() | message_writeback.unwritten()
+    if skip_message_ids:
+        cursor.execute(UNSENT_MESSAGES_SQL + ' AND `message`.`id` NOT IN %s', [tuple(skip_message_ids)])
     else:
         cursor.execute(UNSENT_MESSAGES_SQL)
 
@@ -591,17 +872,8 @@ def poll():
     logger.info('%d new messages waiting in database - queued: %d', new_msg_count, queued_msg_cnt)
 
     for m in cursor:
-        # Set dynamic target as target if applicable
-        if m.get('dynamic_target') and m.get('target') is None:
-            m['target'] = m['dynamic_target']
-        # iris's own email response does not have context since content and
-        # subject are already set
-        if m.get('context'):
-            context = ujson.loads(m['context'])
-            # inject meta variables
-            context['iris'] = {k: m[k] for k in m if k != 'context'}
-            m['context'] = context
-        message_queue.put(m)
+        if coordinator.owns_incident(m['incident_id']):
+            queue_unsent_message(m)
 
     metrics.set('poll', time.time() - start_send)
     metrics.set('queue', len(messages))
@@ -613,7 +885,6 @@ def poll():
 def fetch_and_prepare_message():
     now = time.time()
     m = message_queue.get()
-    message_id = m['message_id']
     plan_id = m['plan_id']
     if plan_id is None:
         message_send_enqueue(m)
@@ -644,32 +915,27 @@ def fetch_and_prepare_message():
 
     if aggregate:
         # we are still in a previous aggregation mode
-        queues.setdefault(key, set()).add(message_id)
-        messages[message_id] = m
+        queue_aggregated_message(key, m, now)
     else:
         # does this message trigger aggregation?
-        window = plan_aggregate_windows.setdefault(key, defaultdict(int))
+        window = plan_aggregate_windows.get(key)
+        if window is None or window.window != plan['threshold_window']:
+            window = plan_aggregate_windows[key] = RateCounter(plan['threshold_window'])
 
-        for bucket in window.keys():
-            if now - bucket > plan['threshold_window']:
-                del window[bucket]
+        window.add(now)
 
-        window[now] += 1
-
-        if sum(window.itervalues()) > plan['threshold_count']:
+        if window.count(now) > plan['threshold_count']:
             # too many messages for the aggregation key - enqueue
 
-            # add message id to aggregation queue
-            queues.setdefault(key, set()).add(message_id)
-            # add message id to queue for deduping
-            messages[message_id] = m
             # initialize last sent tracker
             sent[key] = now
             # initialize aggregation indicator
             aggregation[key] = now
+            # add message id to aggregation queue, and to queue for deduping
+            queue_aggregated_message(key, m, now)
             # TODO: also render message content here?
             audit_msg = 'Aggregated with key (%s, %s, %s, %s)' % key
-            spawn(auditlog.message_change, m['message_id'], auditlog.SENT_CHANGE, '', '', audit_msg)
+            auditlog.message_change(m['message_id'], auditlog.SENT_CHANGE, '', '', audit_msg)
         else:
             # cleared for immediate sending
             message_send_enqueue(m)
@@ -684,17 +950,23 @@ def send():
 
 def set_target_fallback_mode(message):
     try:
-        connection = db.engine.raw_connection()
-        cursor = connection.cursor()
-        cursor.execute('''SELECT `destination`, `mode`.`name`, `mode`.`id`
-                          FROM `target`
-                          JOIN `target_contact` ON `target_contact`.`target_id` = `target`.`id`
-                          JOIN `mode` ON `mode`.`id` = `target_contact`.`mode_id`
-                          WHERE `target`.`name` = %s AND `mode`.`name` = %s''',
-                       (message['target'], target_fallback_mode))
-        [(destination, mode, mode_id)] = cursor
-        cursor.close()
-        connection.close()
+        destination = cache.target_contacts.by_mode(message['target'], mode=target_fallback_mode)
+        if destination is not None:
+            mode = target_fallback_mode
+            mode_id = cache.target_contacts.mode_ids[mode]
+        else:
+            # not a user we have contacts for; look the target up directly
+            connection = db.engine.raw_connection()
+            cursor = connection.cursor()
+            cursor.execute('''SELECT `destination`, `mode`.`name`, `mode`.`id`
+                              FROM `target`
+                              JOIN `target_contact` ON `target_contact`.`target_id` = `target`.`id`
+                              JOIN `mode` ON `mode`.`id` = `target_contact`.`mode_id`
+                              WHERE `target`.`name` = %s AND `mode`.`name` = %s''',
+                           (message['target'], target_fallback_mode))
+            [(destination, mode, mode_id)] = cursor
+            cursor.close()
+            connection.close()
 
         old_mode = message.get('mode', '')
         message['destination'] = destination
@@ -715,61 +987,12 @@ def set_target_fallback_mode(message):
 
 
 def set_target_contact_by_priority(message):
-    session = db.Session()
-    result = session.execute('''
-              SELECT `target_contact`.`destination` AS dest, `mode`.`name` AS mode_name, `mode`.`id` AS mode_id
-              FROM `mode`
-              JOIN `target` ON `target`.`name` = :target
-              JOIN `target_type` ON `target_type`.`id` = `target`.`type_id`
-              JOIN `application` ON `application`.`name` = :application
-
-              -- left join because the "drop" mode isn't going to have a target_contact entry
-              LEFT JOIN `target_contact` ON `target_contact`.`mode_id` = `mode`.`id` AND `target_contact`.`target_id` = `target`.`id`
-
-              WHERE mode.id = IFNULL((
-                        SELECT `target_application_mode`.`mode_id`
-                        FROM `target_application_mode`
-                        WHERE `target_application_mode`.`target_id` = target.id AND
-                                `target_application_mode`.`application_id` = `application`.`id` AND
-                                `target_application_mode`.`priority_id` = :priority_id
-                    ), IFNULL(
-                      -- 2. Lookup default setting for this app
-                      (
-                          SELECT `default_application_mode`.`mode_id`
-                          FROM `default_application_mode`
-                          WHERE    `default_application_mode`.`priority_id` = :priority_id AND
-                                `default_application_mode`.`application_id` = `application`.`id`
-                      ), IFNULL(
-                        -- 3. lookup default user setting
-                            (
-                                SELECT `target_mode`.`mode_id`
-                                FROM `target_mode`
-                                WHERE `target_mode`.`target_id` = target.id AND
-                                        `target_mode`.`priority_id` = :priority_id
-                            ), (
-                        -- 4. lookup default iris setting
-                                SELECT `mode_id`
-                                FROM `priority`
-                                WHERE `id` = :priority_id
-                            )
-                        )
-                   )
-                )
-                -- Make sure this mode is allowed for this application. Eg important apps can't drop.
-                AND EXISTS (SELECT 1 FROM `application_mode`
-                            WHERE `application_mode`.`mode_id` = `mode`.`id`
-                            AND   `application_mode`.`application_id` = `application`.`id`)
-                -- And ensure this only works for users
-                AND `target_type`.`name` = 'user'
-        ''', message)
-
-    try:
-        [(destination, mode, mode_id)] = result
-    except ValueError:
-        raise
-    finally:
-        session.close()
+    contact = cache.target_contacts.by_priority(message['target'], message['application'], message['priority_id'])
+    if contact is None:
+        # not a user, or their mode isn't allowed for this application
+        return False
 
+    destination, mode, mode_id = contact
     if not destination and mode != 'drop':
         logger.error('Did not find destination for message %s and mode is not drop', message)
         return False
@@ -791,21 +1014,10 @@ def set_target_contact(message):
         if 'mode' in message or 'mode_id' in message:
             # for out of band notification, we already have the mode *OR*
             # mode_id set by API
-            connection = db.engine.raw_connection()
-            cursor = connection.cursor()
-            cursor.execute('''
-                SELECT `destination` FROM `target_contact`
-                JOIN `target` ON `target`.`id` = `target_contact`.`target_id`
-                JOIN `target_type` on `target_type`.`id` = `target`.`type_id`
-                WHERE `target`.`name` = %(target)s
-                AND `target_type`.`name` = 'user'
-                AND (`target_contact`.`mode_id` = %(mode_id)s OR `target_contact`.`mode_id` = (SELECT `id` FROM `mode` WHERE `name` = %(mode)s))
-                LIMIT 1
-                ''', {'target': message['target'], 'mode_id': message.get('mode_id'), 'mode': message.get('mode')})
-            message['destination'] = cursor.fetchone()[0]
-            cursor.close()
-            connection.close()
-            result = True
+            destination = cache.target_contacts.by_mode(message['target'], message.get('mode_id'), message.get('mode'))
+            result = destination is not None
+            if result:
+                message['destination'] = destination
         else:
             # message triggered by incident will only have priority
             result = set_target_contact_by_priority(message)
@@ -820,6 +1032,17 @@ def set_target_contact(message):
         return set_target_fallback_mode(message)
 
 
+def get_render_context_key(message):
+    # messages of the same incident share its context
+    incident_id = message.get('incident_id')
+    if incident_id:
+        return incident_id
+    try:
+        return ujson.dumps({key: value for key, value in message['context'].iteritems() if key != 'iris'}, sort_keys=True)
+    except (TypeError, OverflowError):
+        return None
+
+
 def render(message):
     if not message.get('template'):
         if message.get('message_id'):
@@ -851,13 +1074,24 @@ def render(message):
                 application_template = template[message['application']]
                 try:
                     # When we want to "render" a dropped message, treat it as if it's an email
-                    mode_template = application_template['email' if message['mode'] == 'drop' else message['mode']]
+                    mode = 'email' if message['mode'] == 'drop' else message['mode']
+                    mode_template = application_template[mode]
+                    context = message['context']
+                    context_key = get_render_context_key(message)
+                    render_key = None if context_key is None else (template['id'], message['application'], mode, context_key)
                     try:
-                        message['subject'] = mode_template['subject'].render(**message['context'])
+                        message['subject'] = cache.rendered_templates.render(
+                            mode_template['subject'], mode_template['subject_fields'],
+                            render_key and render_key + ('subject',), context)
+                        if mode_template['prefix_message_id']:
+                            message_id = context.get('iris', {}).get('message_id', '')
+                            message['subject'] = '%s %s' % (message_id, message['subject']) if message['subject'] else '%s' % message_id
                     except Exception as e:
                         error = 'template %(template)s - %(application)s - %(mode)s - subject failed to render: ' + str(e)
                     try:
-                        message['body'] += mode_template['body'].render(**message['context'])
+                        message['body'] += cache.rendered_templates.render(
+                            mode_template['body'], mode_template['body_fields'],
+                            render_key and render_key + ('body',), context)
                     except Exception as e:
                         error = 'template %(template)s - %(application)s - %(mode)s - body failed to render: ' + str(e)
                     message['template_id'] = template['id']
@@ -893,51 +1127,17 @@ def render(message):
 
 
 def mark_message_as_sent(message):
-    connection = db.engine.raw_connection()
-
-    params = [
-        message['destination'],
-        message['mode_id'],
-        message.get('template_id'),
-    ]
-
     if 'aggregated_ids' in message:
-        sql = SENT_MESSAGE_BATCH_SQL % connection.escape(message['aggregated_ids'])
-        params.append(message['batch_id'])
         message_ids = message['aggregated_ids']
+        batch_id = message['batch_id']
     else:
-        sql = SENT_MESSAGE_SQL
-        params.append(message['message_id'])
         message_ids = [message['message_id']]
+        batch_id = None
 
-    cursor = connection.cursor()
     if not message['subject']:
         message['subject'] = ''
         logger.warn('Message id %s has blank subject', message.get('message_id', '?'))
 
-    max_retries = 3
-
-    # this deadlocks sometimes. try until it doesn't.
-    for i in xrange(1, max_retries + 1):
-        try:
-            cursor.execute(sql, params)
-            connection.commit()
-            break
-        except DataError:
-            logger.exception('Failed updating message metadata status (message ID %s) (application %s)', message.get('message_id', '?'), message.get('application', '?'))
-            break
-        except Exception:
-            if i == max_retries:
-                logger.exception('Failed running sent message update query. (Try %s/%s)', i, max_retries)
-            else:
-                logger.warn('Failed running sent message update query. (Try %s/%s)', i, max_retries)
-            sleep(.2)
-
-    # Clean messages cache
-    for message_id in message_ids:
-        messages.pop(message_id, None)
-
-    # Update subject and body separately, as they may fail and we don't necessarily care if they do
     if len(message['subject']) > 255:
         message['subject'] = message['subject'][:255]
 
@@ -946,31 +1146,13 @@ def mark_message_as_sent(message):
                     message.get('message_id', '?'), len(message['body']))
         message['body'] = message['body'][:MAX_MESSAGE_BODY_LENGTH]
 
-    if 'aggregated_ids' in message:
-        update_ids = tuple(message['aggregated_ids'])
-    else:
-        update_ids = tuple([message['message_id']])
-
-    max_retries = 3
-
-    # this deadlocks sometimes. try until it doesn't.
-    for i in xrange(1, max_retries + 1):
-        try:
-            cursor.execute(UPDATE_MESSAGE_BODY_SQL, (message['body'], message['subject'], update_ids))
-            connection.commit()
-            break
-        except DataError:
-            logger.exception('Failed updating message body+subject (message IDs %s) (application %s)', update_ids, message.get('application', '?'))
-            break
-        except Exception:
-            if i == max_retries:
-                logger.exception('Failed updating message body+subject (message IDs %s) (application %s) (Try %s/%s)', update_ids, message.get('application', '?'), i, max_retries)
-            else:
-                logger.warn('Failed updating message body+subject (message IDs %s) (application %s) (Try %s/%s)', update_ids, message.get('application', '?'), i, max_retries)
-            sleep(.2)
+    message_writeback.mark_sent(message_ids, message['destination'], message['mode_id'], message.get('template_id'),
+                                batch_id, message['subject'], message['body'])
 
-    cursor.close()
-    connection.close()
+    # Clean messages cache. The writeback keeps them from being queued again until they're
+    # marked inactive in the DB.
+    for message_id in message_ids:
+        messages.pop(message_id, None)
 
 
 def update_message_sent_status(message, status):
@@ -988,17 +1170,7 @@ def update_message_sent_status(message, status):
     if mode in ('sms', 'call'):
         return
 
-    session = db.Session()
-    try:
-        session.execute('''INSERT INTO `generic_message_sent_status` (`message_id`, `status`)
-                           VALUES (:message_id, :status)
-                           ON DUPLICATE KEY UPDATE `status` =  :status''',
-                        {'message_id': message_id, 'status': status})
-        session.commit()
-    except (DataError, IntegrityError, InternalError):
-        logger.exception('Failed setting message sent status for message %s', message)
-    finally:
-        session.close()
+    message_writeback.set_sent_status(message_id, status)
 
 
 def mark_message_has_no_contact(message):
@@ -1019,20 +1191,26 @@ def mark_message_has_no_contact(message):
         'Ignore message as we failed to resolve target contact')
 
 
-def distributed_send_message(message, vendor_manager):
+def pick_slaves(message):
     # If I am the master and this message isn't for a slave, attempt
-    # sending my messages through my slaves.
-    if not message.get('to_slave') and coordinator.am_i_master():
-        try:
-            if coordinator.slave_count and coordinator.slaves:
-                for i, address in enumerate(coordinator.slaves):
-                    if i >= coordinator.slave_count:
-                        logger.error('Failed using all configured slaves; resorting to local send_message')
-                        break
-                    if rpc.send_message_to_slave(message, address):
-                        return True, False
-        except StopIteration:
-            logger.warning('No more slaves. Sending locally.')
+    # sending my messages through my slaves, least loaded first.
+    if message.get('to_slave') or not coordinator.am_i_master():
+        return []
+    return coordinator.pick_slaves(message.get('mode'))
+
+
+def distributed_send_message(message, vendor_manager, slaves):
+    for address in slaves:
+        # Worker processes don't have a coordinator to keep track of what's in flight
+        if coordinator is None:
+            passed = rpc.send_message_to_slave(message, address)
+        else:
+            with coordinator.sending_to_slave(address):
+                passed = rpc.send_message_to_slave(message, address)
+        if passed:
+            return True, False
+    if slaves:
+        logger.error('Failed using all slaves; resorting to local send_message')
 
     logger.info('Sending message (ID %s) locally', message.get('message_id', '?'))
 
@@ -1057,59 +1235,23 @@ def fetch_and_send_message(send_queue, vendor_manager):
     except queue.Empty:
         return
 
-    metrics.incr('send_queue_gets_cnt')
-
-    retry_count = message.get('retry_count')
-    is_retry = retry_count is not None
-    if is_retry and retry_count >= MAX_MESSAGE_RETRIES:
-        logger.warning('Maximum retry count for app: %s target:%s breached', message.get('application', '?'), message.get('target', '?'))
-        return
-
-    if not is_retry:
-        sanitize_unicode_dict(message)
+    # Done with this message once we return, one way or the other. Retries get journaled
+    # again when they're queued back up.
+    journal_id = message.pop('journal_id', None)
+    try:
+        send_queued_message(message, vendor_manager)
+    finally:
+        if journal and journal_id is not None:
+            journal.ack(journal_id)
 
-    if 'message_id' not in message:
-        message['message_id'] = None
 
+def deliver_message(message, vendor_manager, slaves):
+    # Render and send a message that's cleared for sending. Returns (success, sent_locally),
+    # or None if it got dropped instead and needs marking as such.
+    is_retry = message.get('retry_count') is not None
     message_to_slave = message.get('to_slave', False)
-
     drop_mode_id = api_cache.modes.get('drop')
 
-    # If this app breaches hard quota, drop message on floor, and update in UI if it has an ID
-    if not is_retry and not message_to_slave and not quota.allow_send(message):
-        logger.warn('Hard message quota exceeded; Dropping this message on floor: %s', message)
-        if message['message_id']:
-            spawn(auditlog.message_change,
-                  message['message_id'], auditlog.MODE_CHANGE, message.get('mode', '?'), 'drop',
-                  'Dropping due to hard quota violation.')
-
-            # If we know the ID for the mode drop, reflect that for the message
-            if drop_mode_id:
-                message['mode'] = 'drop'
-                message['mode_id'] = drop_mode_id
-            else:
-                logger.error('Can\'t mark message %s as dropped as we don\'t know the mode ID for %s',
-                             message, 'drop')
-
-            # Render, so we're able to populate the message table with the
-            # proper subject/etc as well as information that it was dropped.
-            render(message)
-            mark_message_as_sent(message)
-        return
-
-    # If we're set to drop this message, no-op this before message gets sent to a vendor
-    if message.get('mode') == 'drop':
-        if message['message_id']:
-            render(message)
-            mark_message_as_sent(message)
-        add_mode_stat('drop', 0)
-
-        metrics_key = 'app_%(application)s_mode_drop_cnt' % message
-        metrics.add_new_metrics({metrics_key: 0})
-        metrics.incr(metrics_key)
-
-        return
-
     # Only render this message and validate its body/etc if it's not a retry, in which case this
     # step would have been done before
     if not is_retry and not message_to_slave:
@@ -1124,10 +1266,10 @@ def fetch_and_send_message(send_queue, vendor_manager):
         if body_length > MAX_MESSAGE_BODY_LENGTH:
             logger.warn('Message id %s has a ridiculously long body (%s chars). Dropping it.',
                         message['message_id'], body_length)
-            spawn(auditlog.message_change,
-                  message['message_id'], auditlog.MODE_CHANGE, message.get('mode', '?'), 'drop',
-                  'Dropping due to excessive body length (%s > %s chars)' % (
-                      body_length, MAX_MESSAGE_BODY_LENGTH))
+            auditlog.message_change(
+                message['message_id'], auditlog.MODE_CHANGE, message.get('mode', '?'), 'drop',
+                'Dropping due to excessive body length (%s > %s chars)' % (
+                    body_length, MAX_MESSAGE_BODY_LENGTH))
 
             metrics.incr('msg_drop_length_cnt')
 
@@ -1139,13 +1281,12 @@ def fetch_and_send_message(send_queue, vendor_manager):
                 message['mode'] = 'drop'
                 message['mode_id'] = drop_mode_id
 
-            mark_message_as_sent(message)
-            return
+            return None
 
     success = False
     sent_locally = False
     try:
-        success, sent_locally = distributed_send_message(message, vendor_manager)
+        success, sent_locally = distributed_send_message(message, vendor_manager, slaves)
     except Exception:
         logger.exception('Failed to send message: %s', message)
         add_mode_stat(message['mode'], None)
@@ -1159,7 +1300,7 @@ def fetch_and_send_message(send_queue, vendor_manager):
             set_target_fallback_mode(message)
             render(message)
             try:
-                success, sent_locally = distributed_send_message(message, vendor_manager)
+                success, sent_locally = distributed_send_message(message, vendor_manager, slaves)
             # nope - log and bail
             except Exception:
                 metrics.incr('task_failure')
@@ -1167,6 +1308,84 @@ def fetch_and_send_message(send_queue, vendor_manager):
                 logger.error('unable to send %(mode)s %(message_id)s %(application)s %(destination)s %(subject)s %(body)s', message)
                 sent_locally = True
 
+    return success, sent_locally
+
+
+def send_queued_message(message, vendor_manager):
+    metrics.incr('send_queue_gets_cnt')
+
+    retry_count = message.get('retry_count')
+    is_retry = retry_count is not None
+    if is_retry and retry_count >= MAX_MESSAGE_RETRIES:
+        logger.warning('Maximum retry count for app: %s target:%s breached', message.get('application', '?'), message.get('target', '?'))
+        return
+
+    if not is_retry:
+        sanitize_unicode_dict(message)
+
+    if 'message_id' not in message:
+        message['message_id'] = None
+
+    message_to_slave = message.get('to_slave', False)
+
+    drop_mode_id = api_cache.modes.get('drop')
+
+    # If this app breaches hard quota, drop message on floor, and update in UI if it has an ID
+    if not is_retry and not message_to_slave and not quota.allow_send(message):
+        logger.warn('Hard message quota exceeded; Dropping this message on floor: %s', message)
+        if message['message_id']:
+            auditlog.message_change(
+                message['message_id'], auditlog.MODE_CHANGE, message.get('mode', '?'), 'drop',
+                'Dropping due to hard quota violation.')
+
+            # If we know the ID for the mode drop, reflect that for the message
+            if drop_mode_id:
+                message['mode'] = 'drop'
+                message['mode_id'] = drop_mode_id
+            else:
+                logger.error('Can\'t mark message %s as dropped as we don\'t know the mode ID for %s',
+                             message, 'drop')
+
+            # Render, so we're able to populate the message table with the
+            # proper subject/etc as well as information that it was dropped.
+            render(message)
+            mark_message_as_sent(message)
+        return
+
+    # If we're set to drop this message, no-op this before message gets sent to a vendor
+    if message.get('mode') == 'drop':
+        if message['message_id']:
+            render(message)
+            mark_message_as_sent(message)
+        add_mode_stat('drop', 0)
+
+        metrics_key = 'app_%(application)s_mode_drop_cnt' % message
+        metrics.add_new_metrics({metrics_key: 0})
+        metrics.incr(metrics_key)
+
+        return
+
+    if isinstance(vendor_manager, WorkerProcess):
+        # Rendering and talking to vendors happen in a child process, which sends back the
+        # message as it ended up
+        try:
+            result, sent_message = vendor_manager.deliver(message, pick_slaves(message))
+            message.clear()
+            message.update(sent_message)
+        except WorkerProcessError as e:
+            logger.error('Failed sending message (ID %s) through %s worker process: %s',
+                         message['message_id'], vendor_manager.mode, e)
+            result = (False, False)
+    else:
+        result = deliver_message(message, vendor_manager, pick_slaves(message))
+
+    # Dropped rather than sent
+    if result is None:
+        mark_message_as_sent(message)
+        return
+
+    success, sent_locally = result
+
     # Take it out of our list of active queued messages if it's there
     if message['message_id']:
         message_ids_being_sent.discard(message['message_id'])
@@ -1203,6 +1422,119 @@ def worker(send_queue, worker_config, kill_set):
             return
 
 
+def process_worker(send_queue, worker_process, kill_set):
+    # Like worker(), with the sending itself done by a child process
+    while True:
+        fetch_and_send_message(send_queue, worker_process)
+
+        if kill_set.is_set():
+            return
+
+
+def spawn_worker(mode, config, worker_number, kill_set):
+    processes = worker_processes.get(mode)
+    if processes:
+        return spawn(process_worker, per_mode_send_queues[mode], processes[worker_number % len(processes)], kill_set)
+    return spawn(worker, per_mode_send_queues[mode], config, kill_set)
+
+
+def merge_worker_process_stats(mode, changes, latencies):
+    metrics.merge_changes(changes)
+    mode_latencies.update(latencies)
+
+
+def maintain_worker_processes(config, workers_per_mode):
+    process_counts = config.get('sender', {}).get('worker_processes_per_mode', {})
+    for mode, worker_count in workers_per_mode.iteritems():
+        process_count = int(process_counts.get(mode, 0))
+        if process_count < 1:
+            continue
+
+        processes = worker_processes[mode]
+        if not processes:
+            # Each child runs as many send workers as we have feeding it
+            concurrency = max(1, -(-worker_count // process_count))
+            processes.extend(WorkerProcess(mode, config, concurrency, merge_worker_process_stats)
+                             for _ in xrange(process_count))
+
+        for process in processes:
+            if not process.alive():
+                if process.process is not None:
+                    logger.error('%s worker process %s died. Respawning', mode, process.process.pid)
+                    metrics.incr('workers_respawn_cnt')
+                process.start()
+
+
+def size_vendor_pools(config, workers_per_mode):
+    # Keep alive as many connections to each vendor as there are workers that may send through it at once
+    for vendor_config in config['vendors']:
+        try:
+            vendor_cls = import_custom_module('iris.vendors', vendor_config['type'])
+        except ImportError:
+            continue
+        pool_size = sum(workers_per_mode.get(mode, 0) for mode in vendor_cls.supports)
+        if not pool_size:
+            continue
+        vendor_config.setdefault('http_pool_size', pool_size)
+        if vendor_config['type'] == 'iris_smtp':
+            # SMTP connections are pooled per MX server rather than per session
+            vendor_config.setdefault('pool_size', pool_size)
+        push_config = vendor_config.get('push_notification')
+        if isinstance(push_config, dict):
+            push_config.setdefault('http_pool_size', pool_size)
+
+
+def configure_worker_autoscalers(config, workers_per_mode):
+    global autoscale_worker_config
+    autoscale_worker_config = config
+    sender_config = config.get('sender', {})
+    process_counts = sender_config.get('worker_processes_per_mode', {})
+    target_wait = sender_config.get('autoscale_target_wait', 10)
+
+    for mode, limits in sender_config.get('autoscale_workers', {}).iteritems():
+        # Autoscaled email and modes sending from child processes keep their own worker counts
+        if mode not in workers_per_mode or int(process_counts.get(mode, 0)) > 0:
+            continue
+        autoscaler = worker_autoscalers.get(mode)
+        if autoscaler is None:
+            autoscaler = worker_autoscalers[mode] = WorkerAutoscaler(int(limits.get('min', 1)),
+                                                                     int(limits.get('max', workers_per_mode[mode])),
+                                                                     target_wait)
+            metrics.add_new_metrics({'autoscale_%s_%s' % (mode, stat): 0 for stat in ('workers', 'up_cnt', 'down_cnt')})
+        # Start out with the configured count, and leave it to the autoscaler from then on
+        workers_per_mode[mode] = len(worker_tasks[mode]) or autoscaler.clamp(workers_per_mode[mode])
+
+
+def scale_workers(mode, worker_count):
+    tasks = worker_tasks[mode]
+    current = len(tasks)
+    if worker_count > current:
+        logger.info('Auto scaling %s workers UP from %d to %d', mode, current, worker_count)
+        metrics.incr('autoscale_%s_up_cnt' % mode, worker_count - current)
+        for x in xrange(current, worker_count):
+            kill_set = gevent.event.Event()
+            tasks.append({'greenlet': spawn_worker(mode, autoscale_worker_config, x, kill_set), 'kill_set': kill_set})
+    elif worker_count < current:
+        logger.info('Auto scaling %s workers DOWN from %d to %d', mode, current, worker_count)
+        metrics.incr('autoscale_%s_down_cnt' % mode, current - worker_count)
+        # They finish sending the message they're on before going away
+        for _ in xrange(current - worker_count):
+            tasks.pop()['kill_set'].set()
+
+
+def autoscale_workers(interval):
+    while not shutdown_started:
+        sleep(interval)
+        for mode, autoscaler in worker_autoscalers.items():
+            send_queue = per_mode_send_queues.get(mode)
+            if send_queue is None or shutdown_started:
+                continue
+            worker_count = autoscaler.desired(len(worker_tasks[mode]), send_queue.qsize(), send_queue.oldest_wait(),
+                                              mode_latencies.get(mode))
+            metrics.set('autoscale_%s_workers' % mode, worker_count)
+            scale_workers(mode, worker_count)
+
+
 def maintain_workers(config):
     # We mangle this config dict a bit and pass it around. Avoid latering the main one
     config = copy.deepcopy(config)
@@ -1260,22 +1592,31 @@ def maintain_workers(config):
 
     logger.info('Workers per mode: %s', ', '.join('%s: %s' % count for count in workers_per_mode.iteritems()))
 
+    configure_worker_autoscalers(config, workers_per_mode)
+
+    # Sized for as many workers as autoscaled modes may get
+    size_vendor_pools(config, dict(workers_per_mode, **{mode: autoscaler.max_workers
+                                                             for mode, autoscaler in worker_autoscalers.iteritems()}))
+
+    # Modes set to run their workers in child processes, apart from autoscaled email
+    maintain_worker_processes(config, workers_per_mode)
+
     # Make sure all the counts and distributions for "normal" workers are proper, including email if we're not doing MX record
     # autoscaling
 
     for mode, worker_count in workers_per_mode.iteritems():
         mode_tasks = worker_tasks[mode]
         if mode_tasks:
-            for task in mode_tasks:
+            for x, task in enumerate(mode_tasks):
                 if not bool(task['greenlet']):
                     logger.error("worker task for mode %s failed, %s. Respawning", mode, task['greenlet'].exception)
                     kill_set = gevent.event.Event()
-                    task.update({'greenlet': spawn(worker, per_mode_send_queues[mode], config, kill_set), 'kill_set': kill_set})
+                    task.update({'greenlet': spawn_worker(mode, config, x, kill_set), 'kill_set': kill_set})
                     metrics.incr('workers_respawn_cnt')
         else:
             for x in xrange(worker_count):
                 kill_set = gevent.event.Event()
-                mode_tasks.append({'greenlet': spawn(worker, per_mode_send_queues[mode], config, kill_set), 'kill_set': kill_set})
+                mode_tasks.append({'greenlet': spawn_worker(mode, config, x, kill_set), 'kill_set': kill_set})
 
     # Maintain, grow, and shrink email workers
     if email_autoscale and email_smtp_workers:
@@ -1302,6 +1643,7 @@ def maintain_workers(config):
                 email_vendor_config = copy.deepcopy(email_vendor)
                 email_vendor_config['smtp_server'] = mx
                 email_vendor_config.pop('smtp_gateway', None)
+                email_vendor_config.setdefault('pool_size', correct_worker_count)
                 worker_config = copy.deepcopy(config)
                 worker_config['vendors'] = [email_vendor_config]
 
@@ -1333,6 +1675,7 @@ def maintain_workers(config):
             email_vendor_config = copy.deepcopy(email_vendor)
             email_vendor_config['smtp_server'] = mx
             email_vendor_config.pop('smtp_gateway', None)
+            email_vendor_config.setdefault('pool_size', len(mx_tasks))
             worker_config = copy.deepcopy(config)
             worker_config['vendors'] = [email_vendor_config]
 
@@ -1437,6 +1780,16 @@ def sender_shutdown():
         for task in tasks:
             task['greenlet'].join()
 
+    for processes in worker_processes.itervalues():
+        for process in processes:
+            process.stop()
+
+    logger.info('Writing pending message updates')
+    message_writeback.flush()
+    auditlog.flush()
+    if journal:
+        journal.sync()
+
     # Force quit. Avoid sender process existing longer than it needs to
     os._exit(0)
 
@@ -1464,6 +1817,8 @@ def message_send_enqueue(message):
     if message_mode and message_mode in per_mode_send_queues:
         if message_id is not None:
             message_ids_being_sent.add(message_id)
+        if journal:
+            message['journal_id'] = journal.append(message)
         per_mode_send_queues[message_mode].put(message)
         metrics.incr('send_queue_puts_cnt')
     else:
@@ -1471,6 +1826,31 @@ def message_send_enqueue(message):
         metrics.incr('send_queue_puts_fail_cnt')
 
 
+def replay_journal():
+    messages = journal.replay()
+    # Ones that made it out before the crash, but whose ack didn't make it to disk
+    message_ids = [m['message_id'] for m in messages if m.get('message_id')]
+    active_message_ids = get_active_message_ids(message_ids) if message_ids else set()
+    for message in messages:
+        if message.get('message_id') and message['message_id'] not in active_message_ids:
+            continue
+        message_send_enqueue(message)
+    journal.finish_replay()
+
+
+def get_sender_load():
+    '''
+    What we publish to the cluster so the master can hand messages to the least busy slave
+    '''
+    modes = {}
+    for mode, send_queue in per_mode_send_queues.iteritems():
+        workers = len(worker_tasks.get(mode, ()))
+        if mode == 'email':
+            workers += sum(len(tasks) for tasks in autoscale_email_worker_tasks.itervalues())
+        modes[mode] = {'depth': send_queue.qsize(), 'workers': workers, 'latency': mode_latencies.get(mode)}
+    return {'modes': modes, 'quota': quota.usage()}
+
+
 def init_sender(config):
     gevent.signal(signal.SIGINT, sender_shutdown)
     gevent.signal(signal.SIGTERM, sender_shutdown)
@@ -1486,6 +1866,7 @@ def init_sender(config):
     db.init(config)
     cache.init(api_host, config)
     metrics.init(config, 'iris-sender', default_sender_metrics)
+    auditlog.init(config['sender'])
     api_cache.cache_priorities()
     api_cache.cache_applications()
     api_cache.cache_modes()
@@ -1509,6 +1890,24 @@ def init_sender(config):
     global quota
     quota = ApplicationQuota(db, cache.targets_for_role, message_send_enqueue, config['sender'].get('sender_app'))
 
+    global escalation_scheduler
+    escalation_scheduler = EscalationScheduler(db, repeat_notifications, escalate_incidents, deactivate_incidents,
+                                               lambda incident_id: coordinator.owns_incident(incident_id))
+
+    global message_writeback
+    message_writeback = MessageWriteback(db,
+                                         config['sender'].get('message_update_flush_interval', 500),
+                                         config['sender'].get('message_update_batch_size', 500),
+                                         config['sender'].get('message_update_max_pending', 10000))
+
+    global journal
+    journal_dir = config['sender'].get('journal_dir')
+    if journal_dir:
+        logger.info('Journaling queued messages to %s', journal_dir)
+        journal = MessageJournal(journal_dir,
+                                 config['sender'].get('journal_sync_interval', 100),
+                                 config['sender'].get('journal_segment_size', 64 * 1024 * 1024))
+
     global coordinator
     zk_hosts = config['sender'].get('zookeeper_cluster', False)
 
@@ -1518,7 +1917,11 @@ def init_sender(config):
         coordinator = Coordinator(zk_hosts=zk_hosts,
                                   hostname=socket.gethostname(),
                                   port=config['sender'].get('port', 2321),
-                                  join_cluster=True)
+                                  join_cluster=True,
+                                  get_load=get_sender_load,
+                                  sharded=config['sender'].get('shard_incidents', False),
+                                  on_shards_changed=reassign_shards,
+                                  on_peer_loads=quota.set_peer_usage)
     else:
         logger.info('ZK cluster info not specified. Using master status from config')
         from iris.coordinator.noncluster import Coordinator
@@ -1526,6 +1929,72 @@ def init_sender(config):
                                   slaves=config['sender'].get('slaves', []))
 
 
+def init_worker_process(worker_config):
+    global config
+    config = worker_config
+    db.init(config)
+    cache.init(config['sender'].get('api_host', 'http://localhost:16649'), config)
+    metrics.add_new_metrics(default_sender_metrics)
+    auditlog.init(config['sender'])
+    api_cache.cache_priorities()
+    api_cache.cache_applications()
+    api_cache.cache_modes()
+    init_plugins(config.get('plugins', {}))
+
+
+def worker_process_task(requests, channel, vendor_manager):
+    while True:
+        request_id, message, slaves = requests.get()
+        try:
+            result = deliver_message(message, vendor_manager, slaves)
+        except Exception:
+            logger.exception('Failed sending message (ID %s)', message.get('message_id'))
+            metrics.incr('task_failure')
+            result = (False, False)
+        channel.send('result', request_id, result, message)
+
+
+def worker_process_housekeeping(channel):
+    last_refresh = time.time()
+    while True:
+        sleep(WORKER_PROCESS_STATS_INTERVAL)
+        channel.send('stats', metrics.take_changes(), mode_latencies)
+        if time.time() - last_refresh > 60:
+            last_refresh = time.time()
+            cache.refresh()
+            cache.purge()
+
+
+def worker_process_main():
+    # Sends messages of one mode for the sender that started us, which talks to us over our stdin
+    channel = Channel(socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM))
+    frames = iter(channel)
+    _, mode, worker_config, concurrency = next(frames)
+
+    # Leave shutting down to the parent, which hangs up once it's done with us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    process_title = worker_config['sender'].get('process_title')
+    if process_title and isinstance(process_title, basestring):
+        setproctitle.setproctitle('%s %s worker' % (process_title, mode))
+
+    init_worker_process(worker_config)
+
+    requests = queue.Queue()
+    for _ in xrange(concurrency):
+        vendor_manager = IrisVendorManager(worker_config.get('vendors', []), worker_config.get('applications', []))
+        spawn(worker_process_task, requests, channel, vendor_manager)
+    spawn(worker_process_housekeeping, channel)
+    logger.info('[*] %s worker process bootstrapped with %s workers', mode, concurrency)
+
+    for frame in frames:
+        if frame[0] == 'send':
+            requests.put(frame[1:])
+
+    logger.info('Sender went away; %s worker process exiting', mode)
+    auditlog.flush()
+    os._exit(0)
+
+
 def main():
     global config
     global shutdown_started
@@ -1540,17 +2009,30 @@ def main():
     if not rpc.run(config['sender']):
         sender_shutdown()
 
+    aging_interval = config['sender'].get('send_queue_aging_interval', 30)
+    application_weights = config['sender'].get('application_send_weights', {})
     for mode in api_cache.modes:
-        per_mode_send_queues[mode] = queue.Queue()
+        per_mode_send_queues[mode] = PrioritySendQueue(aging_interval, application_weights)
+        metrics.add_new_metrics({'send_queue_%s_%s_%s' % (mode, lane, stat): 0
+                                 for lane in LANES for stat in ('size', 'wait')})
 
     rpc.init(config['sender'], dict(
-        message_send_enqueue=message_send_enqueue
+        message_send_enqueue=message_send_enqueue,
+        escalate_new_incident=escalate_new_incident,
+        invalidate_contacts=invalidate_contacts,
+        drop_claimed_incidents=incidents_claimed
     ))
 
+    if journal:
+        replay_journal()
+
     spawn(coordinator.update_forever)
     send_task = spawn(send)
+    aggregation_task = spawn(aggregation_flusher)
 
     maintain_workers(config)
+    autoscale_interval = config['sender'].get('autoscale_interval', 10)
+    autoscale_task = spawn(autoscale_workers, autoscale_interval)
 
     disable_gwatch_renewer = config['sender'].get('disable_gwatch_renewer', False)
     gwatch_renewer_task = None
@@ -1575,7 +2057,6 @@ def main():
         cache.purge()
 
         # If we're currently a master, ensure our master-greenlets are running
-        # and we're doing the master duties
         if coordinator.am_i_master():
             if not disable_gwatch_renewer and not bool(gwatch_renewer_task):
                 if should_mock_gwatch_renewer:
@@ -1586,20 +2067,8 @@ def main():
             if not bool(prune_audit_logs_task):
                 prune_audit_logs_task = spawn(prune_old_audit_logs_worker)
 
-            try:
-                escalate()
-                deactivate()
-                poll()
-                aggregate(runtime)
-            except Exception:
-                metrics.incr('task_failure')
-                logger.exception("Exception occured in main loop.")
-
-        # If we're not master, don't do the master tasks and make sure those other
-        # greenlets are stopped if they're running
+        # If we're not master, make sure those other greenlets are stopped if they're running
         else:
-            logger.info('I am not the master so I am not doing master sender tasks.')
-
             # Stop these task greenlets if they're running. Technically this should
             # never happen because if we're the master, we'll likely only stop being the
             # master if our process exits, which would kill these greenlets anyway.
@@ -1611,16 +2080,61 @@ def main():
                 logger.info('I am not master anymore so stopping the audit logs worker')
                 prune_audit_logs_task.kill()
 
+        # Escalate, poll and aggregate for all incidents if we're the master, or for our
+        # shard of them if senders split those between them
+        if coordinator.am_i_master() or coordinator.has_shard():
+            try:
+                # Pick up where the previous master or shard owner left off
+                if not escalation_scheduler.loaded:
+                    escalation_scheduler.rebuild()
+                escalate()
+                escalation_scheduler.purge()
+                poll()
+            except Exception:
+                metrics.incr('task_failure')
+                logger.exception("Exception occured in main loop.")
+
+        else:
+            logger.info('I am not the master so I am not doing master sender tasks.')
+
+            if escalation_scheduler.loaded:
+                logger.info('I am not master anymore so dropping escalation state')
+                escalation_scheduler.reset()
+
         # check status for all background greenlets and respawn if necessary
         if not bool(send_task):
             logger.error("send task failed, %s", send_task.exception)
             metrics.incr('task_failure')
             send_task = spawn(send)
 
+        if not bool(aggregation_task):
+            logger.error("aggregation task failed, %s", aggregation_task.exception)
+            metrics.incr('task_failure')
+            aggregation_task = spawn(aggregation_flusher)
+
+        if not bool(autoscale_task):
+            logger.error("autoscale task failed, %s", autoscale_task.exception)
+            metrics.incr('task_failure')
+            autoscale_task = spawn(autoscale_workers, autoscale_interval)
+
+        application_queue_stats = {}
         for mode, send_queue in per_mode_send_queues.iteritems():
 
-            # Set metric for size of worker queue
-            metrics.set('send_queue_%s_size' % mode, len(send_queue))
+            # Set metrics for size and wait time of each priority lane of worker queue
+            for lane, (size, wait) in send_queue.stats().iteritems():
+                metrics.set('send_queue_%s_%s_size' % (mode, lane), size)
+                metrics.set('send_queue_%s_%s_wait' % (mode, lane), wait)
+
+            for application, (size, wait) in send_queue.application_stats().iteritems():
+                total_size, max_wait = application_queue_stats.get(application, (0, 0))
+                application_queue_stats[application] = (total_size + size, max(max_wait, wait))
+
+        # Per application, across modes, to see who's being held up and who is flooding the queues
+        metrics.add_new_metrics({'app_%s_send_queue_%s' % (application, stat): 0
+                                 for application in application_queue_stats for stat in ('size', 'wait')})
+        for application, (size, wait) in application_queue_stats.iteritems():
+            metrics.set('app_%s_send_queue_size' % application, size)
+            metrics.set('app_%s_send_queue_wait' % application, wait)
 
         maintain_workers(config)
 
@@ -1639,4 +2153,7 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['--worker-process']:
+        worker_process_main()
+    else:
+        main()
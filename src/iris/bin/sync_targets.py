@@ -16,6 +16,7 @@ from phonenumbers.phonenumberutil import NumberParseException
 
 from iris.api import load_config
 from iris import metrics
+from iris.sender import client as sender_client
 
 # Used for the optional ldap mailing list resolving functionality
 import ldap
@@ -212,6 +213,9 @@ def sync_from_oncall(config, engine, purge_old_users=True):
                                 VALUES (%s, %s, %s)
                                 ON DUPLICATE KEY UPDATE `destination` = %s'''
 
+    # users whose contacts senders need to reload
+    changed_users = set()
+
     # insert users that need to be
     logger.info('Users to insert (%d)' % len(users_to_insert))
     for username in users_to_insert:
@@ -225,6 +229,7 @@ def sync_from_oncall(config, engine, purge_old_users=True):
             logger.exception('Failed to add user %s' % username)
             continue
         metrics.incr('users_added')
+        changed_users.add(username)
         for key, value in oncall_users[username].iteritems():
             if value and key in modes:
                 logger.info('%s: %s -> %s' % (username, key, value))
@@ -247,14 +252,17 @@ def sync_from_oncall(config, engine, purge_old_users=True):
                             logger.info('%s: updating %s' % (username, mode))
                             metrics.incr('user_contacts_updated')
                             engine.execute(contact_update_sql, (oncall_contacts[mode], username, modes[mode]))
+                            changed_users.add(username)
                     else:
                         logger.info('%s: adding %s' % (username, mode))
                         metrics.incr('user_contacts_updated')
                         engine.execute(contact_insert_sql, (username, modes[mode], oncall_contacts[mode]))
+                        changed_users.add(username)
                 elif mode in db_contacts:
                     logger.info('%s: deleting %s' % (username, mode))
                     metrics.incr('user_contacts_updated')
                     engine.execute(contact_delete_sql, (username, modes[mode]))
+                    changed_users.add(username)
                 else:
                     logger.debug('%s: missing %s' % (username, mode))
         except SQLAlchemyError as e:
@@ -287,6 +295,9 @@ def sync_from_oncall(config, engine, purge_old_users=True):
             prune_target(engine, username, 'user')
         for team in teams_to_deactivate:
             prune_target(engine, team, 'team')
+        changed_users |= users_to_mark_inactive
+
+    sender_client.notify_contacts_changed(users=changed_users)
 
 
 def get_ldap_lists(l, search_strings, parent_list=None):
@@ -556,6 +567,11 @@ def main():
     engine = create_engine(config['db']['conn']['str'] % config['db']['conn']['kwargs'],
                            **config['db']['kwargs'])
 
+    # Used to have senders reload the contacts of users we change
+    default_master_sender = config['sender'].get('master_sender', config['sender'])
+    sender_client.init(config['sender'].get('zookeeper_cluster', False),
+                       (default_master_sender['host'], default_master_sender['port']))
+
     # Optionally, maintain an internal list of mailing lists from ldap that can also be
     # used as targets.
     ldap_lists = config.get('ldap_lists')
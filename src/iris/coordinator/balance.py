@@ -0,0 +1,67 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+from contextlib import contextmanager
+import random
+
+# Assumed send time for a mode a slave hasn't reported a latency for yet
+DEFAULT_LATENCY = 1.0
+
+
+class SlaveBalancer(object):
+    '''
+    Picks the slave a message goes to by power of two choices: of two slaves picked at random,
+    the one with less outstanding work for the message's mode wins. Outstanding work is what the
+    slave last reported as queued for that mode plus what we've handed it since and that it
+    hasn't answered yet, times its recent send latency, spread over its workers. Slaves that
+    haven't reported any load (like statically configured ones) count their weight as workers.
+    '''
+
+    def __init__(self):
+        self.slaves = []
+        self.loads = {}  # address: load record published by that slave
+        self.weights = {}  # address: workers to assume when it hasn't published any
+        self.inflight = defaultdict(int)  # address: messages handed over and not answered yet
+
+    def __len__(self):
+        return len(self.slaves)
+
+    def update(self, slaves, loads=None, weights=None):
+        self.slaves = list(slaves)
+        self.loads = loads or {}
+        self.weights = weights or {}
+
+    def score(self, address, mode):
+        mode_load = self.loads.get(address, {}).get('modes', {}).get(mode, {})
+        workers = mode_load.get('workers') or self.weights.get(address, 1)
+        latency = mode_load.get('latency') or DEFAULT_LATENCY
+        depth = mode_load.get('depth', 0) + self.inflight.get(address, 0)
+        return (depth + 1) * latency / max(workers, 1)
+
+    def pick(self, mode):
+        '''
+        Return the slaves in the order to try them for a message of this mode: the winner of
+        two random choices first, then the others, least loaded first.
+        '''
+        slaves = list(self.slaves)
+        if len(slaves) < 2:
+            return slaves
+        first, second = random.sample(slaves, 2)
+        if self.score(second, mode) < self.score(first, mode):
+            first = second
+        slaves.remove(first)
+        slaves.sort(key=lambda address: self.score(address, mode))
+        return [first] + slaves
+
+    @contextmanager
+    def sending(self, address):
+        self.inflight[address] += 1
+        try:
+            yield
+        finally:
+            self.inflight[address] -= 1
+            if not self.inflight[address]:
+                del self.inflight[address]
@@ -8,9 +8,12 @@ from kazoo.handlers.gevent import SequentialGeventHandler
 from kazoo.recipe.party import Party
 import kazoo.exceptions
 import logging
+import ujson
 from iris import metrics
 from gevent import sleep
 from itertools import cycle
+from .balance import SlaveBalancer
+from .ring import HashRing
 
 logger = logging.getLogger(__name__)
 
@@ -18,13 +21,23 @@ UPDATE_FREQUENCY = 3
 
 
 class Coordinator(object):
-    def __init__(self, zk_hosts, hostname, port, join_cluster):
+    def __init__(self, zk_hosts, hostname, port, join_cluster, get_load=None,
+                 sharded=False, on_shards_changed=None, on_peer_loads=None):
         self.me = '%s:%s' % (hostname, port)
         self.is_master = None
         self.slaves = cycle([])
         self.slave_count = 0
+        self.balancer = SlaveBalancer()
+        self.get_load = get_load
         self.started_shutdown = False
 
+        # With sharding, incidents are split over every sender in the party rather than all
+        # being escalated by the master
+        self.sharded = sharded
+        self.ring = HashRing()
+        self.on_shards_changed = on_shards_changed
+        self.on_peer_loads = on_peer_loads
+
         if join_cluster:
             read_only = False
         else:
@@ -61,7 +74,70 @@ class Coordinator(object):
 
     # Used for API to get the current slaves if master can't be reached
     def get_current_slaves(self):
-        return [self.address_to_tuple(host) for host in self.party]
+        return [self.address_to_tuple(self.parse_member(data)[0]) for data in self.party]
+
+    # Party nodes hold the member's address, optionally followed by a line with its load record
+    def parse_member(self, data):
+        host, _, load = data.partition('\n')
+        if not load:
+            return host, {}
+        try:
+            return host, ujson.loads(load)
+        except ValueError:
+            logger.error('Failed parsing load record of %s', host)
+            return host, {}
+
+    def publish_load(self):
+        if not self.get_load:
+            return
+        try:
+            data = '%s\n%s' % (self.me, ujson.dumps(self.get_load()))
+        except Exception:
+            logger.exception('Failed getting our load')
+            return
+        # Rejoining the party after a ZK blip brings the latest record along
+        self.party.data = data.encode('utf-8')
+        if self.party.participating:
+            try:
+                self.zk.set(self.party.create_path, self.party.data)
+            except kazoo.exceptions.KazooException:
+                logger.exception('ZK problem while publishing our load')
+
+    def owns_incident(self, incident_id):
+        '''
+        Whether we're the one escalating, polling and aggregating for this incident. Without
+        sharding that's the master; with it, whoever the ring hands the incident to. Messages
+        without an incident stay with the master either way.
+        '''
+        if not self.sharded or incident_id is None:
+            return bool(self.is_master)
+        return self.ring.get(incident_id) == self.me
+
+    def has_shard(self):
+        return self.sharded and self.me in self.ring
+
+    def incident_owner(self, incident_id):
+        owner = self.ring.get(incident_id)
+        if owner is None:
+            return None
+        return self.address_to_tuple(owner)
+
+    def update_ring(self, members):
+        if self.ring.members == frozenset(members):
+            return
+        self.ring = HashRing(members)
+        logger.info('Incident shards now spread over %s senders', len(self.ring))
+        if self.on_shards_changed:
+            try:
+                self.on_shards_changed()
+            except Exception:
+                logger.exception('Failed reassigning incident shards')
+
+    def pick_slaves(self, mode):
+        return self.balancer.pick(mode)
+
+    def sending_to_slave(self, address):
+        return self.balancer.sending(address)
 
     def address_to_tuple(self, address):
         try:
@@ -98,14 +174,30 @@ class Coordinator(object):
             self.is_master = False
 
         if self.zk.state == KazooState.CONNECTED:
+            members = []
+            loads = {}
+            try:
+                for data in self.party:
+                    host, load = self.parse_member(data)
+                    members.append(host)
+                    if host != self.me:
+                        loads[self.address_to_tuple(host)] = load
+            except kazoo.exceptions.KazooException:
+                logger.exception('ZK problem while getting party members')
+                members = None
 
             if self.is_master:
-                slaves = [self.address_to_tuple(host) for host in self.party if host != self.me]
+                slaves = list(loads)
                 self.slave_count = len(slaves)
                 self.slaves = cycle(slaves)
+                self.balancer.update(slaves, loads)
             else:
                 self.slaves = cycle([])
                 self.slave_count = 0
+                self.balancer.update([])
+
+            if self.on_peer_loads:
+                self.on_peer_loads(loads)
 
             # Keep us as part of the party, so the current master sees us as a slave
             if not self.party.participating:
@@ -113,9 +205,19 @@ class Coordinator(object):
                     self.party.join()
                 except kazoo.exceptions.KazooException:
                     logger.exception('ZK problem while trying to join party')
+
+            # Only shard over the party once we're in it ourselves, so we don't take on
+            # incidents the others don't know we have
+            if self.sharded and members is not None:
+                self.update_ring(members if self.me in members else [])
         else:
             self.slaves = cycle([])
             self.slave_count = 0
+            self.balancer.update([])
+
+            # Somebody else takes over our incidents once our party node goes away
+            if self.sharded:
+                self.update_ring([])
 
     def update_forever(self):
         while True:
@@ -124,6 +226,8 @@ class Coordinator(object):
 
             old_status = self.is_master
             self.update_status()
+            if self.zk.state == KazooState.CONNECTED:
+                self.publish_load()
             new_status = self.is_master
 
             if old_status != new_status:
@@ -138,6 +242,8 @@ class Coordinator(object):
 
             metrics.set('slave_instance_count', self.slave_count)
             metrics.set('is_master_sender', int(self.is_master is True))
+            if self.sharded:
+                metrics.set('shard_member_count', len(self.ring))
 
             sleep(UPDATE_FREQUENCY)
 
@@ -155,8 +261,9 @@ class Coordinator(object):
                 logger.info('Releasing lock')
                 self.lock.release()
 
-        # Make us not the master
+        # Make us not the master, nor the owner of any incidents
         self.is_master = False
+        self.ring = HashRing()
 
         # Avoid sending metrics that we are still the master when we're not
         metrics.set('is_master_sender', 0)
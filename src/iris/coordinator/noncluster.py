@@ -4,6 +4,7 @@
 from __future__ import absolute_import
 
 from itertools import cycle
+from .balance import SlaveBalancer
 import logging
 logger = logging.getLogger(__name__)
 
@@ -16,9 +17,19 @@ class Coordinator():
         else:
             logger.info('I am a slave sender')
 
-        self.slaves = cycle((slave['host'], slave['port']) for slave in slaves)
+        addresses = [(slave['host'], slave['port']) for slave in slaves]
+        self.slaves = cycle(addresses)
         self.slave_count = len(slaves)
 
+        # Slaves don't publish their load here, so go by their configured weight
+        # and what we've got in flight with each
+        self.balancer = SlaveBalancer()
+        self.balancer.update(addresses, weights={(slave['host'], slave['port']): slave.get('weight', 1)
+                                                 for slave in slaves})
+
+        # Sharding incidents over senders needs ZK to know who's alive
+        self.sharded = False
+
     def update_forever(self):
         pass
 
@@ -27,3 +38,18 @@ class Coordinator():
 
     def am_i_master(self):
         return self.is_master
+
+    def owns_incident(self, incident_id):
+        return self.is_master
+
+    def has_shard(self):
+        return False
+
+    def incident_owner(self, incident_id):
+        return None
+
+    def pick_slaves(self, mode):
+        return self.balancer.pick(mode)
+
+    def sending_to_slave(self, address):
+        return self.balancer.sending(address)
@@ -0,0 +1,41 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from __future__ import absolute_import
+
+from bisect import bisect
+from hashlib import md5
+
+# Points each member gets on the ring, so shards come out roughly even
+DEFAULT_REPLICAS = 128
+
+
+def ring_hash(key):
+    return int(md5(str(key)).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    '''
+    Consistent hash ring over the live senders. Each member is hashed onto the ring at a number
+    of points, and a key belongs to the member owning the first point at or after the key's own
+    hash. When a member joins or leaves, only the keys next to its points change hands.
+    '''
+
+    def __init__(self, members=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self.members = frozenset(members)
+        points = sorted((ring_hash('%s-%s' % (member, i)), member)
+                        for member in self.members for i in xrange(replicas))
+        self.hashes = [h for h, _ in points]
+        self.owners = [member for _, member in points]
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def get(self, key):
+        if not self.hashes:
+            return None
+        return self.owners[bisect(self.hashes, ring_hash(key)) % len(self.hashes)]
@@ -53,3 +53,30 @@ def incr(key, inc=1):
 
 def set(key, value):
     stats[key] = value
+
+
+def take_changes():
+    '''
+    Return how far each metric moved since it was last reset, and reset them
+    '''
+    changes = {}
+    for key, value in stats.iteritems():
+        default_value = stats_reset.get(key, 0)
+        if value != default_value and isinstance(value, (int, long, float)):
+            changes[key] = value - default_value
+    stats.update(stats_reset)
+    return changes
+
+
+def merge_changes(changes):
+    '''
+    Fold in metrics another process took with take_changes()
+    '''
+    add_new_metrics({key: 0 for key in changes})
+    for key, value in changes.iteritems():
+        if key.endswith('_max'):
+            stats[key] = max(stats[key], value)
+        elif key.endswith('_min'):
+            stats[key] = min(stats[key], value) if stats[key] else value
+        else:
+            stats[key] += value
@@ -5,6 +5,7 @@
 
 from __future__ import absolute_import
 from .. import utils
+from ..sender import client as sender_client
 import logging
 logger = logging.getLogger(__name__)
 
@@ -70,6 +71,7 @@ class IrisPlugin(object):
                         iid, msg_id, owner, mode, args)
             return 'Failed to claim incident for message: %s.' % str(msg_id)
         else:
+            sender_client.notify_incidents_claimed([iid])
             if previous_owner:
                 return 'Iris incident(%s) claimed, previously claimed by %s.' % (iid, previous_owner)
             else:
@@ -93,6 +95,7 @@ class IrisPlugin(object):
             return 'No messages to claim.'
 
         claimed, not_claimed = utils.claim_bulk_incidents(incident_ids, owner)
+        sender_client.notify_incidents_claimed(claimed)
 
         msg = []
         if claimed:
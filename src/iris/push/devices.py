@@ -0,0 +1,94 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Devices registered for push notifications, cached by username so pushes don't need a DB
+# query each. The API has senders drop a user's entry when they register a device, and entries
+# of devices FCM no longer knows are dropped as we find out; anything else (e.g. a sender's
+# child worker processes, which the API doesn't reach) catches up once the entry expires.
+
+import time
+from iris import db, metrics
+
+DEVICES_QUERY = '''SELECT `target`.`name`, `device`.`registration_id`, `device`.`platform`
+FROM `device`
+JOIN `target` ON `target`.`id` = `device`.`user_id`
+WHERE `target`.`name` IN %s
+AND `target`.`type_id` = (SELECT `id` FROM `target_type` WHERE `name` = 'user')'''
+
+DEFAULT_TTL = 60
+
+
+class DeviceRegistry(object):
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.devices = {}  # username: (expires, [(registration_id, platform)])
+        metrics.add_new_metrics({'push_device_cache_hit_cnt': 0, 'push_device_cache_miss_cnt': 0})
+
+    def get(self, usernames):
+        '''
+        Devices of each of these users, looking up the ones we don't have in a single query
+        '''
+        now = time.time()
+        found = {}
+        missing = set()
+        for username in usernames:
+            entry = self.devices.get(username)
+            if entry is not None and entry[0] > now:
+                found[username] = entry[1]
+            else:
+                missing.add(username)
+        metrics.incr('push_device_cache_hit_cnt', len(found))
+        if not missing:
+            return found
+        metrics.incr('push_device_cache_miss_cnt', len(missing))
+
+        loaded = {username: [] for username in missing}
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute(DEVICES_QUERY, (tuple(missing),))
+            for username, registration_id, platform in cursor:
+                loaded[username].append((registration_id, platform))
+        finally:
+            cursor.close()
+            connection.close()
+
+        expires = now + self.ttl
+        for username, devices in loaded.iteritems():
+            self.devices[username] = (expires, devices)
+        found.update(loaded)
+        return found
+
+    def invalidate(self, usernames):
+        for username in usernames:
+            self.devices.pop(username, None)
+
+    def remove(self, registration_ids):
+        # Devices FCM told us aren't registered anymore
+        registration_ids = set(registration_ids)
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''DELETE FROM `device` WHERE `registration_id` IN %s''', (tuple(registration_ids),))
+            connection.commit()
+        finally:
+            cursor.close()
+            connection.close()
+        for username, (expires, devices) in self.devices.items():
+            if any(registration_id in registration_ids for registration_id, _ in devices):
+                self.devices[username] = (expires, [device for device in devices if device[0] not in registration_ids])
+
+
+registry = None
+
+
+def get_registry(ttl=DEFAULT_TTL):
+    global registry
+    if registry is None:
+        registry = DeviceRegistry(ttl)
+    return registry
+
+
+def invalidate(usernames):
+    if registry is not None:
+        registry.invalidate(usernames)
@@ -2,97 +2,193 @@
 # See LICENSE in the project root for license information.
 
 import logging
+from collections import OrderedDict
+from gevent import sleep, spawn
+from gevent.event import Event
+from gevent.pool import Pool
 from pyfcm import FCMNotification
-from iris import db
+from iris import metrics
+from iris.push.devices import get_registry, DEFAULT_TTL
+from iris.vendors.session import get_session
 
 logger = logging.getLogger(__name__)
 
+# Fields of a message its push notification is made of
+PUSH_FIELDS = ('message_id', 'target', 'incident_id', 'subject', 'body')
+
+# Shared by the vendor instances of every worker in the process. api_key: PushDispatcher
+dispatchers = {}
+
+
+class PooledFCMNotification(FCMNotification):
+    '''
+    pyfcm posts each request with requests.post, on a new connection. Send them over a shared
+    keep-alive session instead.
+    '''
+
+    def __init__(self, session, **kwargs):
+        self.session = session
+        super(PooledFCMNotification, self).__init__(**kwargs)
+
+    def do_request(self, payload, timeout):
+        response = self.session.post(self.FCM_END_POINT, headers=self.request_headers(), data=payload, timeout=timeout)
+        if 'Retry-After' in response.headers and int(response.headers['Retry-After']) > 0:
+            sleep(int(response.headers['Retry-After']))
+            return self.do_request(payload, timeout)
+        return response
+
+
+class PushDispatcher(object):
+    '''
+    Sends the push notifications vendors queue from a pool of `workers` greenlets of its own,
+    so they stay off the path of the message they go with. Pushes queued within batch_window ms
+    of each other with the same content, like a page fanned out to a team, go to all their
+    devices in one multicast request.
+    '''
 
-class fcm(object):
     def __init__(self, config):
-        self.config = config
-        self.api_key = self.config.get('api_key')
+        self.api_key = config.get('api_key')
         # FCM guarantees best-effort delivery with TTL 0
-        self.ttl = self.config.get('ttl', 0)
-        self.timeout = self.config.get('timeout', 10)
-        self.default_notification = self.config.get('notification_title')
-        self.proxy = None
-        if 'proxy' in self.config:
-            host = self.config['proxy']['host']
-            port = self.config['proxy']['port']
-            self.proxy = {'http': 'http://%s:%s' % (host, port),
-                          'https': 'https://%s:%s' % (host, port)}
-        self.client = FCMNotification(api_key=self.api_key, proxy_dict=self.proxy)
+        self.ttl = config.get('ttl', 0)
+        self.timeout = config.get('timeout', 10)
+        self.default_notification = config.get('notification_title')
+        self.batch_window = config.get('batch_window', 50) / 1000.0
+        self.session = get_session('fcm', config, self.api_key)
+        self.registry = get_registry(config.get('device_cache_ttl', DEFAULT_TTL))
+        self.pool = Pool(config.get('workers', 10))
+        self.pending = []
+        self.wakeup = Event()
+        metrics.add_new_metrics({'push_queued_cnt': 0, 'push_queue_size': 0, 'push_request_cnt': 0,
+                                 'push_device_cnt': 0, 'push_fail_cnt': 0})
+        spawn(self.run)
 
-    def send_push(self, message):
-        # Tracking message have no target, skip sending push notification
-        if 'target' not in message:
+    def queue(self, message):
+        push = {key: message[key] for key in PUSH_FIELDS if key in message}
+        # Subjects of templates with prefix_message_id start with the message id, for claiming
+        # by replying to an SMS. Pushes are claimed by incident id, so leave it out of them, or
+        # no two pushes of a page fanned out to a team would ever share a request.
+        if push.get('message_id') and push.get('subject'):
+            prefix = str(push['message_id'])
+            subject = push['subject']
+            if subject == prefix:
+                del push['subject']
+            elif subject.startswith(prefix + ' '):
+                push['subject'] = subject[len(prefix) + 1:]
+        self.pending.append(push)
+        metrics.incr('push_queued_cnt')
+        self.wakeup.set()
+
+    def take(self):
+        messages, self.pending = self.pending, []
+        return messages
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            sleep(self.batch_window)
+            self.wakeup.clear()
+            metrics.set('push_queue_size', len(self.pending))
+            # Blocks while all workers are busy, leaving pushes to pile up into bigger batches
+            self.pool.spawn(self.send_batch, self.take())
+
+    def flush(self):
+        self.send_batch(self.take())
+        self.pool.join()
+
+    def send_batch(self, messages):
+        if not messages:
             return
-        connection = db.engine.raw_connection()
-        cursor = connection.cursor()
-        cursor.execute('''SELECT `registration_id`, `platform`
-                          FROM `device` WHERE `user_id` =
-                          (SELECT `id` FROM `target` WHERE `name` = %s
-                          AND `type_id` = (SELECT `id` FROM `target_type` WHERE `name` = 'user'))''',
-                       message['target'])
-        registration_ids = cursor.fetchall()
-        android_ids = [row[0] for row in registration_ids if row[1] == 'Android']
-        ios_ids = [row[0] for row in registration_ids if row[1] == 'iOS']
-        invalid_ids = []
-        failed_ids = []
+        try:
+            devices = self.registry.get({message['target'] for message in messages})
+        except Exception:
+            logger.exception('Failed looking up devices for %s push notifications', len(messages))
+            metrics.incr('push_fail_cnt', len(messages))
+            return
+
         # Handle iOS and Android ids separately. Mobile app requires different formats for
         # correct behavior on both platforms (esp with respect to action buttons)
-        if ios_ids:
-            try:
-                data_message = {'incident_id': message.get('incident_id')}
-                response = self.client.notify_multiple_devices(
-                    registration_ids=ios_ids,
-                    message_title=message.get('subject', self.default_notification),
-                    message_body=message.get('body', ''),
-                    sound='default',
-                    time_to_live=self.ttl,
-                    data_message=data_message,
-                    timeout=self.timeout,
-                    click_action='incident'
-                )
-                for idx, result in enumerate(response['results']):
-                    error = result.get('error')
-                    if error == 'NotRegistered':
-                        invalid_ids.append(ios_ids[idx])
-                    elif error is not None:
-                        failed_ids.append((ios_ids[idx], error))
-            except Exception:
-                logger.exception('FCM request failed for message id %s', message.get('message_id'))
-        if android_ids:
+        batches = OrderedDict()  # (platform, incident_id, title, body): (message, registration ids)
+        for message in messages:
+            for registration_id, platform in devices.get(message['target'], ()):
+                if platform not in ('iOS', 'Android'):
+                    continue
+                key = (platform, message.get('incident_id'), message.get('subject', self.default_notification),
+                       message.get('body', ''))
+                batch = batches.get(key)
+                if batch is None:
+                    batch = batches[key] = (message, OrderedDict())
+                batch[1][registration_id] = True
+
+        # pyfcm keeps the responses of a request on the client, so each batch gets its own
+        client = PooledFCMNotification(self.session, api_key=self.api_key)
+        invalid_ids = []
+        failed_ids = []
+        for (platform, incident_id, title, body), (message, registration_ids) in batches.iteritems():
+            registration_ids = list(registration_ids)
             try:
-                data_message = {'incident_id': message.get('incident_id'),
-                                'title': message.get('subject', self.default_notification),
-                                'message': message.get('body', ''),
-                                'actions': [{
-                                    'title': 'Claim',
-                                    'callback': 'claimIncident',
-                                    'foreground': True
-                                }]
-                                }
-                response = self.client.multiple_devices_data_message(
-                    registration_ids=android_ids,
-                    time_to_live=self.ttl,
-                    data_message=data_message,
-                    timeout=self.timeout
-                )
-                for idx, result in enumerate(response['results']):
-                    error = result.get('error')
-                    if error == 'NotRegistered':
-                        invalid_ids.append(android_ids[idx])
-                    elif error is not None:
-                        failed_ids.append((android_ids[idx], error))
+                if platform == 'iOS':
+                    response = client.notify_multiple_devices(
+                        registration_ids=registration_ids,
+                        message_title=title,
+                        message_body=body,
+                        sound='default',
+                        time_to_live=self.ttl,
+                        data_message={'incident_id': incident_id},
+                        timeout=self.timeout,
+                        click_action='incident'
+                    )
+                else:
+                    data_message = {'incident_id': incident_id,
+                                    'title': title,
+                                    'message': body,
+                                    'actions': [{
+                                        'title': 'Claim',
+                                        'callback': 'claimIncident',
+                                        'foreground': True
+                                    }]
+                                    }
+                    response = client.multiple_devices_data_message(
+                        registration_ids=registration_ids,
+                        time_to_live=self.ttl,
+                        data_message=data_message,
+                        timeout=self.timeout
+                    )
             except Exception:
                 logger.exception('FCM request failed for message id %s', message.get('message_id'))
+                metrics.incr('push_fail_cnt')
+                continue
+            metrics.incr('push_request_cnt')
+            metrics.incr('push_device_cnt', len(registration_ids))
+            for idx, result in enumerate(response['results']):
+                error = result.get('error')
+                if error == 'NotRegistered':
+                    invalid_ids.append(registration_ids[idx])
+                elif error is not None:
+                    failed_ids.append((registration_ids[idx], error))
+
         # Clean invalidated push notification IDs
         if invalid_ids:
-            cursor.execute('''DELETE FROM `device` WHERE `registration_id` IN %s''', (invalid_ids,))
-            connection.commit()
+            try:
+                self.registry.remove(invalid_ids)
+            except Exception:
+                logger.exception('Failed removing %s unregistered devices', len(invalid_ids))
         if failed_ids:
-            logger.exception('FCM requests failed: %s', failed_ids)
-        cursor.close()
-        connection.close()
+            logger.error('FCM requests failed: %s', failed_ids)
+
+
+class fcm(object):
+    def __init__(self, config):
+        self.config = config
+        api_key = self.config.get('api_key')
+        self.dispatcher = dispatchers.get(api_key)
+        if self.dispatcher is None:
+            self.dispatcher = dispatchers[api_key] = PushDispatcher(config)
+
+    def send_push(self, message):
+        # Tracking message have no target, skip sending push notification
+        if 'target' not in message:
+            return
+        self.dispatcher.queue(message)
+
+    def cleanup(self):
+        self.dispatcher.flush()
@@ -0,0 +1,55 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from math import ceil
+from time import time
+
+
+class TimerWheel(object):
+    '''
+    Hashed timing wheel. Timers live in the slot of the tick they're due on and every advance
+    only looks at the slots of the ticks that went by, so scheduling, cancelling and expiring
+    don't depend on how many timers are pending.
+    '''
+
+    def __init__(self, tick=1, size=512):
+        self.tick = tick
+        self.size = size
+        self.slots = [{} for _ in xrange(size)]  # key: due tick
+        self.timers = {}  # key: due tick
+        self.current = int(time() // tick)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, deadline):
+        due = max(int(ceil(deadline / float(self.tick))), self.current + 1)
+        self.cancel(key)
+        self.timers[key] = due
+        self.slots[due % self.size][key] = due
+
+    def cancel(self, key):
+        due = self.timers.pop(key, None)
+        if due is not None:
+            del self.slots[due % self.size][key]
+
+    def advance(self, now):
+        '''
+        Return the keys of every timer that came due by now, oldest tick first
+        '''
+        tick = int(now // self.tick)
+        expired = []
+        # Timers further out than one turn of the wheel share their slot with earlier ones,
+        # hence comparing due ticks rather than taking whole slots
+        for t in xrange(self.current + 1, min(tick, self.current + self.size) + 1):
+            slot = self.slots[t % self.size]
+            for key, due in slot.items():
+                if due <= tick:
+                    del slot[key]
+                    del self.timers[key]
+                    expired.append(key)
+        self.current = max(self.current, tick)
+        return expired
@@ -1,7 +1,11 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
+from time import time
+from gevent import spawn
+from gevent.event import Event
 from .. import db
+from iris import metrics
 import logging
 logger = logging.getLogger(__name__)
 
@@ -9,17 +13,93 @@ MODE_CHANGE = 'mode-change'
 TARGET_CHANGE = 'target-change'
 SENT_CHANGE = 'sent-change'
 
+INSERT_CHANGES_SQL = '''
+  INSERT INTO `message_changelog` (`message_id`, `change_type`, `old`, `new`, `description`, `date`)
+  VALUES %s
+'''
+
+# Changes waiting for the flush task, as (message_id, change_type, old, new, description, time).
+# Until init() starts that task, changes are written as they come in.
+pending = []
+max_pending = 10000
+batch_size = 500
+flush_interval = 1
+flush_now = Event()
+task = None
+
 
 def message_change(message_id, change_type, old, new, description):
     if not message_id:
         logger.warn('Not logging %s for message as it does not have an id', change_type)
         return
 
-    session = db.Session()
-    session.execute('''
-      INSERT INTO `message_changelog` (`message_id`, `change_type`, `old`, `new`, `description`, `date`)
-      VALUES (:message_id, :change_type, :old, :new, :description, NOW())
-    ''', dict(message_id=message_id, change_type=change_type, old=old, new=new, description=description))
-    session.commit()
-    session.close()
-    logger.info('Logged change information for message (ID %s)', message_id)
+    change = (message_id, change_type, old, new, description, time())
+    if task is None:
+        message_changes([change])
+        return
+
+    if len(pending) >= max_pending:
+        metrics.incr('auditlog_dropped_cnt')
+        logger.warn('Audit log queue full; dropping %s for message (ID %s)', change_type, message_id)
+        return
+
+    pending.append(change)
+    if len(pending) >= batch_size:
+        flush_now.set()
+
+
+def message_changes(changes):
+    '''
+    Log a batch of (message_id, change_type, old, new, description[, time]) changes with multi-row inserts
+    '''
+    changes = [change for change in changes if change[0]]
+    if not changes:
+        return
+
+    now = time()
+    rows = [tuple(change) if len(change) == 6 else tuple(change) + (now,) for change in changes]
+
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        for i in xrange(0, len(rows), batch_size):
+            chunk = rows[i:i + batch_size]
+            cursor.execute(INSERT_CHANGES_SQL % ', '.join(['(%s, %s, %s, %s, %s, FROM_UNIXTIME(%s))'] * len(chunk)),
+                           [field for row in chunk for field in row])
+            connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+    logger.info('Logged change information for %s messages', len(rows))
+
+
+def flush():
+    global pending
+    metrics.set('auditlog_queue_depth', len(pending))
+    if not pending:
+        return
+    changes, pending = pending, []
+    start = time()
+    try:
+        message_changes(changes)
+    except Exception:
+        metrics.incr('auditlog_dropped_cnt', len(changes))
+        logger.exception('Failed logging change information for %s messages', len(changes))
+    metrics.set('auditlog_flush', time() - start)
+
+
+def run():
+    while True:
+        flush_now.wait(flush_interval)
+        flush_now.clear()
+        flush()
+
+
+def init(config):
+    global max_pending, batch_size, flush_interval, task
+    max_pending = config.get('auditlog_max_pending', max_pending)
+    batch_size = config.get('auditlog_batch_size', batch_size)
+    flush_interval = config.get('auditlog_flush_interval', 1000) / 1000.0
+    metrics.add_new_metrics({'auditlog_queue_depth': 0, 'auditlog_flush': 0, 'auditlog_dropped_cnt': 0})
+    if task is None:
+        task = spawn(run)
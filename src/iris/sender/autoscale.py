@@ -0,0 +1,43 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from __future__ import absolute_import, division
+
+from math import ceil
+
+# Assumed time to send a message through a mode no message has been sent through yet
+DEFAULT_LATENCY = 1
+
+
+class WorkerAutoscaler(object):
+    '''
+    Decides how many workers a mode needs, between min_workers and max_workers: enough to get
+    through its queue within target_wait seconds at the pace its vendors are sending, growing at
+    most twofold a round when messages have already waited longer than that. It only shrinks
+    while messages are going out in under half of target_wait, and then by scale_down_step of
+    its workers a round, so a lull between bursts doesn't leave it short.
+    '''
+
+    def __init__(self, min_workers, max_workers, target_wait=10, scale_down_step=.25):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target_wait = target_wait
+        self.scale_down_step = scale_down_step
+
+    def clamp(self, workers):
+        return max(self.min_workers, min(self.max_workers, workers))
+
+    def desired(self, current, depth, wait, latency):
+        '''
+        Workers to have, given how many we have, how many messages are queued, how long the
+        oldest of them has waited and the moving average of vendor latency
+        '''
+        needed = int(ceil(depth * (latency or DEFAULT_LATENCY) / self.target_wait))
+        if wait > self.target_wait:
+            needed = max(needed, min(current * 2, int(ceil(current * wait / self.target_wait))))
+        if needed < current:
+            if wait > self.target_wait / 2:
+                needed = current
+            else:
+                needed = max(needed, current - int(ceil(current * self.scale_down_step)))
+        return self.clamp(needed)
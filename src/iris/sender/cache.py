@@ -3,16 +3,20 @@
 
 from __future__ import absolute_import
 
-from collections import deque
+from collections import OrderedDict
+from time import time
 import jinja2
+from jinja2 import nodes as jinja_nodes
 from jinja2.sandbox import SandboxedEnvironment
 from gevent import spawn, sleep
 from gevent.pool import Pool
 from .message import update_message_mode
 from .. import db
+from .rate import RateCounter
 from ..role_lookup import get_role_lookups
 from . import auditlog
 from ..client import IrisClient
+from iris import metrics
 
 import requests
 import logging
@@ -30,13 +34,49 @@ target_reprioritization = None
 target_names = None
 targets_for_role = None
 dynamic_plan_map = None
+target_contacts = None
+rendered_templates = None
+
+USER_CONTACTS_SQL = '''SELECT `target`.`name`, `target_contact`.`mode_id`, `target_contact`.`destination`
+FROM `target`
+JOIN `target_type` ON `target_type`.`id` = `target`.`type_id`
+LEFT JOIN `target_contact` ON `target_contact`.`target_id` = `target`.`id`
+WHERE `target_type`.`name` = "user"'''
+
+USER_MODES_SQL = '''SELECT `target`.`name`, `target_mode`.`priority_id`, `target_mode`.`mode_id`
+FROM `target_mode`
+JOIN `target` ON `target`.`id` = `target_mode`.`target_id`
+JOIN `target_type` ON `target_type`.`id` = `target`.`type_id`
+WHERE `target_type`.`name` = "user"'''
+
+USER_APPLICATION_MODES_SQL = '''SELECT `target`.`name`, `target_application_mode`.`application_id`,
+       `target_application_mode`.`priority_id`, `target_application_mode`.`mode_id`
+FROM `target_application_mode`
+JOIN `target` ON `target`.`id` = `target_application_mode`.`target_id`
+JOIN `target_type` ON `target_type`.`id` = `target`.`type_id`
+WHERE `target_type`.`name` = "user"'''
+
+APPLICATIONS_SQL = '''SELECT `application`.`name`, `application`.`id` FROM `application` WHERE TRUE'''
+
+APPLICATION_MODES_SQL = '''SELECT `application`.`name`, `application_mode`.`mode_id`
+FROM `application_mode`
+JOIN `application` ON `application`.`id` = `application_mode`.`application_id`
+WHERE TRUE'''
+
+DEFAULT_APPLICATION_MODES_SQL = '''SELECT `application`.`name`, `default_application_mode`.`priority_id`,
+       `default_application_mode`.`mode_id`
+FROM `default_application_mode`
+JOIN `application` ON `application`.`id` = `default_application_mode`.`application_id`
+WHERE TRUE'''
 
 
 class Cache():
-    def __init__(self, engine, sql, active):
+    def __init__(self, engine, sql, active, bulk_sql=None, bulk_key=None):
         self.engine = engine
         self.sql = sql
         self.active = active
+        self.bulk_sql = bulk_sql
+        self.bulk_key = bulk_key
         self.data = {}
 
     def __getitem__(self, key):
@@ -51,6 +91,20 @@ class Cache():
             connection.close()
             return ret
 
+    def prefetch(self, keys):
+        # Load all uncached keys with one query. Keys it doesn't return are left for
+        # __getitem__ to look up (and cache as missing) one at a time.
+        missing = set(keys) - self.data.viewkeys()
+        if not missing or not self.bulk_sql:
+            return
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor(db.dict_cursor)
+        cursor.execute(self.bulk_sql, [tuple(missing)])
+        for row in cursor:
+            self.data[row[self.bulk_key]] = row
+        cursor.close()
+        connection.close()
+
     def purge(self):
         if self.data and self.active:
             connection = self.engine.raw_connection()
@@ -107,14 +161,12 @@ class Templates():
             for template_id, application, mode, subject, body in cursor:
                 logger.debug('[+] adding template: %s %s %s %s', key, template_id, application, mode)
                 try:
-                    # make sure message_id is delivered to the user
-                    if self.has_message_id(subject) or self.has_message_id(body):
-                        subject = self.env.from_string(subject)
-                    else:
-                        if subject:
-                            subject = self.env.from_string('{{ iris.message_id }} ' + subject)
-                        else:
-                            subject = self.env.from_string('{{ iris.message_id }}')
+                    # make sure message_id is delivered to the user. It's prefixed to the subject
+                    # after rendering, so the rest of the subject can be shared between recipients
+                    prefix_message_id = not (self.has_message_id(subject) or self.has_message_id(body))
+                    subject_fields = self.message_fields(subject or '')
+                    body_fields = self.message_fields(body)
+                    subject = self.env.from_string(subject or '')
                     body = self.env.from_string(body)
                 except jinja2.exceptions.TemplateSyntaxError:
                     logger.info('[-] error parsing template: %s %s %s %s', key, template_id, application, mode)
@@ -122,7 +174,10 @@ class Templates():
                 template['id'] = template_id
                 template.setdefault(application, {})[mode] = {
                     'subject': subject,
-                    'body': body
+                    'body': body,
+                    'prefix_message_id': prefix_message_id,
+                    'subject_fields': subject_fields,
+                    'body_fields': body_fields
                 }
 
             self.data[key] = template
@@ -156,6 +211,26 @@ class Templates():
 
         return valid
 
+    def message_fields(self, source):
+        # The per message `iris` fields a template uses, so renders can be shared between
+        # messages that agree on them. None if it uses `iris` in a way we can't tell.
+        ast = self.env.parse(source)
+        fields = set()
+        for node in ast.find_all((jinja_nodes.Getattr, jinja_nodes.Getitem)):
+            if isinstance(node.node, jinja_nodes.Name) and node.node.name == 'iris':
+                if isinstance(node, jinja_nodes.Getattr):
+                    fields.add(node.attr)
+                elif isinstance(node.arg, jinja_nodes.Const):
+                    fields.add(node.arg.value)
+                else:
+                    return None
+        uses = sum(1 for node in ast.find_all(jinja_nodes.Name) if node.name == 'iris')
+        accesses = sum(1 for node in ast.find_all((jinja_nodes.Getattr, jinja_nodes.Getitem))
+                       if isinstance(node.node, jinja_nodes.Name) and node.node.name == 'iris')
+        if uses != accesses:
+            return None
+        return tuple(sorted(fields))
+
     def refresh(self):
         logger.info('refreshing templates')
 
@@ -276,10 +351,69 @@ class Plans():
         self.active = active
 
 
+class RenderCache(object):
+    '''
+    Rendered subjects and bodies, shared between messages of the same template, application, mode
+    and incident (or context) that agree on the `iris` fields the template uses, so fanning a
+    notification out to a big team or list renders it once. Entries expire after ttl seconds,
+    which comfortably covers sending all of a notification's messages.
+    '''
+
+    def __init__(self, ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.data = OrderedDict()  # key: (rendered, expiry), oldest first
+        self.hits = 0
+        self.misses = 0
+        metrics.add_new_metrics({'render_cache_hit_cnt': 0, 'render_cache_miss_cnt': 0,
+                                 'render_cache_hit_pct': 0, 'render_cache_size': 0})
+
+    def render(self, template, fields, key, context):
+        if fields is None or key is None:
+            return template.render(**context)
+
+        iris = context.get('iris') or {}
+        key += tuple(iris.get(field) for field in fields)
+        now = time()
+        try:
+            rendered, expiry = self.data[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable field value; can't share this one
+            return template.render(**context)
+        else:
+            if expiry > now:
+                self.hits += 1
+                metrics.incr('render_cache_hit_cnt')
+                return rendered
+
+        self.misses += 1
+        metrics.incr('render_cache_miss_cnt')
+        rendered = template.render(**context)
+        self.data.pop(key, None)
+        self.data[key] = (rendered, now + self.ttl)
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+        return rendered
+
+    def purge(self):
+        now = time()
+        while self.data:
+            key, (rendered, expiry) = next(self.data.iteritems())
+            if expiry > now:
+                break
+            del self.data[key]
+        total = self.hits + self.misses
+        metrics.set('render_cache_hit_pct', 100 * self.hits / total if total else 0)
+        metrics.set('render_cache_size', len(self.data))
+        self.hits = self.misses = 0
+
+
 class TargetReprioritization(object):
     def __init__(self, engine):
         self.engine = engine
-        # (target, src_mode): (dst_mode, destination, count, deque)
+        # (target, src_mode): (dst_mode, destination, count, RateCounter)
         self.rates = {}
 
     def refresh(self):
@@ -306,7 +440,7 @@ class TargetReprioritization(object):
                     logger.info('invalid target reprioritization rule (%s, %s): (%s, %s, %d, %d)',
                                 target, src_mode, dst_mode, destination, count, duration)
                     continue
-                rates[(target, src_mode)] = (dst_mode, destination, count, duration / 60)
+                rates[(target, src_mode)] = (dst_mode, destination, count, duration)
 
             cursor.close()
             connection.close()
@@ -322,22 +456,23 @@ class TargetReprioritization(object):
             # new rate entries:
             for key in current - old:
                 logger.debug('creating target reprioritization rule for %r: %r', key, rates[key])
-                dst_mode, destination, count, duration_min = rates[key]
-                self.rates[key] = (dst_mode, destination, count, deque([0] * duration_min, maxlen=duration_min))
+                dst_mode, destination, count, duration = rates[key]
+                self.rates[key] = (dst_mode, destination, count, RateCounter.with_resolution(duration))
 
             # loop through existing entries
             # if the settings have changed, gracefully alter them
-            # either way, push in a new bucket
+            now = time()
             for key in current & old:
-                current_dst_mode, current_destination, current_count, current_duration_min = rates[key]
-                old_dst_mode, old_destination, old_count, old_buckets = self.rates[key]
-                if old_dst_mode != current_dst_mode or old_destination != current_destination or old_count != current_count or len(old_buckets) != current_duration_min:  # noqa FIXME: refactor this line
+                current_dst_mode, current_destination, current_count, current_duration = rates[key]
+                old_dst_mode, old_destination, old_count, old_counter = self.rates[key]
+                if old_dst_mode != current_dst_mode or old_destination != current_destination or old_count != current_count or old_counter.window != current_duration:  # noqa FIXME: refactor this line
                     logger.debug('updating target reprioritization rule for %r: %r | %r', key, self.rates[key], rates[key])
-                    # create a new bucket truncating if it's smaller and growing if it is larger, while preserving the counts
-                    current_buckets = deque(old_buckets, maxlen=current_duration_min)
-                    self.rates[key] = (current_dst_mode, current_destination, current_count, current_buckets)
-                # add the new interval bucket to each
-                self.rates[key][-1].append(0)
+                    # on a new duration start a new counter, preserving the count so far
+                    current_counter = old_counter
+                    if old_counter.window != current_duration:
+                        current_counter = RateCounter.with_resolution(current_duration)
+                        current_counter.add(now, old_counter.count(now))
+                    self.rates[key] = (current_dst_mode, current_destination, current_count, current_counter)
 
             logger.info('refreshed target reprioritization rules: %d', len(self.rates))
             logger.debug(self.rates)
@@ -359,14 +494,13 @@ class TargetReprioritization(object):
             else:
                 seen.add(original_mode)
         try:
-            dst_mode, destination, count, buckets = self.rates[(message['target'], original_mode)]
-            logger.debug('reprioritization (%s, %s): (%s, %s, %d, %r)',
-                         message['target'], original_mode, dst_mode, destination, count, buckets)
-            # increment the bucket for this minute
-            buckets[-1] += 1
-            if sum(buckets) > count:
-                logger.debug('target reprioritization rule triggered (%s, %s): (%s, %s, %d, %r)',
-                             message['target'], original_mode, dst_mode, destination, count, buckets)
+            dst_mode, destination, count, counter = self.rates[(message['target'], original_mode)]
+            logger.debug('reprioritization (%s, %s): (%s, %s, %d, %d)',
+                         message['target'], original_mode, dst_mode, destination, count, counter.total)
+            counter.add(time())
+            if counter.total > count:
+                logger.debug('target reprioritization rule triggered (%s, %s): (%s, %s, %d, %d)',
+                             message['target'], original_mode, dst_mode, destination, count, counter.total)
                 # sum of all counts for duration exceeds count
                 # reprioritize to destination mode
                 message['mode'] = dst_mode
@@ -430,12 +564,158 @@ class RoleTargets():
         connection.close()
 
 
+class TargetContacts(object):
+    '''
+    In-memory copy of the user and application mode settings and user contacts, so picking the
+    mode and destination of a message doesn't take a DB round trip. Rebuilt in bulk every ttl
+    seconds, and per user or application through invalidate() when the API changes their settings.
+    '''
+
+    def __init__(self, engine, ttl, max_invalidate=1000):
+        self.engine = engine
+        self.ttl = ttl
+        self.max_invalidate = max_invalidate
+        self.built = 0
+        self.modes = {}  # mode_id: name
+        self.mode_ids = {}  # name: mode_id
+        self.priority_modes = {}  # priority_id: mode_id
+        # user name: {'contacts': {mode_id: destination}, 'modes': {priority_id: mode_id},
+        #             'app_modes': {(application_id, priority_id): mode_id}}, or None if not a user
+        self.users = {}
+        # application name: {'id', 'modes': set of allowed mode_ids, 'defaults': {priority_id: mode_id}}, or None
+        self.applications = {}
+
+    def query(self, sql, column=None, names=None):
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor()
+        if names:
+            cursor.execute(sql + ' AND %s IN %%s' % column, [tuple(names)])
+        else:
+            cursor.execute(sql)
+        rows = cursor.fetchall()
+        cursor.close()
+        connection.close()
+        return rows
+
+    def load_users(self, names=None):
+        users = {}
+        for name, mode_id, destination in self.query(USER_CONTACTS_SQL, '`target`.`name`', names):
+            user = users.setdefault(name, {'contacts': {}, 'modes': {}, 'app_modes': {}})
+            if mode_id is not None:
+                user['contacts'][mode_id] = destination
+        for name, priority_id, mode_id in self.query(USER_MODES_SQL, '`target`.`name`', names):
+            if name in users:
+                users[name]['modes'][priority_id] = mode_id
+        for name, application_id, priority_id, mode_id in self.query(USER_APPLICATION_MODES_SQL, '`target`.`name`', names):
+            if name in users:
+                users[name]['app_modes'][(application_id, priority_id)] = mode_id
+        return users
+
+    def load_applications(self, names=None):
+        applications = {}
+        for name, application_id in self.query(APPLICATIONS_SQL, '`application`.`name`', names):
+            applications[name] = {'id': application_id, 'modes': set(), 'defaults': {}}
+        for name, mode_id in self.query(APPLICATION_MODES_SQL, '`application`.`name`', names):
+            if name in applications:
+                applications[name]['modes'].add(mode_id)
+        for name, priority_id, mode_id in self.query(DEFAULT_APPLICATION_MODES_SQL, '`application`.`name`', names):
+            if name in applications:
+                applications[name]['defaults'][priority_id] = mode_id
+        return applications
+
+    def rebuild(self):
+        start = time()
+        modes = dict(self.query('SELECT `id`, `name` FROM `mode`'))
+        priority_modes = dict(self.query('SELECT `id`, `mode_id` FROM `priority`'))
+        users = self.load_users()
+        applications = self.load_applications()
+        self.modes = modes
+        self.mode_ids = {name: mode_id for mode_id, name in modes.iteritems()}
+        self.priority_modes = priority_modes
+        self.users = users
+        self.applications = applications
+        self.built = time()
+        logger.info('Built contact index for %s users and %s applications in %.2f seconds',
+                    len(users), len(applications), self.built - start)
+
+    def refresh(self):
+        if time() - self.built > self.ttl:
+            self.rebuild()
+
+    def invalidate(self, users=(), applications=()):
+        # cheaper to start over than to reload a big chunk of users one IN list at a time
+        if len(users) + len(applications) > self.max_invalidate:
+            self.rebuild()
+            return
+        if users:
+            loaded = self.load_users(users)
+            for name in users:
+                self.users[name] = loaded.get(name)
+        if applications:
+            loaded = self.load_applications(applications)
+            for name in applications:
+                self.applications[name] = loaded.get(name)
+        logger.info('Reloaded contact settings for users: %s, applications: %s',
+                    ', '.join(users), ', '.join(applications))
+
+    def get_user(self, name):
+        try:
+            return self.users[name]
+        except KeyError:
+            user = self.users[name] = self.load_users([name]).get(name)
+            return user
+
+    def get_application(self, name):
+        try:
+            return self.applications[name]
+        except KeyError:
+            application = self.applications[name] = self.load_applications([name]).get(name)
+            return application
+
+    def by_priority(self, target, application, priority_id):
+        '''
+        Returns (destination, mode, mode_id) for a user's message of this application and priority,
+        going by the user's per application setting, then the application's default, then the user's
+        default and finally the priority's default. None if this isn't a user or the application
+        doesn't allow the resulting mode.
+        '''
+        user = self.get_user(target)
+        app = self.get_application(application)
+        if not user or not app:
+            return None
+
+        mode_id = user['app_modes'].get((app['id'], priority_id))
+        if mode_id is None:
+            mode_id = app['defaults'].get(priority_id)
+        if mode_id is None:
+            mode_id = user['modes'].get(priority_id)
+        if mode_id is None:
+            mode_id = self.priority_modes.get(priority_id)
+        if mode_id not in app['modes']:
+            return None
+
+        # the "drop" mode isn't going to have a contact
+        return user['contacts'].get(mode_id), self.modes.get(mode_id), mode_id
+
+    def by_mode(self, target, mode_id=None, mode=None):
+        # Returns a user's destination for a mode given by id or name, if they have one
+        user = self.get_user(target)
+        if not user:
+            return None
+        contacts = user['contacts']
+        if mode_id in contacts:
+            return contacts[mode_id]
+        return contacts.get(self.mode_ids.get(mode))
+
+
 def refresh():
+    target_contacts.refresh()
     plans.refresh()
     templates.refresh()
 
 
 def purge():
+    rendered_templates.purge()
     target_names.purge()
     targets_for_role.purge()
     incidents.purge()
@@ -444,7 +724,7 @@ def purge():
 
 def init(api_host, config):
     global targets_for_role, target_names, target_reprioritization, plan_notifications, targets
-    global roles, incidents, templates, plans, iris_client, dynamic_plan_map
+    global roles, incidents, templates, plans, iris_client, dynamic_plan_map, target_contacts, rendered_templates
 
     iris_client = IrisClient(api_host, 0)
 
@@ -470,6 +750,7 @@ def init(api_host, config):
 
     plans = Plans(db.engine)
     templates = Templates(db.engine)
+    rendered_templates = RenderCache(config['sender'].get('render_cache_ttl', 300))
     incidents = Cache(db.engine,
                       'SELECT * FROM `incident` WHERE `id`=%s',
                       'SELECT `id` from `incident` WHERE `active`=True AND `id` IN %s')
@@ -483,7 +764,8 @@ def init(api_host, config):
                                 'JOIN `plan_active` ON `plan_notification`.`plan_id` = `plan_active`.`plan_id` '
                                 'AND `plan_notification`.`id` IN %s'))
     target_reprioritization = TargetReprioritization(db.engine)
-    target_names = Cache(db.engine, 'SELECT * FROM `target` WHERE `name`=%s AND `active` = TRUE', None)
+    target_names = Cache(db.engine, 'SELECT * FROM `target` WHERE `name`=%s AND `active` = TRUE', None,
+                         'SELECT * FROM `target` WHERE `name` IN %s AND `active` = TRUE', 'name')
     role_lookups = get_role_lookups(config)
     targets_for_role = RoleTargets(role_lookups, db.engine)
     dynamic_plan_map = DynamicPlanMap(db.engine,
@@ -492,4 +774,6 @@ def init(api_host, config):
                                          JOIN `incident` ON `incident`.`id` = `dynamic_plan_map`.`incident_id`
                                          WHERE `incident`.`active` = TRUE AND `incident_id` IN %s''')
 
+    target_contacts = TargetContacts(db.engine, config['sender'].get('contact_index_ttl', 600))
+
     spawn(target_reprioritization.refresh)
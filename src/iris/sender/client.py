@@ -0,0 +1,320 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Client side of the sender msgpack RPC, used by the API to reach the sender cluster
+# and by the master sender to reach its slaves
+
+from __future__ import absolute_import
+
+from time import time
+from gevent import spawn, sleep, socket, Timeout
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore, Semaphore
+import msgpack
+from iris import metrics
+from ..utils import msgpack_handle_sets
+
+import logging
+logger = logging.getLogger(__name__)
+
+coordinator = None
+default_sender_addr = None
+connections = {}  # sender address: MultiplexedConnection
+
+# Don't let a slow or hung master sender hold on to API greenlets
+NOTIFY_TIMEOUT = 5
+REQUEST_TIMEOUT = 20
+
+
+class RPCError(Exception):
+    pass
+
+
+class ConnectError(RPCError):
+    '''
+    The request never reached the sender, so it's safe to try it elsewhere
+    '''
+    pass
+
+
+class MultiplexedConnection(object):
+    '''
+    Long lived connection to one sender, carrying many requests at once. Requests are tagged
+    with an id and answered as [id, response] frames in whatever order the sender finishes
+    them, with at most max_inflight of them outstanding. Failed connects are retried with
+    exponential backoff, and idle connections are pinged every health_check_interval seconds
+    so dead ones get noticed before a request has to wait out its timeout.
+    '''
+
+    def __init__(self, address, max_inflight=100, timeout=20, connect_timeout=NOTIFY_TIMEOUT,
+                 health_check_interval=10, max_backoff=30, name=None):
+        self.address = tuple(address)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.health_check_interval = health_check_interval
+        self.max_backoff = max_backoff
+
+        self.inflight = BoundedSemaphore(max_inflight)
+        self.connect_lock = Semaphore()
+        self.write_lock = Semaphore()
+        self.sock = None
+        self.pending = {}  # request id: AsyncResult
+        self.next_id = 0
+        self.backoff = 0
+        self.retry_at = 0
+        self.last_response = 0
+        self.latencies = []  # of responses since metrics were last reported
+
+        self.metric_prefix = 'rpc_%s_' % name if name else None
+        if self.metric_prefix:
+            metrics.add_new_metrics({self.metric_prefix + key: 0 for key in
+                                     ('latency_avg', 'latency_max', 'pending', 'connect_fail_cnt', 'disconnect_cnt')})
+        spawn(self.check_health)
+
+    def connect(self):
+        with self.connect_lock:
+            if self.sock is not None:
+                return self.sock
+            now = time()
+            if now < self.retry_at:
+                raise ConnectError('not reconnecting for another %.1fs' % (self.retry_at - now))
+            try:
+                sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+            except (socket.error, socket.timeout) as e:
+                self.backoff = min(max(self.backoff * 2, 0.5), self.max_backoff)
+                self.retry_at = now + self.backoff
+                self.incr('connect_fail_cnt')
+                raise ConnectError('failed connecting: %s' % e)
+            sock.settimeout(None)
+            self.backoff = 0
+            self.sock = sock
+            spawn(self.read_responses, sock)
+            return sock
+
+    def disconnect(self, sock, reason):
+        if sock is not self.sock:
+            return
+        self.sock = None
+        self.incr('disconnect_cnt')
+        logger.warning('Dropping connection to %s:%s: %s', self.address[0], self.address[1], reason)
+        try:
+            sock.close()
+        except socket.error:
+            pass
+        pending, self.pending = self.pending, {}
+        for result in pending.itervalues():
+            result.set_exception(RPCError(reason))
+
+    def read_responses(self, sock):
+        unpacker = msgpack.Unpacker()
+        reason = 'connection closed'
+        try:
+            while True:
+                buf = sock.recv(65536)
+                if not buf:
+                    break
+                unpacker.feed(buf)
+                for request_id, payload in unpacker:
+                    self.last_response = time()
+                    result = self.pending.pop(request_id, None)
+                    if result is not None:
+                        result.set(msgpack.unpackb(payload))
+        except Exception as e:
+            reason = str(e)
+        self.disconnect(sock, reason)
+
+    def request(self, endpoint, data, timeout=None):
+        with self.inflight:
+            sock = self.connect()
+            request_id = self.next_id
+            self.next_id += 1
+            payload = msgpack.packb({'endpoint': endpoint, 'data': data, 'id': request_id}, default=msgpack_handle_sets)
+            result = self.pending[request_id] = AsyncResult()
+            start = time()
+            try:
+                with self.write_lock:
+                    sock.sendall(payload)
+            except socket.error as e:
+                self.disconnect(sock, str(e))
+                raise RPCError(str(e))
+
+            try:
+                response = result.get(timeout=timeout or self.timeout)
+            except Timeout:
+                self.pending.pop(request_id, None)
+                raise RPCError('timed out after %ss' % (timeout or self.timeout))
+            self.latencies.append(time() - start)
+            return response
+
+    def check_health(self):
+        while True:
+            sleep(self.health_check_interval)
+            self.report_metrics()
+            sock = self.sock
+            if sock is None or time() - self.last_response < self.health_check_interval:
+                continue
+            try:
+                self.request('v0/ping', {}, self.connect_timeout)
+            except RPCError as e:
+                self.disconnect(sock, 'health check failed: %s' % e)
+
+    def incr(self, key):
+        if self.metric_prefix:
+            metrics.incr(self.metric_prefix + key)
+
+    def report_metrics(self):
+        latencies, self.latencies = self.latencies, []
+        if not self.metric_prefix:
+            return
+        metrics.set(self.metric_prefix + 'pending', len(self.pending))
+        if latencies:
+            metrics.set(self.metric_prefix + 'latency_avg', sum(latencies) / len(latencies))
+            metrics.set(self.metric_prefix + 'latency_max', max(latencies))
+
+
+def get_master_address():
+    # If we're using ZK, try that to get master
+    if coordinator:
+        sender_addr = coordinator.get_current_master()
+        if sender_addr:
+            return sender_addr
+        logger.error('Failed getting current sender master. Falling back to %s', default_sender_addr)
+    return default_sender_addr
+
+
+def get_slave_addresses():
+    if coordinator:
+        return coordinator.get_current_slaves()
+    return []
+
+
+def get_connection(address):
+    address = tuple(address)
+    connection = connections.get(address)
+    if connection is None:
+        connection = connections[address] = MultiplexedConnection(
+            address, timeout=REQUEST_TIMEOUT, name='sender_%s_%s' % (address[0].replace('.', '_'), address[1]))
+    return connection
+
+
+def send_request(endpoint, data):
+    '''
+    Send a request over the pooled connection to the master sender, falling back to the
+    slaves if the master can't be reached. Requests that made it to a sender but failed
+    there aren't retried elsewhere, as they may have been acted on already.
+    '''
+    sender_addrs = [get_master_address()] + get_slave_addresses()
+    last_error = RPCError('no senders known')
+    for sender_addr in filter(None, sender_addrs):
+        try:
+            return get_connection(sender_addr).request(endpoint, data)
+        except ConnectError as e:
+            logger.warning('Failed reaching sender %s: %s', sender_addr, e)
+            last_error = e
+    raise last_error
+
+
+def notify_sender(sender_addr, endpoint, data, about):
+    '''
+    Send a request to one sender over its pooled connection, with a short timeout, and
+    return whether it was accepted. Failures are only logged, as the periodic work in the
+    senders catches up on whatever these notifications are about.
+    '''
+    try:
+        sender_resp = get_connection(sender_addr).request(endpoint, data, timeout=NOTIFY_TIMEOUT)
+    except RPCError as e:
+        logger.warning('Failed telling sender %s about %s: %s', sender_addr, about, e)
+        return False
+
+    if sender_resp != 'OK':
+        logger.warning('Sender %s did not accept %s: %s', sender_addr, about, sender_resp)
+        return False
+
+    return True
+
+
+def send_incident_notification(incident_id, sender_addr=None, forwarded=False):
+    if sender_addr is None:
+        sender_addr = get_master_address()
+    if not sender_addr:
+        return False
+
+    data = {'incident_id': incident_id}
+    if forwarded:
+        data['forwarded'] = True
+    return notify_sender(sender_addr, 'v0/new_incident', data, 'new incident %s' % incident_id)
+
+
+def notify_new_incident(incident_id):
+    '''
+    Tell the master sender about a freshly committed incident so it can page
+    right away instead of waiting for its next escalation run. Fire and
+    forget; the periodic escalation in the sender stays the safety net.
+    '''
+    if not incident_id or not (coordinator or default_sender_addr):
+        return
+    spawn(send_incident_notification, incident_id)
+
+
+def send_incidents_claimed(incident_ids, sender_addr=None, forwarded=False):
+    if sender_addr is None:
+        sender_addr = get_master_address()
+    if not sender_addr:
+        return False
+
+    data = {'incident_ids': incident_ids}
+    if forwarded:
+        data['forwarded'] = True
+    return notify_sender(sender_addr, 'v0/incidents_claimed', data, '%s claimed incidents' % len(incident_ids))
+
+
+def notify_incidents_claimed(incident_ids):
+    '''
+    Tell the master sender these incidents were claimed, so it stops holding their
+    messages for aggregated batches. Fire and forget; the master also checks a batch
+    is still active before sending it.
+    '''
+    incident_ids = list(incident_ids)
+    if not incident_ids or not (coordinator or default_sender_addr):
+        return
+    spawn(send_incidents_claimed, incident_ids)
+
+
+def send_contacts_changed(sender_addr, users, applications):
+    return notify_sender(sender_addr, 'v0/invalidate_contacts', {'users': users, 'applications': applications},
+                         'changed contacts')
+
+
+def broadcast_contacts_changed(users, applications):
+    sender_addrs = set(filter(None, get_slave_addresses()))
+    master_addr = get_master_address()
+    if master_addr:
+        sender_addrs.add(master_addr)
+    for sender_addr in sender_addrs:
+        spawn(send_contacts_changed, sender_addr, users, applications)
+
+
+def notify_contacts_changed(users=(), applications=()):
+    '''
+    Tell every sender we know of to reload the contact settings of these users and applications.
+    Fire and forget; senders also rebuild their contact index periodically.
+    '''
+    users = list(users)
+    applications = list(applications)
+    if not (users or applications) or not (coordinator or default_sender_addr):
+        return
+    spawn(broadcast_contacts_changed, users, applications)
+
+
+def init(zk_hosts, default_addr):
+    global coordinator, default_sender_addr
+    default_sender_addr = default_addr
+    if zk_hosts:
+        from iris.coordinator.kazoo import Coordinator
+        coordinator = Coordinator(zk_hosts=zk_hosts,
+                                  hostname=None,
+                                  port=None,
+                                  join_cluster=False)
+    else:
+        logger.info('Not using ZK to get senders. Using host %s for master instead.', default_addr)
+        coordinator = None
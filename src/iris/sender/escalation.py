@@ -0,0 +1,299 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from __future__ import absolute_import
+
+from heapq import heappush, heappop
+from time import time
+from gevent import spawn
+from gevent.event import Event
+from gevent.lock import Semaphore
+from iris import metrics
+from . import cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Only run once, when we become master, to pick up where the previous master left off
+ESCALATION_STATE_SQL = '''SELECT
+`incident_id`,
+`plan_id`,
+`plan_notification_id`,
+max(`count`) as `count`,
+`max`,
+min(`age`) as `age`,
+`wait`,
+`step`,
+`current_step`,
+`step_count`
+FROM (
+    SELECT
+        `message`.`incident_id` as `incident_id`,
+        `message`.`plan_notification_id` as `plan_notification_id`,
+        count(`message`.`id`) as `count`,
+        `plan_notification`.`repeat` + 1 as `max`,
+        TIMESTAMPDIFF(SECOND, max(`message`.`created`), NOW()) as `age`,
+        `plan_notification`.`wait` as `wait`,
+        `plan_notification`.`step` as `step`,
+        `incident`.`current_step`,
+        `plan`.`step_count`,
+        `message`.`plan_id`
+    FROM `message`
+    JOIN `incident` ON `message`.`incident_id` = `incident`.`id`
+    JOIN `plan_notification` ON `message`.`plan_notification_id` = `plan_notification`.`id`
+    JOIN `plan` ON `message`.`plan_id` = `plan`.`id`
+    WHERE `incident`.`active` = 1
+    GROUP BY `incident`.`id`, `message`.`plan_notification_id`, `message`.`target_id`
+) as `inner`
+GROUP BY `incident_id`, `plan_notification_id`'''
+
+ACTIVE_INCIDENTS_SQL = '''SELECT `id` FROM `incident` WHERE `active`=1 AND `id` IN %s'''
+
+
+class NotificationState(object):
+    __slots__ = ('count', 'max', 'wait', 'step', 'last_created', 'retry_at')
+
+    def __init__(self, count, max, wait, step, last_created):
+        self.count = count
+        self.max = max
+        self.wait = wait
+        self.step = step
+        self.last_created = last_created
+        self.retry_at = None
+
+    @property
+    def deadline(self):
+        if self.retry_at is not None:
+            return self.retry_at
+        return self.last_created + self.wait
+
+
+class EscalationScheduler(object):
+    '''
+    Tracks every (incident, plan notification) the master has created messages for and fires
+    repeats, step escalations and deactivations from a deadline heap once their wait expires,
+    instead of rediscovering them with aggregate queries over the message table. Repeats we
+    couldn't create any messages for (e.g. failing to resolve their targets) are tried again
+    every retry_interval seconds.
+    '''
+
+    def __init__(self, db, repeat_notifications, escalate_incidents, deactivate_incidents, owns_incident=None,
+                 retry_interval=60):
+        self.db = db
+        self.retry_interval = retry_interval
+        self.owns_incident = owns_incident
+        self.repeat_notifications = repeat_notifications
+        self.escalate_incidents = escalate_incidents
+        self.deactivate_incidents = deactivate_incidents
+
+        self.notifications = {}  # (incident_id, plan_notification_id): NotificationState
+        self.incidents = {}  # incident_id: {'plan_id', 'current_step', 'step_count', 'notifications'}
+        self.deadlines = []  # heap of (deadline, incident_id, plan_notification_id)
+        self.wakeup = Event()
+        self.rebuild_lock = Semaphore()
+        self.task = None
+        self.loaded = False
+
+        metrics.add_new_metrics({'escalation_state_rebuild': 0, 'escalation_tracked_incidents_cnt': 0,
+                                 'escalation_tracked_notifications_cnt': 0, 'escalation_repeat_cnt': 0,
+                                 'escalation_step_cnt': 0, 'escalation_deactivate_cnt': 0,
+                                 'escalation_repeat_retry_cnt': 0})
+
+    def rebuild(self):
+        with self.rebuild_lock:
+            self.load()
+
+    def load(self):
+        logger.info('Rebuilding escalation state from DB')
+        start = time()
+        self.clear()
+
+        connection = self.db.engine.raw_connection()
+        cursor = connection.cursor(self.db.dict_cursor)
+        cursor.execute(ESCALATION_STATE_SQL)
+        for row in cursor:
+            # Incidents of other senders' shards are theirs to escalate
+            if self.owns_incident and not self.owns_incident(row['incident_id']):
+                continue
+            incident = self.track_incident(row['incident_id'], row['plan_id'], row['current_step'], row['step_count'])
+            key = (row['incident_id'], row['plan_notification_id'])
+            self.notifications[key] = NotificationState(row['count'], row['max'], row['wait'], row['step'], start - row['age'])
+            incident['notifications'].add(row['plan_notification_id'])
+            self.schedule(key)
+        cursor.close()
+        connection.close()
+
+        self.loaded = True
+        if not bool(self.task):
+            self.task = spawn(self.run)
+
+        metrics.set('escalation_state_rebuild', time() - start)
+        logger.info('Rebuilt escalation state for %s notifications of %s incidents',
+                    len(self.notifications), len(self.incidents))
+
+    def reset(self):
+        logger.info('Dropping escalation state')
+        if bool(self.task):
+            self.task.kill()
+        self.task = None
+        self.loaded = False
+        self.clear()
+
+    def clear(self):
+        self.notifications = {}
+        self.incidents = {}
+        self.deadlines = []
+
+    def track_incident(self, incident_id, plan_id, current_step, step_count):
+        incident = self.incidents.get(incident_id)
+        if incident is None:
+            incident = self.incidents[incident_id] = {
+                'plan_id': plan_id,
+                'current_step': current_step,
+                'step_count': step_count,
+                'notifications': set()
+            }
+        return incident
+
+    def forget_incident(self, incident_id):
+        incident = self.incidents.pop(incident_id, None)
+        if incident:
+            for plan_notification_id in incident['notifications']:
+                self.notifications.pop((incident_id, plan_notification_id), None)
+
+    def schedule(self, key):
+        deadline = self.notifications[key].deadline
+        if not self.deadlines or deadline < self.deadlines[0][0]:
+            self.wakeup.set()
+        heappush(self.deadlines, (deadline,) + key)
+
+    def messages_created(self, incident_id, plan_notification_id, now=None):
+        if not self.loaded:
+            return
+        if now is None:
+            now = time()
+        plan_notification = cache.plan_notifications[plan_notification_id]
+        plan_id = plan_notification['plan_id']
+        incident = self.track_incident(incident_id, plan_id, plan_notification['step'],
+                                       len(cache.plans[plan_id]['steps']))
+
+        key = (incident_id, plan_notification_id)
+        state = self.notifications.get(key)
+        if state is None:
+            state = self.notifications[key] = NotificationState(0, plan_notification['repeat'] + 1, plan_notification['wait'],
+                                                                plan_notification['step'], now)
+            incident['notifications'].add(plan_notification_id)
+        state.count += 1
+        state.last_created = now
+        state.retry_at = None
+        self.schedule(key)
+
+    def created_count(self, key):
+        state = self.notifications.get(key)
+        return None if state is None else state.count
+
+    def invalidate(self):
+        # Our state is out of date, e.g. because another sender escalated one of our incidents
+        # while we disagreed on who owns it. Have it rebuilt from the DB on the next sender loop.
+        self.loaded = False
+
+    def step_changed(self, incident_id, plan_id, step):
+        if not self.loaded or not step:
+            return
+        incident = self.track_incident(incident_id, plan_id, step, len(cache.plans[plan_id]['steps']))
+        incident['current_step'] = step
+
+    def get_active_incidents(self, incident_ids):
+        connection = self.db.engine.raw_connection()
+        cursor = connection.cursor()
+        cursor.execute(ACTIVE_INCIDENTS_SQL, [tuple(incident_ids)])
+        active = {row[0] for row in cursor}
+        cursor.close()
+        connection.close()
+        return active
+
+    def purge(self):
+        # Drop incidents that were claimed or otherwise went inactive outside of the sender
+        if not self.incidents:
+            return
+        active = self.get_active_incidents(self.incidents)
+        for incident_id in self.incidents.viewkeys() - active:
+            self.forget_incident(incident_id)
+        metrics.set('escalation_tracked_incidents_cnt', len(self.incidents))
+        metrics.set('escalation_tracked_notifications_cnt', len(self.notifications))
+
+    def fire_due(self, now):
+        due = set()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, incident_id, plan_notification_id = heappop(self.deadlines)
+            key = (incident_id, plan_notification_id)
+            state = self.notifications.get(key)
+            # Entries are superseded rather than removed when a notification gets rescheduled
+            if state is not None and state.deadline == deadline:
+                due.add(key)
+
+        if not due:
+            return
+
+        active = self.get_active_incidents({incident_id for incident_id, _ in due})
+
+        repeats = []
+        escalations = {}
+        deactivations = set()
+        for key in due:
+            incident_id, plan_notification_id = key
+            if incident_id not in active:
+                self.forget_incident(incident_id)
+                continue
+
+            state = self.notifications[key]
+            incident = self.incidents[incident_id]
+
+            if state.count < state.max:
+                repeats.append(key)
+            elif state.step == incident['current_step']:
+                if state.step < incident['step_count']:
+                    escalations[incident_id] = (incident['plan_id'], state.step + 1)
+                else:
+                    deactivations.add(incident_id)
+            else:
+                # Exhausted notification from a step we've already escalated past
+                del self.notifications[key]
+                incident['notifications'].discard(plan_notification_id)
+
+        if repeats:
+            counts = {key: self.notifications[key].count for key in repeats}
+            self.repeat_notifications(repeats)
+            metrics.incr('escalation_repeat_cnt', len(repeats))
+            for key in repeats:
+                state = self.notifications.get(key)
+                if state is not None and state.count == counts[key]:
+                    # Nothing got created, so nothing would schedule it again
+                    state.retry_at = now + self.retry_interval
+                    self.schedule(key)
+                    metrics.incr('escalation_repeat_retry_cnt')
+
+        if escalations:
+            self.escalate_incidents(escalations)
+            metrics.incr('escalation_step_cnt', len(escalations))
+
+        if deactivations:
+            self.deactivate_incidents(deactivations)
+            metrics.incr('escalation_deactivate_cnt', len(deactivations))
+            for incident_id in deactivations:
+                self.forget_incident(incident_id)
+
+    def run(self):
+        while True:
+            if self.deadlines:
+                self.wakeup.wait(max(0, self.deadlines[0][0] - time()))
+            else:
+                self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                self.fire_due(time())
+            except Exception:
+                metrics.incr('task_failure')
+                logger.exception('Failed firing due escalations. Rebuilding state on the next sender loop.')
+                # Due entries were already popped off the heap; have them recovered from the DB
+                self.loaded = False
@@ -0,0 +1,213 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+import os
+import errno
+import msgpack
+from time import time
+from collections import defaultdict, deque
+from itertools import groupby
+from operator import itemgetter
+from gevent import spawn, sleep, get_hub
+from gevent.lock import Semaphore
+from iris import metrics
+from ..utils import msgpack_handle_sets
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENQUEUED = 'e'
+ACKED = 'a'
+WRITE = 'w'
+REMOVE = 'r'
+SEGMENT_SUFFIX = '.journal'
+
+
+class MessageJournal(object):
+    '''
+    Append only on disk record of the messages sitting in the send queues, so a sender that
+    dies doesn't take them along. Every queued message gets an enqueued entry and, once a worker
+    is done with it, an acked entry. Entries are buffered in memory and written and fsynced every
+    sync_interval ms rather than one by one, so a crash can lose at most that much. Entries go to
+    segments of about segment_size bytes. Segments are deleted oldest first, once all messages
+    they and every older segment hold are acked, as acks of messages in older segments may be
+    in them.
+
+    Writing and syncing happen in gevent's threadpool, as an fsync can take long enough on a busy
+    disk to stall every greenlet in the sender were it to run on the hub.
+
+    On startup replay() returns whatever the previous process left unacked. The caller queues
+    those again, which journals them anew, and then calls finish_replay() to drop the old segments.
+    '''
+
+    def __init__(self, path, sync_interval=100, segment_size=64 * 1024 * 1024):
+        self.path = path
+        self.sync_interval = sync_interval / 1000.0
+        self.segment_size = segment_size
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.old_segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(path)
+                                   if name.endswith(SEGMENT_SUFFIX))
+
+        self.next_id = 0
+        self.live = {}  # journal_id: segment holding its enqueued entry
+        self.segment_live = defaultdict(int)  # segment: messages in it that aren't acked yet
+        self.segment = (self.old_segments[-1] if self.old_segments else 0) + 1
+        self.segments = deque([self.segment])  # ours that aren't deleted yet, oldest first
+        self.segment_bytes = 0
+
+        # (WRITE, segment, data) and (REMOVE, segment, None) waiting for the next sync, in order
+        self.pending = []
+        self.sync_lock = Semaphore()
+
+        # Only touched from the threadpool, by one sync at a time
+        self.file = None
+        self.file_segment = None
+
+        metrics.add_new_metrics({'journal_sync': 0, 'journal_live_cnt': 0, 'journal_segment_cnt': 0,
+                                 'journal_replayed_cnt': 0, 'journal_pending_bytes': 0})
+        self.task = spawn(self.run)
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+    def rotate(self):
+        self.segment += 1
+        self.segments.append(self.segment)
+        self.segment_bytes = 0
+        self.remove_acked_segments()
+
+    def remove_acked_segments(self):
+        # The current segment stays, as it's the one being written to
+        while len(self.segments) > 1 and not self.segment_live.get(self.segments[0]):
+            self.remove_segment(self.segments.popleft())
+
+    def remove_segment(self, segment):
+        self.segment_live.pop(segment, None)
+        self.pending.append((REMOVE, segment, None))
+
+    def write(self, entry):
+        data = msgpack.packb(entry, default=msgpack_handle_sets)
+        self.pending.append((WRITE, self.segment, data))
+        self.segment_bytes += len(data)
+        if self.segment_bytes >= self.segment_size:
+            self.rotate()
+
+    def append(self, message):
+        journal_id = self.next_id
+        self.next_id += 1
+        self.live[journal_id] = self.segment
+        self.segment_live[self.segment] += 1
+        self.write((ENQUEUED, journal_id, message))
+        return journal_id
+
+    def ack(self, journal_id):
+        segment = self.live.pop(journal_id, None)
+        if segment is None:
+            return
+        self.write((ACKED, journal_id))
+        self.segment_live[segment] -= 1
+        if not self.segment_live[segment]:
+            self.remove_acked_segments()
+
+    def sync(self):
+        with self.sync_lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, []
+            try:
+                failed_removals = get_hub().threadpool.apply(self.write_pending, (pending,))
+            except Exception:
+                # Try again next time. Entries written twice are harmless to replay.
+                self.pending[:0] = pending
+                raise
+        for segment, error in failed_removals:
+            logger.error('Failed removing journal segment %s: %s', segment, error)
+
+    def write_pending(self, pending):
+        # Runs in the threadpool, so no logging or other greenlet aware calls from here
+        failed_removals = []
+        # One write per run of entries for the same segment, as we'd hold the GIL for as long as
+        # we spend in here between system calls
+        for (op, segment), ops in groupby(pending, itemgetter(0, 1)):
+            if op == WRITE:
+                if segment != self.file_segment:
+                    self.close_file()
+                    self.file = open(self.segment_path(segment), 'ab')
+                    self.file_segment = segment
+                self.file.write(''.join([data for _, _, data in ops]))
+            else:
+                # Whatever got journaled anew needs to be on disk before older segments go
+                if segment == self.file_segment:
+                    self.close_file()
+                elif self.file:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                try:
+                    os.remove(self.segment_path(segment))
+                except OSError as e:
+                    # Never written to, as all its messages got acked within one sync
+                    if e.errno != errno.ENOENT:
+                        failed_removals.append((segment, e))
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return failed_removals
+
+    def close_file(self):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = self.file_segment = None
+
+    def close(self):
+        self.sync()
+        with self.sync_lock:
+            get_hub().threadpool.apply(self.close_file)
+
+    def read_segment(self, segment):
+        unpacker = msgpack.Unpacker()
+        with open(self.segment_path(segment), 'rb') as f:
+            unpacker.feed(f.read())
+        try:
+            for entry in unpacker:
+                yield entry
+        except Exception:
+            # Most likely the tail of a write the previous process died in the middle of
+            logger.warning('Stopped reading journal segment %s at a corrupt entry', segment)
+
+    def replay(self):
+        pending = {}
+        for segment in self.old_segments:
+            for entry in self.read_segment(segment):
+                if entry[0] == ENQUEUED:
+                    pending[entry[1]] = entry[2]
+                elif entry[0] == ACKED:
+                    pending.pop(entry[1], None)
+                self.next_id = max(self.next_id, entry[1] + 1)
+        metrics.set('journal_replayed_cnt', len(pending))
+        logger.info('Replaying %s unacked messages from %s journal segments', len(pending), len(self.old_segments))
+        return [pending[journal_id] for journal_id in sorted(pending)]
+
+    def finish_replay(self):
+        # Whatever was replayed has been journaled again by now
+        for segment in self.old_segments:
+            self.remove_segment(segment)
+        self.old_segments = []
+        self.sync()
+
+    def run(self):
+        while True:
+            sleep(self.sync_interval)
+            start = time()
+            try:
+                self.sync()
+                metrics.set('journal_sync', time() - start)
+            except Exception:
+                metrics.incr('task_failure')
+                logger.exception('Failed syncing message journal')
+            metrics.set('journal_live_cnt', len(self.live))
+            metrics.set('journal_pending_bytes', sum(len(data) for op, _, data in self.pending if op == WRITE))
+            metrics.set('journal_segment_cnt', len(self.segments) + len(self.old_segments))
@@ -4,10 +4,10 @@
 from time import time
 from gevent import spawn, sleep
 from gevent.lock import Semaphore
-from collections import deque
 from datetime import datetime
 import iris.cache
 from iris import metrics
+from iris.sender.rate import RateCounter
 import logging
 import ujson
 
@@ -73,11 +73,12 @@ class ApplicationQuota(object):
         else:
             logger.warning('Iris sender_app not configured so notifications for quota breaches will not work')
 
-        self.rates = {}  # application: (hard_buckets, soft_buckets, hard_limit, soft_limit, wait_time, plan_name, (target_name, target_role))
+        self.rates = {}  # application: (hard_counter, soft_counter, hard_limit, soft_limit, wait_time, plan_name, (target_name, target_role))
         self.last_incidents = {}  # application: (incident_id, time())
         self.last_incidents_mutex = Semaphore()
         self.last_soft_quota_notification_time = {}  # application: time()
         self.last_soft_quota_notification_time_mutex = Semaphore()
+        self.peer_usage = {}  # application: (hard_count, soft_count) sent by the other senders
         metrics.add_new_metrics({'quota_hard_exceed_cnt': 0, 'quota_soft_exceed_cnt': 0})
         spawn(self.refresh)
 
@@ -93,7 +94,7 @@ class ApplicationQuota(object):
             new_rates = {}
 
             for application, hard_limit, soft_limit, hard_duration, soft_duration, target_name, target_role, plan_name, wait_time in self.get_new_rules():
-                new_rates[application] = (hard_limit, soft_limit, hard_duration / 60, soft_duration / 60, wait_time, plan_name, (target_name, target_role))
+                new_rates[application] = (hard_limit, soft_limit, hard_duration, soft_duration, wait_time, plan_name, (target_name, target_role))
 
             old_keys = self.rates.viewkeys()
             new_keys = new_rates.viewkeys()
@@ -107,30 +108,51 @@ class ApplicationQuota(object):
                 except KeyError:
                     pass
 
-            # Create new ones with fresh buckets
+            # Create new ones with fresh counters
             for key in new_keys - old_keys:
                 hard_limit, soft_limit, hard_duration, soft_duration, wait_time, plan_name, target = new_rates[key]
-                self.rates[key] = (deque([0] * hard_duration, maxlen=hard_duration),  # hard buckets
-                                   deque([0] * soft_duration, maxlen=soft_duration),  # soft buckets
+                self.rates[key] = (RateCounter.with_resolution(hard_duration),
+                                   RateCounter.with_resolution(soft_duration),
                                    hard_limit, soft_limit, wait_time, plan_name, target)
 
-            # Update existing ones + append new time interval. Keep same time bucket object if duration hasn't changed, otherwise create new
-            # one and resize accordingly
+            # Update existing ones. Keep the same counter if duration hasn't changed, otherwise
+            # start a new one carrying over the usage so far
+            now = time()
             for key in new_keys & old_keys:
                 hard_limit, soft_limit, hard_duration, soft_duration, wait_time, plan_name, target = new_rates[key]
-                self.rates[key] = (self.rates[key][0] if len(self.rates[key][0]) == hard_duration else deque(self.rates[key][0], maxlen=hard_duration),
-                                   self.rates[key][1] if len(self.rates[key][1]) == soft_duration else deque(self.rates[key][1], maxlen=soft_duration),
+                self.rates[key] = (self.resize_counter(self.rates[key][0], hard_duration, now),
+                                   self.resize_counter(self.rates[key][1], soft_duration, now),
                                    hard_limit, soft_limit, wait_time, plan_name, target)
 
-                # Increase minute interval for hard + soft buckets
-                self.rates[key][0].append(0)
-                self.rates[key][1].append(0)
-
             metrics.add_new_metrics({'app_%s_quota_%s_usage_pct' % (app, quota_type): 0 for quota_type in ('hard', 'soft') for app in new_keys})
 
             logger.info('Refreshed app quotas: %s', ', '.join(new_keys))
             sleep(60)
 
+    def resize_counter(self, counter, duration, now):
+        if counter.window == duration:
+            return counter
+        resized = RateCounter.with_resolution(duration)
+        resized.add(now, counter.count(now))
+        return resized
+
+    def usage(self):
+        '''
+        What we've counted against each application's quota, for the other senders to add to theirs
+        '''
+        now = time()
+        return {application: (rate[0].count(now), rate[1].count(now)) for application, rate in self.rates.iteritems()}
+
+    def set_peer_usage(self, loads):
+        # Senders sharding incidents between them each only see their own share of an
+        # application's messages, so add up what the others last published
+        peer_usage = {}
+        for load in loads.itervalues():
+            for application, (hard_count, soft_count) in load.get('quota', {}).iteritems():
+                peer_hard, peer_soft = peer_usage.get(application, (0, 0))
+                peer_usage[application] = (peer_hard + hard_count, peer_soft + soft_count)
+        self.peer_usage = peer_usage
+
     def allow_send(self, message):
         application = message.get('application')
 
@@ -147,14 +169,16 @@ class ApplicationQuota(object):
         if not rate:
             return True
 
-        hard_buckets, soft_buckets, hard_limit, soft_limit, wait_time, plan_name, target = rate
+        hard_counter, soft_counter, hard_limit, soft_limit, wait_time, plan_name, target = rate
 
-        # Increment both buckets for this minute
-        hard_buckets[-1] += 1
-        soft_buckets[-1] += 1
+        # Count this message against both windows
+        now = time()
+        hard_counter.add(now)
+        soft_counter.add(now)
+        peer_hard_usage, peer_soft_usage = self.peer_usage.get(application, (0, 0))
 
         # If hard limit breached, disallow sending this message and create incident
-        hard_quota_usage = sum(hard_buckets)
+        hard_quota_usage = hard_counter.total + peer_hard_usage
 
         hard_usage_pct = 0
         if hard_limit > 0:
@@ -164,11 +188,11 @@ class ApplicationQuota(object):
         if hard_quota_usage > hard_limit:
             metrics.incr('quota_hard_exceed_cnt')
             with self.last_incidents_mutex:
-                self.notify_incident(application, hard_limit, len(hard_buckets), plan_name, wait_time)
+                self.notify_incident(application, hard_limit, hard_counter.window / 60, plan_name, wait_time)
             return False
 
         # If soft limit breached, just notify owner and still send
-        soft_quota_usage = sum(soft_buckets)
+        soft_quota_usage = soft_counter.total + peer_soft_usage
 
         soft_usage_pct = 0
         if soft_limit > 0:
@@ -178,7 +202,7 @@ class ApplicationQuota(object):
         if soft_quota_usage > soft_limit:
             metrics.incr('quota_soft_exceed_cnt')
             with self.last_soft_quota_notification_time_mutex:
-                self.notify_target(application, soft_limit, len(soft_buckets), *target)
+                self.notify_target(application, soft_limit, soft_counter.window / 60, *target)
             return True
 
         return True
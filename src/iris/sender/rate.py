@@ -0,0 +1,51 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Bucket width the quota and reprioritization windows are tracked at
+DEFAULT_RESOLUTION = 10
+
+
+class RateCounter(object):
+    '''
+    Counts events over a sliding window of `window` seconds, using a ring buffer of fixed
+    resolution buckets and a running total. Adding and reading cost the same however long the
+    window is, and buckets age by the clock rather than by whoever last rotated them.
+    '''
+    __slots__ = ('window', 'resolution', 'buckets', 'total', 'current')
+
+    def __init__(self, window, slots=60):
+        self.window = window
+        window = max(window, 1)
+        slots = max(1, min(slots, int(window)))
+        self.resolution = float(window) / slots
+        self.buckets = [0] * slots
+        self.total = 0
+        self.current = None
+
+    @classmethod
+    def with_resolution(cls, window, resolution=DEFAULT_RESOLUTION):
+        return cls(window, int(window // resolution))
+
+    def advance(self, now):
+        position = int(now // self.resolution)
+        if self.current is None or position - self.current >= len(self.buckets):
+            # The whole window has gone by since we last saw an event
+            self.buckets = [0] * len(self.buckets)
+            self.total = 0
+        elif position > self.current:
+            size = len(self.buckets)
+            for p in xrange(self.current + 1, position + 1):
+                self.total -= self.buckets[p % size]
+                self.buckets[p % size] = 0
+        else:
+            return
+        self.current = position
+
+    def add(self, now, count=1):
+        self.advance(now)
+        self.buckets[self.current % len(self.buckets)] += count
+        self.total += count
+
+    def count(self, now):
+        self.advance(now)
+        return self.total
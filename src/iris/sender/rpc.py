@@ -4,11 +4,15 @@
 from __future__ import absolute_import
 
 import os
-from gevent import Timeout, socket
+import re
+from gevent import Timeout
+from gevent.lock import Semaphore
+from gevent.pool import Pool
 from gevent.server import StreamServer
 import msgpack
-from ..utils import msgpack_unpack_msg_from_socket, sanitize_unicode_dict
+from ..utils import msgpack_handle_sets, sanitize_unicode_dict
 from . import cache
+from .client import MultiplexedConnection, RPCError
 from iris import metrics
 from iris.role_lookup import IrisRoleLookupException
 
@@ -21,34 +25,39 @@ send_funcs = {}
 rpc_timeout = None
 rpc_server = None
 
+# Requests handled at once per persistent connection, and how long one may sit idle
+rpc_max_inflight = 100
+rpc_idle_timeout = 300
 
-def msgpack_handle_sets(obj):
-    if isinstance(obj, set):
-        return list(obj)
+# Persistent connections to the slaves we pass messages to. address: MultiplexedConnection
+slave_connections = {}
+slave_connection_settings = {}
 
 
 def generate_msgpack_message_payload(message):
     return msgpack.packb({'endpoint': 'v0/slave_send', 'data': message}, default=msgpack_handle_sets)
 
 
+def get_slave_connection(address):
+    address = tuple(address)
+    connection = slave_connections.get(address)
+    if connection is None:
+        name = 'slave_%s' % re.sub(r'\W', '_', '%s_%s' % address)
+        connection = slave_connections[address] = MultiplexedConnection(address, name=name, **slave_connection_settings)
+    return connection
+
+
 def send_message_to_slave(message, address):
+    pretty_address = '%s:%s' % tuple(address)
+    message_id = message.get('message_id', '?')
     try:
-        payload = generate_msgpack_message_payload(message)
+        sender_resp = get_slave_connection(address).request('v0/slave_send', message)
     except TypeError:
         logger.exception('Failed encoding message %s as msgpack', message)
         metrics.incr('rpc_message_pass_fail_cnt')
         return False
-
-    pretty_address = '%s:%s' % address
-    message_id = message.get('message_id', '?')
-    try:
-        s = socket.create_connection(address)
-        s.send(payload)
-        sender_resp = msgpack_unpack_msg_from_socket(s)
-        s.close()
-    except socket.error:
-        logging.exception('Failed connecting to %s to send message (ID %s)',
-                          pretty_address, message_id)
+    except RPCError as e:
+        logger.warning('Failed passing message (ID %s) to %s: %s', message_id, pretty_address, e)
         metrics.incr('rpc_message_pass_fail_cnt')
         return False
 
@@ -69,26 +78,26 @@ def reject_api_request(socket, address, err_msg):
     socket.sendall(msgpack.packb(err_msg))
 
 
-def handle_api_notification_request(socket, address, req):
-    notification = req['data']
+def queue_notification(address, notification):
+    '''
+    Validate an out of band notification and queue it for its targets. Returns 'OK', or why it
+    was rejected.
+    '''
     if 'application' not in notification:
-        reject_api_request(socket, address, 'INVALID application')
         logger.warn('Dropping OOB message due to missing application key')
-        return
+        return 'INVALID application'
     notification['subject'] = '[%s] %s' % (notification['application'],
                                            notification.get('subject', ''))
     role = notification.get('role')
     if not role:
-        reject_api_request(socket, address, 'INVALID role')
         logger.warn('Dropping OOB message with invalid role "%s" from app %s',
                     role, notification['application'])
-        return
+        return 'INVALID role'
     target = notification.get('target')
     if not target:
-        reject_api_request(socket, address, 'INVALID target')
         logger.warn('Dropping OOB message with invalid target "%s" from app %s',
                     target, notification['application'])
-        return
+        return 'INVALID target'
     expanded_targets = None
     # if role is literal_target skip unrolling
     if not notification.get('unexpanded'):
@@ -97,10 +106,9 @@ def handle_api_notification_request(socket, address, req):
         except IrisRoleLookupException:
             expanded_targets = None
         if not expanded_targets:
-            reject_api_request(socket, address, 'INVALID role:target')
             logger.warn('Dropping OOB message with invalid role:target "%s:%s" from app %s',
                         role, target, notification['application'])
-            return
+            return 'INVALID role:target'
 
     sanitize_unicode_dict(notification)
 
@@ -110,8 +118,7 @@ def handle_api_notification_request(socket, address, req):
         if 'context' not in notification:
             logger.warn('Dropping OOB message due to missing context from app %s',
                         notification['application'])
-            reject_api_request(socket, address, 'INVALID context')
-            return
+            return 'INVALID context'
         else:
             # fill in dummy iris meta data
             notification['context']['iris'] = {}
@@ -119,13 +126,11 @@ def handle_api_notification_request(socket, address, req):
         if not isinstance(notification['email_html'], basestring):
             logger.warn('Dropping OOB message with invalid email_html from app %s: %s',
                         notification['application'], notification['email_html'])
-            reject_api_request(socket, address, 'INVALID email_html')
-            return
+            return 'INVALID email_html'
     elif 'body' not in notification:
-        reject_api_request(socket, address, 'INVALID body')
         logger.warn('Dropping OOB message with invalid body from app %s',
                     notification['application'])
-        return
+        return 'INVALID body'
 
     access_logger.info('-> %s OK, to %s:%s (%s:%s)',
                        address, role, target, notification['application'],
@@ -140,9 +145,25 @@ def handle_api_notification_request(socket, address, req):
             temp_notification['target'] = _target
             send_funcs['message_send_enqueue'](temp_notification)
     metrics.incr('notification_cnt')
+    return 'OK'
+
+
+def handle_api_notification_request(socket, address, req):
+    response = queue_notification(address, req['data'])
+    if response != 'OK':
+        reject_api_request(socket, address, response)
+        return
     socket.sendall(msgpack.packb('OK'))
 
 
+def handle_api_notification_batch_request(socket, address, req):
+    notifications = req['data']
+    if not isinstance(notifications, list) or not all(isinstance(n, dict) for n in notifications):
+        reject_api_request(socket, address, 'INVALID batch')
+        return
+    socket.sendall(msgpack.packb([queue_notification(address, notification) for notification in notifications]))
+
+
 def handle_slave_send(socket, address, req):
     message = req['data']
     message_id = message.get('message_id', '?')
@@ -162,34 +183,153 @@ def handle_slave_send(socket, address, req):
     socket.sendall(msgpack.packb(response))
 
 
+def handle_new_incident(socket, address, req):
+    incident_id = req['data'].get('incident_id')
+    if not isinstance(incident_id, (int, long)):
+        reject_api_request(socket, address, 'INVALID incident_id')
+        return
+
+    if send_funcs['escalate_new_incident'](incident_id, bool(req['data'].get('forwarded'))):
+        response = 'OK'
+        access_logger.info('-> %s OK, escalating new incident %s', address, incident_id)
+    else:
+        response = 'NOT MASTER'
+        access_logger.info('-> %s not owner, ignoring new incident %s', address, incident_id)
+
+    socket.sendall(msgpack.packb(response))
+
+
+def handle_invalidate_contacts(socket, address, req):
+    users = req['data'].get('users') or []
+    applications = req['data'].get('applications') or []
+    if not isinstance(users, list) or not isinstance(applications, list):
+        reject_api_request(socket, address, 'INVALID users or applications')
+        return
+
+    send_funcs['invalidate_contacts'](users, applications)
+    access_logger.info('-> %s OK, reloaded contacts of %s users and %s applications',
+                       address, len(users), len(applications))
+    socket.sendall(msgpack.packb('OK'))
+
+
+def handle_incidents_claimed(socket, address, req):
+    incident_ids = req['data'].get('incident_ids')
+    if not isinstance(incident_ids, list):
+        reject_api_request(socket, address, 'INVALID incident_ids')
+        return
+
+    send_funcs['drop_claimed_incidents'](incident_ids, bool(req['data'].get('forwarded')))
+    access_logger.info('-> %s OK, dropped queued messages of %s claimed incidents', address, len(incident_ids))
+    socket.sendall(msgpack.packb('OK'))
+
+
+def handle_ping(socket, address, req):
+    socket.sendall(msgpack.packb('OK'))
+
+
 api_request_handlers = {
     'v0/send': handle_api_notification_request,
-    'v0/slave_send': handle_slave_send
+    'v0/send_batch': handle_api_notification_batch_request,
+    'v0/slave_send': handle_slave_send,
+    'v0/new_incident': handle_new_incident,
+    'v0/invalidate_contacts': handle_invalidate_contacts,
+    'v0/incidents_claimed': handle_incidents_claimed,
+    'v0/ping': handle_ping
 }
 
 
-def handle_api_request(socket, address):
+class TaggedResponses(object):
+    '''
+    Stands in for the socket of a persistent connection when handling one of its requests,
+    framing the response as [request id, response] so the client can match it up.
+    '''
+
+    def __init__(self, socket, request_id, write_lock):
+        self.socket = socket
+        self.request_id = request_id
+        self.write_lock = write_lock
+
+    def sendall(self, payload):
+        with self.write_lock:
+            self.socket.sendall(msgpack.packb([self.request_id, payload]))
+
+
+def read_request(socket, unpacker):
+    while True:
+        try:
+            return unpacker.next()
+        except StopIteration:
+            pass
+        buf = socket.recv(4096)
+        if not buf:
+            return None
+        unpacker.feed(buf)
+
+
+def handle_request(socket, address, req):
+    access_logger.info('%s %s', address, req['endpoint'])
+    handler = api_request_handlers.get(req['endpoint'])
+    if handler is not None:
+        handler(socket, address, req)
+    else:
+        logger.info('-> %s unknown request', address)
+        socket.sendall(msgpack.packb('UNKNOWN'))
+
+
+def handle_tagged_request(socket, address, req, write_lock):
     metrics.incr('api_request_cnt')
+    responses = TaggedResponses(socket, req['id'], write_lock)
+    timeout = Timeout.start_new(rpc_timeout)
+    try:
+        handle_request(responses, address, req)
+    except Timeout:
+        metrics.incr('api_request_timeout_cnt')
+        logger.warning('-> %s timeout', address)
+        responses.sendall(msgpack.packb('TIMEOUT'))
+    except EnvironmentError:
+        logger.warning('-> %s connection lost before responding', address)
+    finally:
+        timeout.cancel()
+
+
+def serve_connection(socket, address, unpacker, req):
+    # Requests carrying an id keep the connection open for more of them. They're handled
+    # concurrently, up to rpc_max_inflight at a time, and answered in whatever order they finish.
+    write_lock = Semaphore()
+    pool = Pool(rpc_max_inflight)
+    try:
+        while req:
+            pool.spawn(handle_tagged_request, socket, address, req, write_lock)
+            req = None
+            with Timeout(rpc_idle_timeout, False):
+                req = read_request(socket, unpacker)
+    except EnvironmentError:
+        logger.info('-> %s connection lost', address)
+    pool.join()
+
+
+def handle_api_request(socket, address):
+    unpacker = msgpack.Unpacker()
+    req = None
     timeout = Timeout.start_new(rpc_timeout)
     try:
-        req = msgpack_unpack_msg_from_socket(socket)
+        req = read_request(socket, unpacker)
         if not req:
+            metrics.incr('api_request_cnt')
             logger.warning('Couldn\'t get msgpack data from %s', address)
-            socket.close()
-            return
-        access_logger.info('%s %s', address, req['endpoint'])
-        handler = api_request_handlers.get(req['endpoint'])
-        if handler is not None:
-            handler(socket, address, req)
-        else:
-            logger.info('-> %s unknown request', address)
-            socket.sendall(msgpack.packb('UNKNOWN'))
+        elif 'id' not in req:
+            metrics.incr('api_request_cnt')
+            handle_request(socket, address, req)
     except Timeout:
+        metrics.incr('api_request_cnt')
         metrics.incr('api_request_timeout_cnt')
         logger.warning('-> %s timeout', address)
         socket.sendall(msgpack.packb('TIMEOUT'))
     finally:
         timeout.cancel()
+
+    if req and 'id' in req:
+        serve_connection(socket, address, unpacker, req)
     socket.close()
 
 
@@ -213,10 +353,13 @@ def shutdown():
 
 
 def init(sender_config, _send_funcs):
-    global rpc_timeout
+    global rpc_timeout, rpc_max_inflight, rpc_idle_timeout
 
     send_funcs.update(_send_funcs)
 
+    rpc_max_inflight = sender_config.get('rpc_max_inflight', rpc_max_inflight)
+    rpc_idle_timeout = sender_config.get('rpc_idle_timeout', rpc_idle_timeout)
+
     default_rpc_timeout = 20
     try:
         rpc_timeout = int(sender_config.get('rpc_timeout', default_rpc_timeout))
@@ -225,6 +368,12 @@ def init(sender_config, _send_funcs):
         rpc_timeout = default_rpc_timeout
     logger.info('RPC timeout is set to %s seconds', rpc_timeout)
 
+    slave_connection_settings.update({
+        'max_inflight': rpc_max_inflight,
+        'timeout': rpc_timeout,
+        'health_check_interval': sender_config.get('rpc_health_check_interval', 10)
+    })
+
     access_log_cfg = {
         'filename': './access.log',
         'mode': 'a',
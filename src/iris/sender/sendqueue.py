@@ -0,0 +1,167 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from collections import deque
+from time import time
+from gevent.lock import Semaphore
+from gevent.queue import Empty
+
+# Most urgent first. Messages without a (known) priority, such as quota breach
+# notifications, go in the medium lane.
+LANES = ('urgent', 'high', 'medium', 'low')
+DEFAULT_LANE = 'medium'
+
+# Keeps a zero or negative weight from stalling the round robin
+MIN_WEIGHT = 0.01
+
+
+class FairLane(object):
+    '''
+    FIFO per application, served deficit round robin: on its turn an application gets its weight
+    worth of messages (1 by default) before the next application with queued messages is up.
+    '''
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.queues = {}  # application: deque of (enqueued, message)
+        self.active = deque()  # applications with queued messages, in round robin order
+        self.deficits = {}  # application: messages it may still send this turn
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, item):
+        application = item[1].get('application')
+        app_queue = self.queues.get(application)
+        if app_queue is None:
+            app_queue = self.queues[application] = deque()
+            self.deficits[application] = 0
+            self.active.append(application)
+        app_queue.append(item)
+        self.size += 1
+
+    def oldest(self):
+        return min(app_queue[0][0] for app_queue in self.queues.itervalues())
+
+    def popleft(self):
+        while True:
+            application = self.active[0]
+            if self.deficits[application] < 1:
+                self.deficits[application] += self.weights.get(application, 1)
+                if self.deficits[application] < 1:
+                    self.active.rotate(-1)
+                    continue
+
+            app_queue = self.queues[application]
+            item = app_queue.popleft()
+            self.size -= 1
+            self.deficits[application] -= 1
+            if not app_queue:
+                del self.queues[application]
+                del self.deficits[application]
+                self.active.popleft()
+            elif self.deficits[application] < 1:
+                self.active.rotate(-1)
+            return item
+
+
+class PrioritySendQueue(object):
+    '''
+    Drop in for the gevent queue of a mode, with a lane per priority. get() takes from the
+    most urgent lane that has messages, except that messages in lower lanes move up a lane
+    for every aging_interval seconds they've waited, so they can't be starved. Aging never
+    moves anything ahead of the urgent lane. Within a lane applications take turns, so one
+    flooding application can't hold up the others.
+    '''
+
+    def __init__(self, aging_interval=30, application_weights=None):
+        self.aging_interval = aging_interval
+        weights = {application: max(float(weight), MIN_WEIGHT)
+                   for application, weight in (application_weights or {}).iteritems()}
+        self.lanes = [FairLane(weights) for _ in LANES]
+        self.ranks = {lane: rank for rank, lane in enumerate(LANES)}
+        self.waits = [0] * len(LANES)  # longest wait of messages taken off each lane since last stats()
+        self.app_waits = {}  # longest wait of messages taken off for each application since last stats()
+        self.available = Semaphore(0)
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return not any(len(lane) for lane in self.lanes)
+
+    def put(self, message, block=True, timeout=None):
+        rank = self.ranks.get(message.get('priority'), self.ranks[DEFAULT_LANE])
+        self.lanes[rank].append((time(), message))
+        self.available.release()
+
+    def put_nowait(self, message):
+        self.put(message, False)
+
+    def next_rank(self, now):
+        best = None
+        for rank, lane in enumerate(self.lanes):
+            if not lane:
+                continue
+            waited = now - lane.oldest()
+            effective = rank
+            if rank > 0:
+                effective = max(1, rank - int(waited // self.aging_interval))
+            # on ties the message that waited longest goes first
+            candidate = (effective, -waited, rank)
+            if best is None or candidate < best:
+                best = candidate
+        return best[2]
+
+    def get(self, block=True, timeout=None):
+        if not self.available.acquire(blocking=block, timeout=timeout if block else None):
+            raise Empty
+        now = time()
+        rank = self.next_rank(now)
+        enqueued, message = self.lanes[rank].popleft()
+        waited = now - enqueued
+        self.waits[rank] = max(self.waits[rank], waited)
+        application = message.get('application')
+        self.app_waits[application] = max(self.app_waits.get(application, 0), waited)
+        return message
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def oldest_wait(self):
+        '''
+        How long the message that has been queued the longest has been waiting
+        '''
+        now = time()
+        return max([now - lane.oldest() for lane in self.lanes if lane] or [0])
+
+    def stats(self):
+        '''
+        Return {lane: (depth, longest wait since the last call)}
+        '''
+        now = time()
+        stats = {}
+        for rank, lane_name in enumerate(LANES):
+            lane = self.lanes[rank]
+            # count messages still waiting too, or a stuck lane would look idle
+            waited = now - lane.oldest() if lane else 0
+            stats[lane_name] = (len(lane), max(self.waits[rank], waited))
+            self.waits[rank] = 0
+        return stats
+
+    def application_stats(self):
+        '''
+        Return {application: (depth, longest wait since the last call)}
+        '''
+        now = time()
+        stats = {application: (0, waited) for application, waited in self.app_waits.iteritems()}
+        for lane in self.lanes:
+            for application, app_queue in lane.queues.iteritems():
+                depth, waited = stats.get(application, (0, 0))
+                stats[application] = (depth + len(app_queue), max(waited, now - app_queue[0][0]))
+        self.app_waits = {}
+        return stats
@@ -9,6 +9,10 @@ logger = logging.getLogger(__name__)
 # queue for sending messages. mode -> gevent queue
 per_mode_send_queues = {}
 
+# mode -> moving average of how long vendors took to send a message
+mode_latencies = {}
+LATENCY_DECAY = 0.1
+
 
 def add_mode_stat(mode, runtime):
     try:
@@ -17,6 +21,8 @@ def add_mode_stat(mode, runtime):
             stats[mode + '_fail'] += 1
         else:
             stats[mode + '_total'] += runtime
+            latency = mode_latencies.get(mode)
+            mode_latencies[mode] = runtime if latency is None else latency + LATENCY_DECAY * (runtime - latency)
             stats[mode + '_sent'] += 1
             if runtime > stats[mode + '_max']:
                 stats[mode + '_max'] = runtime
@@ -0,0 +1,181 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Child processes that render and send messages for one mode, so the CPU they burn doesn't hold
+# up the sender's main loop. The sender keeps the send queues, quotas, journal and DB updates,
+# and hands each message to a child over a unix socket.
+
+from __future__ import absolute_import
+
+from datetime import datetime
+from itertools import count
+import os
+import sys
+from gevent import spawn, sleep, socket, subprocess, Timeout
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+import msgpack
+
+import logging
+logger = logging.getLogger(__name__)
+
+DATETIME_EXT = 1
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Longest a message may take to render and send before we give up on the child
+DELIVER_TIMEOUT = 300
+
+
+class WorkerProcessError(Exception):
+    pass
+
+
+def encode(obj):
+    # Incident context carries datetimes from the DB, which templates may format
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(DATETIME_EXT, obj.strftime(DATETIME_FORMAT))
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError('Cannot encode %r' % obj)
+
+
+def decode_ext(code, data):
+    if code == DATETIME_EXT:
+        return datetime.strptime(data, DATETIME_FORMAT)
+    return msgpack.ExtType(code, data)
+
+
+class Channel(object):
+    '''
+    Stream of msgpack frames over a unix socket. Byte and unicode strings both come out the
+    other end as they went in.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.write_lock = Semaphore()
+        self.unpacker = msgpack.Unpacker(encoding='utf-8', ext_hook=decode_ext)
+
+    def send(self, *frame):
+        payload = msgpack.packb(frame, default=encode, use_bin_type=True)
+        with self.write_lock:
+            self.sock.sendall(payload)
+
+    def __iter__(self):
+        while True:
+            for frame in self.unpacker:
+                yield frame
+            buf = self.sock.recv(65536)
+            if not buf:
+                return
+            self.unpacker.feed(buf)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class WorkerProcess(object):
+    '''
+    Parent side of one child process sending messages of a mode. The child runs `concurrency`
+    send workers of its own; any number of greenlets here can hand it messages at once with
+    deliver(). Counters the child bumps are passed to on_stats every few seconds.
+    '''
+
+    def __init__(self, mode, config, concurrency, on_stats=None, timeout=DELIVER_TIMEOUT):
+        self.mode = mode
+        self.config = config
+        self.concurrency = concurrency
+        self.on_stats = on_stats
+        self.timeout = timeout
+        self.process = None
+        self.channel = None
+        self.pending = {}  # request id: AsyncResult
+        self.ids = count()
+
+    def alive(self):
+        return self.channel is not None and self.process is not None and self.process.poll() is None
+
+    def start(self):
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        env = dict(os.environ)
+        env.pop('SENDER_PIDFILE', None)
+        # The child talks to us over its stdin
+        self.process = subprocess.Popen([sys.executable, '-m', 'iris.bin.sender', '--worker-process'],
+                                        stdin=child_sock, env=env, close_fds=True)
+        child_sock.close()
+        channel = self.channel = Channel(parent_sock)
+        logger.info('Started %s worker process %s with %s workers', self.mode, self.process.pid, self.concurrency)
+        try:
+            channel.send('init', self.mode, self.config, self.concurrency)
+        except socket.error as e:
+            self.disconnect(channel, str(e))
+            return
+        spawn(self.read_results, channel)
+
+    def disconnect(self, channel, reason):
+        if channel is not self.channel:
+            return
+        self.channel = None
+        logger.warning('Lost %s worker process %s: %s', self.mode, self.process.pid, reason)
+        channel.close()
+        pending, self.pending = self.pending, {}
+        for result in pending.itervalues():
+            result.set_exception(WorkerProcessError(reason))
+
+    def read_results(self, channel):
+        reason = 'connection closed'
+        try:
+            for frame in channel:
+                if frame[0] == 'result':
+                    _, request_id, result, message = frame
+                    pending = self.pending.pop(request_id, None)
+                    if pending is not None:
+                        pending.set((result, message))
+                elif frame[0] == 'stats' and self.on_stats:
+                    self.on_stats(self.mode, *frame[1:])
+        except Exception as e:
+            logger.exception('Failed reading from %s worker process', self.mode)
+            reason = str(e)
+        self.disconnect(channel, reason)
+
+    def deliver(self, message, slaves):
+        '''
+        Have the child render and send this message, through one of these slaves or itself.
+        Returns what it got back from deliver_message, along with the message as the child
+        left it.
+        '''
+        channel = self.channel
+        if channel is None:
+            raise WorkerProcessError('%s worker process is not running' % self.mode)
+        request_id = next(self.ids)
+        result = self.pending[request_id] = AsyncResult()
+        try:
+            channel.send('send', request_id, message, slaves)
+        except TypeError as e:
+            self.pending.pop(request_id, None)
+            raise WorkerProcessError('failed encoding message: %s' % e)
+        except socket.error as e:
+            self.disconnect(channel, str(e))
+            raise WorkerProcessError(str(e))
+        try:
+            return result.get(timeout=self.timeout)
+        except Timeout:
+            self.pending.pop(request_id, None)
+            raise WorkerProcessError('timed out after %ss' % self.timeout)
+
+    def stop(self, timeout=10):
+        # Hanging up tells the child to finish up and exit
+        if self.channel is not None:
+            self.disconnect(self.channel, 'shutting down')
+        process = self.process
+        if process is None:
+            return
+        for _ in xrange(timeout * 10):
+            if process.poll() is not None:
+                return
+            sleep(.1)
+        logger.warning('Killing %s worker process %s', self.mode, process.pid)
+        process.kill()
@@ -0,0 +1,195 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from time import time
+from gevent import spawn, sleep
+from gevent.event import Event
+from pymysql import DataError, IntegrityError
+from iris import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# UPDATE ... JOIN against a derived table of the per message values, as INSERT ... ON DUPLICATE KEY
+# UPDATE trips over the NOT NULL columns of `message` we don't have at hand
+SENT_MESSAGES_SQL = '''UPDATE `message`
+JOIN (%s) AS `sent_message` ON `message`.`id` = `sent_message`.`id`
+SET `message`.`destination` = `sent_message`.`destination`,
+    `message`.`mode_id` = `sent_message`.`mode_id`,
+    `message`.`template_id` = `sent_message`.`template_id`,
+    `message`.`batch` = IFNULL(`sent_message`.`batch`, `message`.`batch`),
+    `message`.`active` = FALSE,
+    `message`.`sent` = FROM_UNIXTIME(`sent_message`.`sent`)'''
+
+SENT_MESSAGE_ROW = '''SELECT %s AS `id`, %s AS `destination`, %s AS `mode_id`, %s AS `template_id`,
+       %s AS `batch`, %s AS `sent`'''
+
+MESSAGE_BODIES_SQL = '''UPDATE `message`
+JOIN (%s) AS `message_body` ON `message`.`id` = `message_body`.`id`
+SET `message`.`body` = `message_body`.`body`,
+    `message`.`subject` = `message_body`.`subject`'''
+
+MESSAGE_BODY_ROW = '''SELECT %s AS `id`, %s AS `body`, %s AS `subject`'''
+
+SENT_STATUS_SQL = '''INSERT INTO `generic_message_sent_status` (`message_id`, `status`)
+VALUES %s
+ON DUPLICATE KEY UPDATE `status` = VALUES(`status`)'''
+
+
+class MessageWriteback(object):
+    '''
+    Collects the updates workers make to messages once they're sent and writes them to the DB
+    in bulk, every flush_interval ms or as soon as batch_size messages are pending. Workers block
+    once max_pending messages are waiting to be written, rather than us dropping updates.
+
+    Messages stay unwritten() until their sent state is committed, retrying failed writes on the
+    next flush, so the sender knows not to queue them up again in the meantime.
+    '''
+
+    def __init__(self, db, flush_interval=500, batch_size=500, max_pending=10000):
+        self.db = db
+        self.flush_interval = flush_interval / 1000.0
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+
+        self.sent = {}  # message_id: (destination, mode_id, template_id, batch, sent)
+        self.writing = {}  # message_id: sent state of the ones being flushed right now
+        self.bodies = {}  # message_id: (body, subject)
+        self.statuses = {}  # message_id: status
+        self.flush_now = Event()
+        self.drained = Event()
+        self.drained.set()
+
+        metrics.add_new_metrics({'message_writeback_pending': 0, 'message_writeback_flush': 0,
+                                 'message_writeback_flush_cnt': 0, 'message_writeback_fail_cnt': 0,
+                                 'message_writeback_blocked_cnt': 0})
+        spawn(self.run)
+
+    def pending(self):
+        return len(self.sent.viewkeys() | self.bodies.viewkeys() | self.statuses.viewkeys())
+
+    def unwritten(self):
+        return self.sent.viewkeys() | self.writing.viewkeys()
+
+    def wait_for_room(self):
+        while self.pending() >= self.max_pending:
+            metrics.incr('message_writeback_blocked_cnt')
+            self.drained.clear()
+            self.flush_now.set()
+            self.drained.wait()
+
+    def queued(self):
+        if self.pending() >= self.batch_size:
+            self.flush_now.set()
+
+    def mark_sent(self, message_ids, destination, mode_id, template_id, batch_id, subject, body):
+        self.wait_for_room()
+        now = time()
+        for message_id in message_ids:
+            self.sent[message_id] = (destination, mode_id, template_id, batch_id, now)
+            self.bodies[message_id] = (body, subject)
+        self.queued()
+
+    def set_sent_status(self, message_id, status):
+        self.wait_for_room()
+        self.statuses[message_id] = status
+        self.queued()
+
+    def execute(self, description, sql, params):
+        connection = self.db.engine.raw_connection()
+        cursor = connection.cursor()
+        max_retries = 3
+
+        # this deadlocks sometimes. retry the whole batch until it doesn't.
+        try:
+            for i in xrange(1, max_retries + 1):
+                try:
+                    cursor.execute(sql, params)
+                    connection.commit()
+                    return True
+                except (DataError, IntegrityError):
+                    # no use retrying these; None tells them apart from the DB being unavailable
+                    logger.exception('Failed writing %s', description)
+                    return None
+                except Exception:
+                    if i == max_retries:
+                        logger.exception('Failed writing %s. (Try %s/%s)', description, i, max_retries)
+                    else:
+                        logger.warn('Failed writing %s. (Try %s/%s)', description, i, max_retries)
+                        sleep(.2)
+            return False
+        finally:
+            cursor.close()
+            connection.close()
+
+    def chunks(self, rows):
+        for i in xrange(0, len(rows), self.batch_size):
+            yield rows[i:i + self.batch_size]
+
+    def write_sent(self, rows):
+        # returns the rows we failed writing
+        written = self.execute('sent state of %s messages' % len(rows),
+                               SENT_MESSAGES_SQL % ' UNION ALL '.join([SENT_MESSAGE_ROW] * len(rows)),
+                               [field for row in rows for field in row])
+        if written:
+            return []
+        if written is None and len(rows) > 1:
+            # so one bad row doesn't hold back the rest of its batch for good
+            return [row for row in rows if self.write_sent([row])]
+        return rows
+
+    def flush(self):
+        # swap buffers before touching the DB, so workers keep queueing into fresh ones
+        sent, self.sent = self.sent, {}
+        self.writing.update(sent)
+        bodies, self.bodies = self.bodies, {}
+        statuses, self.statuses = self.statuses, {}
+        self.drained.set()
+
+        if not (sent or bodies or statuses):
+            return
+
+        start = time()
+        failed = 0
+
+        try:
+            for rows in self.chunks([(message_id,) + row for message_id, row in sent.iteritems()]):
+                unwritten = self.write_sent(rows)
+                failed += len(unwritten)
+                for row in rows:
+                    self.writing.pop(row[0], None)
+                # keep these around to try again next time, rather than have them sent again
+                for row in unwritten:
+                    self.sent.setdefault(row[0], row[1:])
+        finally:
+            for message_id in sent:
+                if message_id in self.writing:
+                    self.sent.setdefault(message_id, self.writing.pop(message_id))
+
+        # Written separately, as they may fail and we don't necessarily care if they do
+        for rows in self.chunks([(message_id,) + row for message_id, row in bodies.iteritems()]):
+            if not self.execute('body+subject of %s messages' % len(rows),
+                                MESSAGE_BODIES_SQL % ' UNION ALL '.join([MESSAGE_BODY_ROW] * len(rows)),
+                                [field for row in rows for field in row]):
+                failed += len(rows)
+
+        for rows in self.chunks(statuses.items()):
+            if not self.execute('sent status of %s messages' % len(rows),
+                                SENT_STATUS_SQL % ', '.join(['(%s, %s)'] * len(rows)),
+                                [field for row in rows for field in row]):
+                failed += len(rows)
+
+        metrics.incr('message_writeback_flush_cnt')
+        metrics.incr('message_writeback_fail_cnt', failed)
+        metrics.set('message_writeback_flush', time() - start)
+
+    def run(self):
+        while True:
+            self.flush_now.wait(self.flush_interval)
+            self.flush_now.clear()
+            metrics.set('message_writeback_pending', self.pending())
+            try:
+                self.flush()
+            except Exception:
+                metrics.incr('task_failure')
+                logger.exception('Failed flushing message updates')
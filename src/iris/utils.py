@@ -312,6 +312,11 @@ def claim_incidents_from_batch_id(batch_id, owner):
     connection.close()
 
 
+def msgpack_handle_sets(obj):
+    if isinstance(obj, set):
+        return list(obj)
+
+
 def msgpack_unpack_msg_from_socket(socket):
     unpacker = msgpack.Unpacker()
     while True:
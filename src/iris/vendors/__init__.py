@@ -2,24 +2,114 @@
 # See LICENSE in the project root for license information.
 
 from iris.custom_import import import_custom_module
+from iris import metrics
 from collections import defaultdict
 import logging
-import itertools
 import random
 import copy
+import re
+import time
 logger = logging.getLogger(__name__)
 
+# Health of each vendor per mode, shared by the vendor managers of every worker in the process.
+# (vendor name, mode): VendorHealth
+vendor_health = {}
+
 
 class IrisVendorException(Exception):
     pass
 
 
+class VendorHealth(object):
+    '''
+    How sending a mode through a vendor has been going lately: moving averages of its latency
+    and error rate, weighting recent sends by alpha, and a circuit breaker. After
+    failure_threshold failures in a row the circuit opens and the vendor is left out. Once
+    open_timeout seconds have passed it goes half-open, letting one message through at a time
+    to probe it, and the first success closes it again.
+    '''
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, name, mode, alpha=0.2, failure_threshold=5, open_timeout=30):
+        self.name = '%s (%s)' % (name, mode)
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.probing = False
+
+        self.metric_prefix = 'vendor_%s_%s_' % (re.sub(r'\W', '_', name), mode)
+        metrics.add_new_metrics({self.metric_prefix + key: 0 for key in
+                                 ('latency', 'error_rate', 'circuit_state', 'ejected_cnt')})
+
+    def available(self, now):
+        if self.state == self.OPEN and now - self.opened_at >= self.open_timeout:
+            self.state = self.HALF_OPEN
+            self.report()
+        if self.state == self.HALF_OPEN:
+            return not self.probing
+        return self.state == self.CLOSED
+
+    def score(self):
+        # Expected time spent per successful send. Untried vendors come first, so they get some
+        # traffic to measure
+        return (self.latency or 0) / max(1 - self.error_rate, 0.05)
+
+    def started(self):
+        if self.state != self.CLOSED:
+            self.probing = True
+
+    def succeeded(self, latency):
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.error_rate = (1 - self.alpha) * self.error_rate
+        self.failures = 0
+        self.probing = False
+        if self.state != self.CLOSED:
+            logger.info('Closing circuit of %s, which is sending again', self.name)
+            self.state = self.CLOSED
+        self.report()
+
+    def failed(self, now):
+        self.error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            logger.warning('Opening circuit of %s after %s failures in a row', self.name, self.failures)
+            self.state = self.OPEN
+            self.opened_at = now
+            metrics.incr(self.metric_prefix + 'ejected_cnt')
+        self.report()
+
+    def report(self):
+        metrics.set(self.metric_prefix + 'latency', self.latency or 0)
+        metrics.set(self.metric_prefix + 'error_rate', self.error_rate)
+        metrics.set(self.metric_prefix + 'circuit_state', self.state)
+
+
+def get_vendor_health(vendor_config, mode):
+    name = vendor_config.get('name', vendor_config['type'])
+    health = vendor_health.get((name, mode))
+    if health is None:
+        health = vendor_health[(name, mode)] = VendorHealth(name, mode,
+                                                            vendor_config.get('latency_ewma_alpha', 0.2),
+                                                            vendor_config.get('circuit_failure_threshold', 5),
+                                                            vendor_config.get('circuit_open_timeout', 30))
+    return health
+
+
 class IrisVendorManager():
 
     def __init__(self, vendors, application_vendors):
         self.max_tries_per_message = 5
-        self.vendors_iter = {}
-        self.app_specific_vendors_iter = defaultdict(dict)
+        self.mode_vendors = {}  # mode: [(vendor, health)]
+        self.app_specific_vendors = defaultdict(dict)  # application: mode: [(vendor, health)]
         self.all_vendor_instances = []
 
         applications = {}
@@ -43,31 +133,56 @@ class IrisVendorManager():
             vendor_cls = import_custom_module('iris.vendors', vendor_config['type'])
             for mode in vendor_cls.supports:
                 vendor_instance = vendor_cls(copy.deepcopy(vendor_config))
-                vendor_instances[mode].append(vendor_instance)
+                health = get_vendor_health(vendor_config, mode)
+                vendor_instances[mode].append((vendor_instance, health))
+                self.all_vendor_instances.append(vendor_instance)
                 for application_name, application_cls in applications.iteritems():
-                    app_vendor_instances[application_name][mode].append(application_cls(vendor_instance))
-
-        for mode, instances in vendor_instances.iteritems():
-            random.shuffle(instances)
-            self.all_vendor_instances += instances
-            self.vendors_iter[mode] = itertools.cycle(instances)
+                    app_vendor_instances[application_name][mode].append((application_cls(vendor_instance), health))
 
+        self.mode_vendors = dict(vendor_instances)
         for application_name, modes in app_vendor_instances.iteritems():
-            for mode_name, instances in modes.iteritems():
-                random.shuffle(instances)
-                self.app_specific_vendors_iter[application_name][mode_name] = itertools.cycle(instances)
+            self.app_specific_vendors[application_name] = dict(modes)
+
+    def pick_vendor(self, candidates, tried):
+        '''
+        Pick which of these (vendor, health) to try next: of two random ones with their circuit
+        closed, and not tried yet for this message if we can help it, the one with the lower
+        expected cost. If every circuit is open, the one that opened first.
+
+        The two are drawn with replacement, so that with just two vendors the slower one still
+        gets a share of messages (a quarter), keeping its latency current and spreading load.
+        '''
+        now = time.time()
+        available = [candidate for candidate in candidates if candidate[1].available(now)]
+        if not available:
+            return min(candidates, key=lambda candidate: candidate[1].opened_at)
+        untried = [candidate for candidate in available if candidate[0] not in tried] or available
+        return min(random.choice(untried), random.choice(untried), key=lambda candidate: candidate[1].score())
 
     def send_message(self, message):
-        for tries, vendor in enumerate(self.app_specific_vendors_iter.get(message.get('application'), self.vendors_iter)[message['mode']]):
-            if tries > self.max_tries_per_message:
-                logger.warning('Exhausted %d tries for message %s', tries, message)
-                break
-            logger.debug('Attempting %s send using vendor %s', message['mode'], vendor)
-            try:
-                return vendor.send(message)
-            except Exception:
-                logger.exception('Sending %s with vendor %s failed', message, vendor)
-                continue
+        candidates = self.app_specific_vendors.get(message.get('application'), self.mode_vendors).get(message['mode'])
+        if candidates:
+            tried = set()
+            for tries in xrange(self.max_tries_per_message + 1):
+                vendor, health = self.pick_vendor(candidates, tried)
+                tried.add(vendor)
+                logger.debug('Attempting %s send using vendor %s', message['mode'], vendor)
+                health.started()
+                try:
+                    runtime = vendor.send(message)
+                except Exception:
+                    logger.exception('Sending %s with vendor %s failed', message, vendor)
+                    health.failed(time.time())
+                    continue
+                # Vendors return None for sends that failed without raising, which the sender retries
+                if runtime is None:
+                    health.failed(time.time())
+                else:
+                    # What the vendor says it took, which leaves out time spent holding the
+                    # message for rate limits
+                    health.succeeded(runtime)
+                return runtime
+            logger.warning('Exhausted %d tries for message %s', self.max_tries_per_message + 1, message)
 
         raise IrisVendorException('All %s vendors failed for %s' % (message['mode'], message))
 
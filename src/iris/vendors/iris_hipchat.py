@@ -2,9 +2,9 @@
 # See LICENSE in the project root for license information.
 
 import logging
-import requests
 import time
 from iris.constants import HIPCHAT_SUPPORT
+from iris.vendors.session import get_session, release_session
 
 logger = logging.getLogger(__name__)
 
@@ -17,17 +17,12 @@ class iris_hipchat(object):
         self.modes = {
             'hipchat': self.send_message
         }
-        self.proxy = None
-        if 'proxy' in self.config:
-            host = self.config['proxy']['host']
-            port = self.config['proxy']['port']
-            self.proxy = {'http': 'http://%s:%s' % (host, port),
-                          'https': 'https://%s:%s' % (host, port)}
         self.token = self.config.get('auth_token')
         self.room_id = int(self.config.get('room_id'))
         self.debug = self.config.get('debug')
         self.endpoint_url = self.config.get('base_url')
         self.timeout = config.get('timeout', 10)
+        self.session = get_session('hipchat', config, self.endpoint_url)
 
         self.headers = {
             'Content-type': 'application/json',
@@ -91,12 +86,11 @@ class iris_hipchat(object):
             logger.info('debug: %s', payload)
         else:
             try:
-                response = requests.post(notification_url,
-                                         headers=self.headers,
-                                         params=params,
-                                         json=payload,
-                                         proxies=self.proxy,
-                                         timeout=self.timeout)
+                response = self.session.post(notification_url,
+                                             headers=self.headers,
+                                             params=params,
+                                             json=payload,
+                                             timeout=self.timeout)
                 if response.status_code == 200 or response.status_code == 204:
                     return time.time() - start
                 else:
@@ -108,3 +102,6 @@ class iris_hipchat(object):
 
     def send(self, message, customizations=None):
         return self.modes[message['mode']](message)
+
+    def cleanup(self):
+        release_session(self.session)
@@ -2,9 +2,9 @@
 # See LICENSE in the project root for license information.
 
 import logging
-import requests
 import time
 from iris.constants import SMS_SUPPORT, CALL_SUPPORT
+from iris.vendors.session import get_session, release_session
 
 logger = logging.getLogger(__name__)
 
@@ -21,12 +21,7 @@ class iris_messagebird(object):
 
         self.debug = self.config.get('debug')
 
-        self.proxy = None
-        if 'proxy' in self.config:
-            host = self.config['proxy']['host']
-            port = self.config['proxy']['port']
-            self.proxy = {'http': 'http://%s:%s' % (host, port),
-                          'https': 'https://%s:%s' % (host, port)}
+        self.session = get_session('messagebird', config, self.config.get('access_key'))
 
         base_url = 'https://rest.messagebird.com'
         self.endpoint_url_messages = base_url + '/messages'
@@ -61,11 +56,10 @@ class iris_messagebird(object):
             logger.info('debug: %s', payload)
         else:
             try:
-                response = requests.post(self.endpoint_url_messages,
-                                         headers=self.headers,
-                                         json=payload,
-                                         proxies=self.proxy,
-                                         timeout=self.timeout)
+                response = self.session.post(self.endpoint_url_messages,
+                                             headers=self.headers,
+                                             json=payload,
+                                             timeout=self.timeout)
                 if response.status_code == 201:
                     return time.time() - start
                 else:
@@ -82,11 +76,10 @@ class iris_messagebird(object):
             logger.info('debug: %s', payload)
         else:
             try:
-                response = requests.post(self.endpoint_url_voicemessages,
-                                         headers=self.headers,
-                                         json=payload,
-                                         proxies=self.proxy,
-                                         timeout=self.timeout)
+                response = self.session.post(self.endpoint_url_voicemessages,
+                                             headers=self.headers,
+                                             json=payload,
+                                             timeout=self.timeout)
                 if response.status_code == 201:
                     return time.time() - start
                 else:
@@ -97,3 +90,6 @@ class iris_messagebird(object):
 
     def send(self, message, customizations=None):
         return self.modes[message['mode']](message)
+
+    def cleanup(self):
+        release_session(self.session)
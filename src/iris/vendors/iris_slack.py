@@ -3,13 +3,87 @@
 
 import ujson
 import logging
-import requests
 import time
+from gevent import sleep
+from iris import metrics
 from iris.constants import SLACK_SUPPORT
 from iris.custom_import import import_custom_module
+from iris.vendors.session import get_session, release_session
 
 logger = logging.getLogger(__name__)
 
+# Longest we hold on to a message while Slack rate limits us, before failing it over as usual
+DEFAULT_MAX_THROTTLE_WAIT = 300
+
+# Shared by the slack vendor instances of every worker in the process. (base_url, auth_token): RateLimiter
+limiters = {}
+
+
+class RateLimiter(object):
+    '''
+    Token bucket letting up to `rate` messages a second through to a Slack workspace, after an
+    initial burst of `burst`. Without a rate, it only holds messages back for as long as a 429's
+    Retry-After tells us to.
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or rate or 1
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.paused_until = 0
+        self.waiting = 0
+
+    def delay(self, now):
+        if now < self.paused_until:
+            return self.paused_until - now
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        # Returns how long we were held back for
+        start = now = time.time()
+        delay = self.delay(now)
+        if delay:
+            self.waiting += 1
+            update_waiting()
+            try:
+                while delay:
+                    sleep(delay)
+                    now = time.time()
+                    delay = self.delay(now)
+            finally:
+                self.waiting -= 1
+                update_waiting()
+            metrics.incr('slack_throttled_cnt')
+            metrics.incr('slack_throttled_time_total', now - start)
+        if self.rate:
+            self.tokens -= 1
+        return now - start
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+def update_waiting():
+    # Messages held back, on top of the ones still queued up behind them
+    metrics.set('slack_throttle_waiting', sum(limiter.waiting for limiter in limiters.itervalues()))
+
+
+def get_limiter(config):
+    key = (config.get('base_url'), config.get('auth_token'))
+    limiter = limiters.get(key)
+    if limiter is None:
+        metrics.add_new_metrics({'slack_throttled_cnt': 0, 'slack_throttled_time_total': 0,
+                                 'slack_throttle_waiting': 0, 'slack_rate_limited_cnt': 0})
+        limiter = limiters[key] = RateLimiter(config.get('rate_limit'), config.get('rate_limit_burst'))
+    return limiter
+
 
 class iris_slack(object):
     supports = frozenset([SLACK_SUPPORT])
@@ -21,13 +95,10 @@ class iris_slack(object):
         self.modes = {
             SLACK_SUPPORT: self.send_message
         }
-        self.proxy = None
-        if 'proxy' in self.config:
-            host = self.config['proxy']['host']
-            port = self.config['proxy']['port']
-            self.proxy = {'http': 'http://%s:%s' % (host, port),
-                          'https': 'https://%s:%s' % (host, port)}
+        self.session = get_session('slack', config, config.get('base_url'))
         self.timeout = config.get('timeout', 10)
+        self.limiter = get_limiter(config)
+        self.max_throttle_wait = config.get('max_throttle_wait', DEFAULT_MAX_THROTTLE_WAIT)
         self.message_attachments = self.config.get('message_attachments', {})
         push_config = config.get('push_notification', {})
         self.push_active = push_config.get('activated', False)
@@ -94,15 +165,32 @@ class iris_slack(object):
         if self.push_active:
             self.notifier.send_push(message)
         payload = self.get_message_payload(message)
+        throttled = 0
         try:
-            response = requests.post(self.config['base_url'],
-                                     data=payload,
-                                     proxies=self.proxy,
-                                     timeout=self.timeout)
+            # While Slack rate limits us, hold on to the message rather than failing it over to
+            # another mode, leaving the rest queued up behind it
+            while True:
+                throttled += self.limiter.acquire()
+                response = self.session.post(self.config['base_url'],
+                                             data=payload,
+                                             timeout=self.timeout)
+                if response.status_code != 429:
+                    break
+                metrics.incr('slack_rate_limited_cnt')
+                try:
+                    retry_after = int(response.headers.get('Retry-After', 1))
+                except ValueError:
+                    retry_after = 1
+                self.limiter.pause(retry_after)
+                if time.time() + retry_after - start > self.max_throttle_wait:
+                    logger.error('Rate limited by slack for over %ss. Giving up on message', self.max_throttle_wait)
+                    return
+                logger.warning('Rate limited by slack. Retrying in %ss', retry_after)
+
             if response.status_code == 200:
                 data = response.json()
                 if data['ok']:
-                    return time.time() - start
+                    return time.time() - start - throttled
                 # If message is invalid:
                 #   {u'ok': False, u'error': u'invalid_arg_name'}
                 logger.error('Received an error from slack api: %s',
@@ -115,3 +203,8 @@ class iris_slack(object):
 
     def send(self, message, customizations=None):
         return self.modes[message['mode']](message)
+
+    def cleanup(self):
+        release_session(self.session)
+        if self.push_active:
+            self.notifier.cleanup()
@@ -1,11 +1,15 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
-from gevent import sleep
+from gevent import sleep, spawn
+from gevent.lock import BoundedSemaphore
+from gevent.event import AsyncResult, Event
 from iris.constants import EMAIL_SUPPORT, IM_SUPPORT
+from iris import metrics
 from smtplib import SMTP
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from collections import OrderedDict
 import quopri
 import time
 import markdown
@@ -15,6 +19,196 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Messages fanned out to a team or list share the same body, so only convert it to html once
+html_cache = OrderedDict()
+HTML_CACHE_SIZE = 100
+
+
+# Connection pools shared by every iris_smtp instance in the process. (host, port, username): SMTPConnectionPool
+pools = {}
+
+# Identical emails waiting to be sent together. ((mx servers, port, username), content): EmailGroup
+email_groups = {}
+
+
+def markdown_to_html(body):
+    try:
+        return html_cache[body]
+    except KeyError:
+        html = html_cache[body] = markdown.Markdown().convert(body)
+        if len(html_cache) > HTML_CACHE_SIZE:
+            html_cache.popitem(last=False)
+        return html
+
+
+class PooledConnection(object):
+    __slots__ = ('smtp', 'created', 'last_used', 'messages')
+
+    def __init__(self, smtp, now):
+        self.smtp = smtp
+        self.created = now
+        self.last_used = now
+        self.messages = 0
+
+
+class SMTPConnectionPool(object):
+    '''
+    Connections to one MX server, shared by all the email workers sending through it. At most
+    `size` are open at once; workers wait for one to free up past that. Connections go back to
+    the pool after each send, are NOOP checked when they've sat idle for a while, and get
+    replaced after `max_messages` messages or `max_age` seconds.
+    '''
+
+    def __init__(self, host, port=25, timeout=10, username=None, password=None, size=10,
+                 max_messages=100, max_age=300, check_interval=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.check_interval = check_interval
+
+        self.slots = BoundedSemaphore(size)
+        self.idle = []
+        self.users = 0
+        self.closed = False
+        metrics.add_new_metrics({'smtp_pool_wait_total': 0, 'smtp_pool_wait_max': 0, 'smtp_pool_connect_cnt': 0,
+                                 'smtp_pool_connect_fail_cnt': 0, 'smtp_pool_recycle_cnt': 0,
+                                 'smtp_pool_broken_cnt': 0})
+
+    def connect(self):
+        smtp = SMTP(timeout=self.timeout)
+        try:
+            smtp.connect(self.host, self.port)
+            if self.username is not None and self.password is not None:
+                smtp.login(self.username, self.password)
+        except Exception:
+            metrics.incr('smtp_pool_connect_fail_cnt')
+            self.quit(smtp)
+            raise
+        metrics.incr('smtp_pool_connect_cnt')
+        return PooledConnection(smtp, time.time())
+
+    def quit(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            pass
+
+    def expired(self, conn, now):
+        return conn.messages >= self.max_messages or now - conn.created >= self.max_age
+
+    def usable(self, conn, now):
+        if self.expired(conn, now):
+            metrics.incr('smtp_pool_recycle_cnt')
+            self.quit(conn.smtp)
+            return False
+        if now - conn.last_used >= self.check_interval:
+            try:
+                code = conn.smtp.noop()[0]
+            except Exception:
+                code = None
+            if code != 250:
+                metrics.incr('smtp_pool_broken_cnt')
+                self.quit(conn.smtp)
+                return False
+        return True
+
+    def get(self):
+        start = time.time()
+        self.slots.acquire()
+        waited = time.time() - start
+        metrics.incr('smtp_pool_wait_total', waited)
+        if waited > metrics.stats.get('smtp_pool_wait_max', 0):
+            metrics.set('smtp_pool_wait_max', waited)
+        try:
+            while self.idle:
+                conn = self.idle.pop()
+                if self.usable(conn, time.time()):
+                    return conn
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, conn, broken=False):
+        try:
+            now = time.time()
+            if broken:
+                metrics.incr('smtp_pool_broken_cnt')
+                self.quit(conn.smtp)
+            elif self.closed:
+                self.quit(conn.smtp)
+            elif self.expired(conn, now):
+                metrics.incr('smtp_pool_recycle_cnt')
+                self.quit(conn.smtp)
+            else:
+                conn.last_used = now
+                self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    def sendmail(self, from_address, destinations, payload):
+        conn = self.get()
+        broken = True
+        try:
+            result = conn.smtp.sendmail(from_address, destinations, payload)
+            conn.messages += 1
+            broken = False
+            return result
+        finally:
+            self.put(conn, broken)
+
+    def warm(self, count):
+        # Open connections ahead of the first sends
+        for _ in xrange(min(count, self.size) - len(self.idle)):
+            self.slots.acquire()
+            try:
+                conn = self.connect()
+            except Exception:
+                self.slots.release()
+                logger.exception('Failed warming up connection to %s:%s', self.host, self.port)
+                return
+            self.put(conn)
+
+    def close(self):
+        self.closed = True
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            self.quit(conn.smtp)
+
+
+class EmailGroup(object):
+    __slots__ = ('destinations', 'full', 'result')
+
+    def __init__(self):
+        self.destinations = []
+        self.full = Event()
+        self.result = AsyncResult()
+
+
+def get_pool(host, config):
+    key = (host, config.get('port', 25), config.get('username'))
+    pool = pools.get(key)
+    if pool is None:
+        pool = pools[key] = SMTPConnectionPool(host, key[1], config.get('timeout', 10), key[2], config.get('password'),
+                                               config.get('pool_size', 10), config.get('connection_max_messages', 100),
+                                               config.get('connection_max_age', 300), config.get('connection_check_interval', 30))
+        if config.get('pool_warm'):
+            spawn(pool.warm, config['pool_warm'])
+    pool.users += 1
+    return pool
+
+
+def release_pool(pool):
+    pool.users -= 1
+    if pool.users <= 0:
+        pools.pop((pool.host, pool.port, pool.username), None)
+        pool.close()
+
 
 class iris_smtp(object):
     supports = frozenset([EMAIL_SUPPORT, IM_SUPPORT])
@@ -29,8 +223,7 @@ class iris_smtp(object):
             IM_SUPPORT: self.send_email,
         }
         self.mx_sorted = []
-        self.last_conn = None
-        self.last_conn_server = None
+        self.pools = []
 
         self.smtp_timeout = config.get('timeout', 10)
         if config.get('smtp_server'):
@@ -49,49 +242,86 @@ class iris_smtp(object):
         else:
             raise ValueError('Missing SMTP config for sender')
 
-    def send_email(self, message, customizations=None):
-        md = markdown.Markdown()
-
-        if isinstance(customizations, dict):
-            from_address = customizations.get('from', self.config['from'])
+        self.pools = [get_pool(mx[1], config) for mx in self.mx_sorted]
+
+        # Optionally send identical emails queued within group_window ms of each other in one
+        # transaction, with a RCPT TO for each recipient. Only out of band notifications are
+        # grouped: incident messages carry their own message id to reply with, so no two of
+        # them are the same.
+        self.group_window = config.get('group_window', 0) / 1000.0
+        self.group_max_recipients = config.get('group_max_recipients', 50)
+        self.group_key = (tuple(mx for _, mx in self.mx_sorted), config.get('port', 25), config.get('username'))
+        if self.group_window:
+            metrics.add_new_metrics({'smtp_group_cnt': 0, 'smtp_grouped_message_cnt': 0})
+
+    def sendmail(self, from_address, destinations, payload):
+        # Go through the MX servers in order of preference until one takes the message
+        error = None
+        for pool in self.pools:
+            try:
+                return pool.sendmail(from_address, destinations, payload)
+            except Exception as e:
+                logger.warning('Failed sending email through %s: %s', pool.host, e)
+                error = e
+        raise Exception('Failed sending email through any MX server: %s' % error)
+
+    def email_content(self, message, from_address):
+        # Everything that goes into the email apart from who it's to, so identical ones can be
+        # told apart from the rest
+        if 'email_subject' in message:
+            subject = message['email_subject']
         else:
-            from_address = self.config['from']
+            subject = message['subject']
 
-        start = time.time()
+        plaintext = None
+
+        if 'email_text' in message:
+            plaintext = message['email_text']
+        elif 'body' in message:
+            plaintext = message['body']
+
+        # for tracking messages, email_html is not required, so it's possible
+        # that both of the following keys are missing from message
+        html = None
+
+        if 'email_html' in message:
+            html = message['email_html']
+        elif 'body' in message:
+            html = markdown_to_html(message['body'])
+
+        if html:
+            if 'extra_html' in message:
+                html += message['extra_html']
+            # We need to have body tags for the oneclick buttons to properly parse
+            html = '<body>\n' + html + '\n</body>'
+
+        incident_id = message.get('incident_id')
+        return (from_address, message.get('priority'), message.get('application'), message.get('plan'),
+                str(incident_id) if incident_id else None, subject, plaintext, html)
+
+    def build_email(self, content, destinations, noreply=False):
+        from_address, priority, application, plan, incident_id, subject, plaintext, html = content
         m = MIMEMultipart('alternative')
 
-        priority = message.get('priority')
         if priority:
             m['X-IRIS-PRIORITY'] = priority
 
-        application = message.get('application')
         if application:
             m['X-IRIS-APPLICATION'] = application
 
-        plan = message.get('plan')
         if plan:
             m['X-IRIS-PLAN'] = plan
 
-        incident_id = message.get('incident_id')
         if incident_id:
-            m['X-IRIS-INCIDENT-ID'] = str(incident_id)
+            m['X-IRIS-INCIDENT-ID'] = incident_id
 
         m['from'] = from_address
-        m['to'] = message['destination']
-        if message.get('noreply'):
+        # Recipients of a grouped email only go in the envelope, so they don't see each other
+        m['to'] = destinations[0] if len(destinations) == 1 else 'undisclosed-recipients:;'
+        if noreply:
             m['reply-to'] = m['to']
 
-        if 'email_subject' in message:
-            m['subject'] = message['email_subject']
-        else:
-            m['subject'] = message['subject']
-
-        plaintext = None
-
-        if 'email_text' in message:
-            plaintext = message['email_text']
-        elif 'body' in message:
-            plaintext = message['body']
+        m['subject'] = subject
 
         if plaintext:
             mt = MIMEText(None, 'plain', 'utf-8')
@@ -99,20 +329,7 @@ class iris_smtp(object):
             mt.replace_header('Content-Transfer-Encoding', 'quoted-printable')
             m.attach(mt)
 
-        # for tracking messages, email_html is not required, so it's possible
-        # that both of the following keys are missing from message
-        html = None
-
-        if 'email_html' in message:
-            html = message['email_html']
-        elif 'body' in message:
-            html = md.convert(message['body'])
-
         if html:
-            if 'extra_html' in message:
-                html += message['extra_html']
-            # We need to have body tags for the oneclick buttons to properly parse
-            html = '<body>\n' + html + '\n</body>'
             mt = MIMEText(None, 'html', 'utf-8')
             # Google does not like base64 encoded emails for the oneclick button functionalty,
             # so force quoted printable.
@@ -120,75 +337,86 @@ class iris_smtp(object):
             mt.replace_header('Content-Transfer-Encoding', 'quoted-printable')
             m.attach(mt)
 
-        conn = None
-
-        # Try reusing previous connection in this worker if we have one
-        if self.last_conn:
-            conn = self.last_conn
-        else:
-            for mx in self.mx_sorted:
-                try:
-                    smtp = SMTP(timeout=self.smtp_timeout)
-                    smtp.connect(mx[1], self.config.get('port', 25))
-                    if self.config.get('username', None) is not None and self.config.get('password', None) is not None:
-                        smtp.login(self.config.get('username', None), self.config.get('password', None))
-                    conn = smtp
-                    self.last_conn = conn
-                    self.last_conn_server = mx[1]
-                    break
-                except Exception as e:
-                    logger.exception(e)
-
-        if not conn:
-            raise Exception('Failed to get smtp connection.')
+        return m.as_string()
 
+    def deliver(self, content, destinations, noreply=False):
+        # Returns the recipients the server refused, or None if the email didn't go out at all
+        payload = self.build_email(content, destinations, noreply)
         try:
-            conn.sendmail([from_address], [message['destination']], m.as_string())
+            return self.sendmail([content[0]], destinations, payload)
         except Exception:
-            logger.warning('Failed sending email through %s. Will try connecting again and resending.', self.last_conn_server)
+            logger.warning('Failed sending email. Will try again on a fresh connection.')
 
-            try:
-                conn.quit()
-            except Exception:
-                pass
-
-            # If we can't send it, try reconnecting and then sending it one more time before
-            # giving up
-            for mx in self.mx_sorted:
-                try:
-                    smtp = SMTP(timeout=self.smtp_timeout)
-                    smtp.connect(mx[1], 25)
-                    conn = smtp
-                    self.last_conn = conn
-                    self.last_conn_server = mx[1]
-                    break
-                except Exception as e:
-                    logger.exception('Failed reconnecting to %s to send message', self.last_conn_server)
-                    self.last_conn = None
-                    return None
+            # If configured, sleep to back-off on connection
+            if self.retry_interval:
+                sleep(self.retry_interval)
 
+            # The connection that failed was dropped, so try one more time before giving up
             try:
-                # If configured, sleep to back-off on connection
-                if self.retry_interval:
-                    sleep(self.retry_interval)
-                conn.sendmail([from_address], [message['destination']], m.as_string())
-                logger.info('Message successfully sent through %s after reconnecting', self.last_conn_server)
+                refused = self.sendmail([content[0]], destinations, payload)
+                logger.info('Message successfully sent after reconnecting')
+                return refused
             except Exception:
-                logger.exception('Failed sending email through %s after trying to reconnect', self.last_conn_server)
+                logger.exception('Failed sending email after trying to reconnect')
                 return None
 
+    def send_email(self, message, customizations=None):
+        if isinstance(customizations, dict):
+            from_address = customizations.get('from', self.config['from'])
+        else:
+            from_address = self.config['from']
+
+        start = time.time()
+        content = self.email_content(message, from_address)
+
+        if self.group_window and not message.get('noreply') and not message.get('message_id'):
+            refused = self.send_grouped(content, message['destination'])
+        else:
+            refused = self.deliver(content, [message['destination']], message.get('noreply'))
+
+        if refused is None or message['destination'] in refused:
+            return None
         return time.time() - start
 
+    def send_grouped(self, content, destination):
+        # Wait for other workers sending the very same email, to send them all in one transaction
+        key = (self.group_key, content)
+        group = email_groups.get(key)
+        if group is None:
+            group = email_groups[key] = EmailGroup()
+            spawn(self.send_group, key, group)
+        group.destinations.append(destination)
+        if len(group.destinations) >= self.group_max_recipients:
+            # Later ones start a new group
+            if email_groups.get(key) is group:
+                del email_groups[key]
+            group.full.set()
+        return group.result.get()
+
+    def send_group(self, key, group):
+        group.full.wait(self.group_window)
+        if email_groups.get(key) is group:
+            del email_groups[key]
+
+        # Somebody on a list and in a team gets it once
+        destinations = list(OrderedDict.fromkeys(group.destinations))
+        try:
+            refused = self.deliver(key[1], destinations)
+        except Exception:
+            logger.exception('Failed sending email to %s recipients', len(destinations))
+            refused = None
+        metrics.incr('smtp_group_cnt')
+        metrics.incr('smtp_grouped_message_cnt', len(group.destinations))
+        group.result.set(refused)
+
     def send(self, message, customizations=None):
         return self.modes[message['mode']](message, customizations)
 
     def cleanup(self):
-        if self.last_conn:
-            logger.info('Trying to quit smtp connection to %s', self.last_conn_server)
-            try:
-                self.last_conn.quit()
-            except Exception:
-                pass
+        # Connections close once the last worker using their pool is done with it
+        pools, self.pools = self.pools, []
+        for pool in pools:
+            release_pool(pool)
 
     @classmethod
     def determine_worker_count(cls, vendor):
@@ -4,31 +4,142 @@
 from iris.constants import SMS_SUPPORT, CALL_SUPPORT
 from iris.plugins import find_plugin
 from iris.custom_import import import_custom_module
-from twilio.rest import TwilioRestClient
-from twilio.rest.resources import Connection
+from iris.vendors.session import get_session, release_session
 from iris import db
-from sqlalchemy.exc import IntegrityError
+from gevent import spawn
+from gevent.event import Event
 import time
 import urllib
 import logging
 
 logger = logging.getLogger(__name__)
 
+TWILIO_API_URL = 'https://api.twilio.com/2010-04-01'
+
+# Rows of sids we've sent messages with, so status callbacks from Twilio can be tied back to them
+STATUS_SQL = '''INSERT IGNORE INTO `twilio_delivery_status` (`twilio_sid`, `message_id`)
+VALUES %s'''
+
+status_writer = None
+
+
+class TwilioError(Exception):
+    pass
+
+
+class TwilioResult(object):
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+class TwilioListResource(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def create(self, **kwargs):
+        # Same arguments as twilio-python takes: to=, from_=, status_callback= and so on
+        params = {}
+        for key, value in kwargs.iteritems():
+            params[''.join(word.capitalize() for word in key.split('_'))] = value
+        return self.client.request(self.name, params)
+
+
+class TwilioClient(object):
+    '''
+    Just enough of twilio-python's TwilioRestClient to send messages and make calls. Requests go
+    out over a shared keep-alive session, where twilio-python opens a new connection for each.
+    '''
+
+    def __init__(self, account_sid, auth_token, session, timeout, api_url=TWILIO_API_URL):
+        self.api_url = api_url
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.session = session
+        self.timeout = timeout
+        self.messages = TwilioListResource(self, 'Messages')
+        self.calls = TwilioListResource(self, 'Calls')
+
+    def request(self, name, params):
+        resp = self.session.post('%s/Accounts/%s/%s.json' % (self.api_url, self.account_sid, name),
+                                 data={k: unicode(v).encode('utf-8') for k, v in params.iteritems()},
+                                 auth=(self.account_sid, self.auth_token),
+                                 timeout=self.timeout)
+        if not resp.ok:
+            try:
+                error = resp.json()
+                msg = '%s (code %s)' % (error['message'], error['code'])
+            except Exception:
+                msg = resp.text
+            raise TwilioError('Twilio returned %s creating %s: %s' % (resp.status_code, name, msg))
+        return TwilioResult(resp.json())
+
+
+class DeliveryStatusWriter(object):
+    '''
+    Writes the twilio_delivery_status rows of messages we've sent in bulk, every flush_interval ms
+    or as soon as batch_size of them are pending. Twilio's first status callback for a message
+    comes in well after the default interval, so the row is there by then.
+    '''
+
+    def __init__(self, flush_interval=100, batch_size=100):
+        self.flush_interval = flush_interval / 1000.0
+        self.batch_size = batch_size
+        self.pending = []
+        self.flush_now = Event()
+        spawn(self.run)
+
+    def add(self, sid, message_id):
+        self.pending.append((sid, message_id))
+        if len(self.pending) >= self.batch_size:
+            self.flush_now.set()
+
+    def flush(self):
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            # IGNORE skips rows of messages deleted in the meantime, without failing the rest
+            cursor.execute(STATUS_SQL % ', '.join(['(%s, %s)'] * len(rows)),
+                           [field for row in rows for field in row])
+            connection.commit()
+        except Exception:
+            logger.exception('Failed initializing %s twilio delivery status rows: %s', len(rows), rows)
+        finally:
+            cursor.close()
+            connection.close()
+
+    def run(self):
+        while True:
+            self.flush_now.wait(self.flush_interval)
+            self.flush_now.clear()
+            self.flush()
+
+
+def get_status_writer(config):
+    global status_writer
+    if status_writer is None:
+        status_writer = DeliveryStatusWriter(config.get('status_flush_interval', 100),
+                                             config.get('status_batch_size', 100))
+    return status_writer
+
 
 class iris_twilio(object):
     supports = frozenset([SMS_SUPPORT, CALL_SUPPORT])
 
     def __init__(self, config):
         self.config = config
-        if 'proxy' in self.config:
-            Connection.set_proxy_info(self.config['proxy']['host'],
-                                      self.config['proxy']['port'],
-                                      proxy_rdns=True)
         self.modes = {
             SMS_SUPPORT: self.send_sms,
             CALL_SUPPORT: self.send_call,
         }
         self.timeout = config.get('timeout', 10)
+        self.client = TwilioClient(config.get('account_sid'), config.get('auth_token'),
+                                   get_session('twilio', config, config.get('account_sid')), self.timeout,
+                                   config.get('api_url', TWILIO_API_URL))
+        self.status_writer = get_status_writer(config)
         self.say_endpoint = config.get('say_endpoint', '/api/v0/twilio/calls/say')
         self.gather_endpoint = config.get('gather_endpoint', '/api/v0/twilio/calls/gather')
         push_config = config.get('push_notification', {})
@@ -37,9 +148,7 @@ class iris_twilio(object):
             self.notifier = import_custom_module('iris.push', push_config['type'])(push_config)
 
     def get_twilio_client(self):
-        return TwilioRestClient(self.config['account_sid'],
-                                self.config['auth_token'],
-                                timeout=self.timeout)
+        return self.client
 
     def generate_message_text(self, message):
         content = []
@@ -55,14 +164,7 @@ class iris_twilio(object):
         return '. '.join(content)
 
     def initialize_twilio_message_status(self, sid, message_id):
-        session = db.Session()
-        try:
-            session.execute('''INSERT INTO `twilio_delivery_status` (`twilio_sid`, `message_id`)
-                               VALUES (:sid, :mid)''', {'sid': sid, 'mid': message_id})
-            session.commit()
-        except IntegrityError:
-            logger.exception('Failed initializing twilio delivery status row. sid: %s, mid: %s', sid, message_id)
-        session.close()
+        self.status_writer.add(sid, message_id)
 
     def send_sms(self, message):
         client = self.get_twilio_client()
@@ -152,3 +254,9 @@ class iris_twilio(object):
         if self.push_active:
             self.notifier.send_push(message)
         return self.modes[message['mode']](message)
+
+    def cleanup(self):
+        self.status_writer.flush()
+        release_session(self.client.session)
+        if self.push_active:
+            self.notifier.cleanup()
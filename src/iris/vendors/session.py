@@ -0,0 +1,97 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# HTTP sessions shared by the vendor instances of every worker in the process, so messages go out
+# over connections kept alive from previous ones rather than paying for a new TLS handshake each.
+
+from weakref import WeakKeyDictionary
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from iris import metrics
+
+DEFAULT_POOL_SIZE = 10
+
+# (name, key..., proxy): [session, number of vendor instances using it]
+sessions = {}
+
+
+def get_proxies(config):
+    if 'proxy' not in config:
+        return None
+    host = config['proxy']['host']
+    port = config['proxy']['port']
+    return {'http': 'http://%s:%s' % (host, port),
+            'https': 'https://%s:%s' % (host, port)}
+
+
+class MeteredAdapter(HTTPAdapter):
+    '''
+    Counts the requests a vendor makes, how long they take and how many new connections they
+    needed, as <name>_http_* metrics.
+    '''
+
+    def __init__(self, name, pool_size):
+        self.name = name
+        self.connections = WeakKeyDictionary()  # connection pool: connections it had opened when we last looked
+        metrics.add_new_metrics({name + '_http_request_cnt': 0, name + '_http_request_fail_cnt': 0,
+                                 name + '_http_connect_cnt': 0, name + '_http_latency_total': 0,
+                                 name + '_http_latency_max': 0})
+        super(MeteredAdapter, self).__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def send(self, request, **kwargs):
+        start = time.time()
+        try:
+            return super(MeteredAdapter, self).send(request, **kwargs)
+        except Exception:
+            metrics.incr(self.name + '_http_request_fail_cnt')
+            raise
+        finally:
+            latency = time.time() - start
+            metrics.incr(self.name + '_http_request_cnt')
+            metrics.incr(self.name + '_http_latency_total', latency)
+            if latency > metrics.stats.get(self.name + '_http_latency_max', 0):
+                metrics.set(self.name + '_http_latency_max', latency)
+            self.count_connections(request.url, kwargs.get('proxies'))
+
+    def count_connections(self, url, proxies):
+        try:
+            pool = self.get_connection(url, proxies)
+        except Exception:
+            return
+        opened = pool.num_connections - self.connections.get(pool, 0)
+        self.connections[pool] = pool.num_connections
+        if opened > 0:
+            metrics.incr(self.name + '_http_connect_cnt', opened)
+
+
+def get_session(name, config, *key):
+    '''
+    Session for vendor configs of this name (and anything else in key telling them apart),
+    honouring their proxy. Up to http_pool_size connections per host are kept alive for reuse;
+    the sender sizes that to the number of workers sending through the vendor. More than that
+    are still made when needed, but closed once done with.
+    '''
+    proxies = get_proxies(config)
+    key = (name,) + key + (tuple(sorted(proxies.iteritems())) if proxies else None,)
+    entry = sessions.get(key)
+    if entry is None:
+        session = requests.Session()
+        adapter = MeteredAdapter(name, config.get('http_pool_size') or DEFAULT_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if proxies:
+            session.proxies.update(proxies)
+        entry = sessions[key] = [session, 0]
+    entry[1] += 1
+    return entry[0]
+
+
+def release_session(session):
+    for key, entry in sessions.items():
+        if entry[0] is session:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del sessions[key]
+                session.close()
+            return
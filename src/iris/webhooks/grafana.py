@@ -6,6 +6,7 @@ import ujson
 from falcon import HTTP_201, HTTPBadRequest, HTTPInvalidParam
 
 from iris import db
+from iris.sender import client as sender_client
 
 logger = logging.getLogger(__name__)
 
@@ -82,6 +83,8 @@ class grafana(object):
             session.commit()
             session.close()
 
+        sender_client.notify_new_incident(incident_id)
+
         resp.status = HTTP_201
         resp.set_header('Location', '/incidents/%s' % incident_id)
         resp.body = ujson.dumps(incident_id)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Overhead of journaling queued messages: queue + journal + ack per message, against just
+# queueing it. Then how long a sync of about 100ms worth of a busy sender's entries keeps the
+# hub from running other greenlets, against a journal writing and fsyncing on the hub itself.
+# Run with `make bench`.
+#
+# Segments go to a temporary directory under JOURNAL_BENCH_DIR (the current directory by
+# default), as /tmp is often a tmpfs where fsyncs cost next to nothing.
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+from timeit import default_timer
+from gevent import spawn, sleep
+from iris.sender.journal import MessageJournal
+from iris.sender.sendqueue import PrioritySendQueue
+
+MESSAGES = 50000
+SYNC_MESSAGES = 5000
+SYNC_ROUNDS = 20
+
+message = {
+    'message_id': 1234, 'application': 'iris', 'target': 'demo', 'priority': 'high', 'mode': 'email',
+    'destination': 'demo@example.com', 'incident_id': 5678, 'plan': 'demo-plan', 'template': 'default',
+    'context': {'summary': 'Disk usage above 90%', 'host': 'db01.example.com', 'value': 92.5},
+}
+
+
+class OnHubJournal(MessageJournal):
+    # How the journal used to write: straight from the hub
+    def sync(self):
+        pending, self.pending = self.pending, []
+        self.write_pending(pending)
+
+
+def run(journal):
+    send_queue = PrioritySendQueue()
+    start = default_timer()
+    for i in xrange(MESSAGES):
+        m = dict(message)
+        if journal:
+            m['journal_id'] = journal.append(m)
+        send_queue.put(m)
+        m = send_queue.get()
+        if journal:
+            journal.ack(m.pop('journal_id'))
+    if journal:
+        journal.sync()
+    return (default_timer() - start) / MESSAGES * 1e6
+
+
+def ticker(lags):
+    while True:
+        start = default_timer()
+        sleep(0.0005)
+        lags.append(default_timer() - start - 0.0005)
+
+
+def hub_stall(journal):
+    # Median over the rounds of the longest a greenlet waited for the hub during a sync
+    stalls = []
+    for _ in xrange(SYNC_ROUNDS):
+        for _ in xrange(SYNC_MESSAGES):
+            journal.ack(journal.append(dict(message)))
+        lags = []
+        tick = spawn(ticker, lags)
+        sleep(0.005)
+        del lags[:]
+        spawn(journal.sync).join()
+        sleep(0.001)
+        tick.kill()
+        stalls.append(max(lags))
+    return sorted(stalls)[len(stalls) // 2] * 1000
+
+
+def journal(cls, path):
+    journal = cls(path)
+    # syncs are up to the benchmark
+    journal.task.kill()
+    return journal
+
+
+if __name__ == '__main__':
+    path = tempfile.mkdtemp(dir=os.environ.get('JOURNAL_BENCH_DIR', '.'))
+    try:
+        baseline = run(None)
+        journaled = run(journal(MessageJournal, os.path.join(path, 'run')))
+        stall_on_hub = hub_stall(journal(OnHubJournal, os.path.join(path, 'hub')))
+        stall = hub_stall(journal(MessageJournal, os.path.join(path, 'threadpool')))
+    finally:
+        shutil.rmtree(path)
+    print('queue only:       %.2fus per message' % baseline)
+    print('queue + journal:  %.2fus per message (%.2fus overhead)' % (journaled, journaled - baseline))
+    print('hub stalled by a sync of %s messages: %.2fms writing on the hub, %.2fms from the threadpool' %
+          (SYNC_MESSAGES, stall_on_hub, stall))
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Per message cost of the quota and reprioritization rate counters, for windows from
+# a minute to a day. Run with `make bench`.
+
+from __future__ import print_function
+from timeit import timeit
+from iris.sender.rate import RateCounter
+
+MESSAGES = 100000
+
+if __name__ == '__main__':
+    for window in (60, 3600, 86400):
+        counter = RateCounter.with_resolution(window)
+        # a message every 50ms, so buckets keep rotating as they would under load
+        clock = iter(xrange(0, MESSAGES * 50, 50))
+
+        def message():
+            now = next(clock) / 1000.0
+            counter.add(now)
+            return counter.total
+
+        elapsed = timeit(message, number=MESSAGES)
+        print('%6ds window: %.3fus per message' % (window, elapsed / MESSAGES * 1e6))
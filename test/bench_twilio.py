@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# SMS and call send latency of the Twilio vendor against a local stub of the Twilio API, over
+# its shared keep-alive session and over a new connection per message as twilio-python does.
+# Plain HTTP, so the TLS handshake a real new connection costs on top isn't counted. Run with
+# `make bench`.
+
+from __future__ import print_function
+from gevent import monkey
+monkey.patch_all()  # noqa
+
+import requests
+from gevent.pywsgi import WSGIServer
+from timeit import default_timer
+from iris.vendors import iris_twilio
+
+MESSAGES = 2000
+connections = set()
+
+
+def stub_twilio(environ, start_response):
+    connections.add(environ['REMOTE_PORT'])
+    environ['wsgi.input'].read()
+    start_response('201 Created', [('Content-Type', 'application/json')])
+    return ['{"sid": "SM0123456789abcdef0123456789abcdef"}']
+
+
+class StubPlugin(object):
+    def get_phone_menu_text(self):
+        return 'Press 1 to claim'
+
+
+class NewConnectionSession(object):
+    def post(self, *args, **kwargs):
+        return requests.post(*args, **kwargs)
+
+
+def run(send):
+    connections.clear()
+    start = default_timer()
+    for i in xrange(MESSAGES):
+        send({'message_id': None, 'application': 'iris', 'destination': '+15555550100',
+              'subject': 'Disk usage', 'body': 'Disk usage above 90% on db01'})
+    return (default_timer() - start) / MESSAGES * 1e3, len(connections)
+
+
+if __name__ == '__main__':
+    server = WSGIServer(('127.0.0.1', 0), stub_twilio, log=None)
+    server.start()
+    config = {
+        'account_sid': 'AC0123456789abcdef0123456789abcdef',
+        'auth_token': 'secret',
+        'twilio_number': '+15555550199',
+        'relay_base_url': 'http://127.0.0.1',
+        'api_url': 'http://127.0.0.1:%s/2010-04-01' % server.server_port,
+    }
+    iris_twilio.find_plugin = lambda application: StubPlugin()
+    vendor = iris_twilio.iris_twilio(config)
+    for name, session in (('new connection', NewConnectionSession()), ('keep-alive', vendor.client.session)):
+        vendor.client.session = session
+        for kind, send in (('SMS', vendor.send_sms), ('call', vendor.send_call)):
+            latency, opened = run(send)
+            print('%15s: %.3fms per %s, %d connections' % (name, latency, kind, opened))
+    server.stop()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Send latency of the HTTP based vendors and FCM push notifications against a local stub API,
+# over their shared keep-alive session and over a new connection per message as they used to.
+# Plain HTTP, so the TLS handshake a real new connection costs on top isn't counted. Run with
+# `make bench`.
+
+from __future__ import print_function
+from gevent import monkey
+monkey.patch_all()  # noqa
+
+import requests
+from gevent.pywsgi import WSGIServer
+from timeit import default_timer
+from iris import metrics
+from iris.vendors.iris_slack import iris_slack
+from iris.vendors.iris_messagebird import iris_messagebird
+from iris.vendors.iris_hipchat import iris_hipchat
+from iris.push.fcm import PooledFCMNotification
+from iris.vendors.session import get_session
+
+MESSAGES = 2000
+message = {'application': 'iris', 'destination': 'demo', 'mode': 'sms', 'subject': 'Disk usage',
+           'body': 'Disk usage above 90% on db01'}
+
+
+def stub_api(environ, start_response):
+    environ['wsgi.input'].read()
+    start_response('201 Created' if 'messagebird' in environ['PATH_INFO'] else '200 OK',
+                   [('Content-Type', 'application/json')])
+    return ['{"ok": true, "success": 1, "results": [{"message_id": "1"}]}']
+
+
+class NewConnectionSession(object):
+    def post(self, *args, **kwargs):
+        return requests.post(*args, **kwargs)
+
+
+def run(send):
+    start = default_timer()
+    for i in xrange(MESSAGES):
+        send()
+    return (default_timer() - start) / MESSAGES * 1e3
+
+
+if __name__ == '__main__':
+    server = WSGIServer(('127.0.0.1', 0), stub_api, log=None)
+    server.start()
+    base_url = 'http://127.0.0.1:%s' % server.server_port
+
+    slack = iris_slack({'auth_token': 'abc', 'base_url': base_url + '/slack'})
+    messagebird = iris_messagebird({'access_key': 'abc'})
+    messagebird.endpoint_url_messages = base_url + '/messagebird/messages'
+    hipchat = iris_hipchat({'auth_token': 'abc', 'room_id': 1, 'base_url': base_url + '/hipchat'})
+    push = PooledFCMNotification(get_session('fcm', {}, 'abc'), api_key='abc')
+    push.FCM_END_POINT = base_url + '/fcm'
+
+    benches = (
+        ('slack', slack, lambda: slack.send_message(message)),
+        ('messagebird', messagebird, lambda: messagebird.send_message(message)),
+        ('hipchat', hipchat, lambda: hipchat.send_message(message)),
+        ('fcm', push, lambda: push.notify_multiple_devices(
+            registration_ids=['device'], message_title='Disk usage', message_body='Disk usage above 90%')),
+    )
+    for name, vendor, send in benches:
+        session = vendor.session
+        vendor.session = NewConnectionSession()
+        new_connection = run(send)
+        vendor.session = session
+        keep_alive = run(send)
+        print('%12s: %.3fms per message on new connections, %.3fms kept alive (%d connections for %d requests)' % (
+            name, new_connection, keep_alive, metrics.stats[name + '_http_connect_cnt'],
+            metrics.stats[name + '_http_request_cnt']))
+    server.stop()
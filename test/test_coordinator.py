@@ -86,3 +86,62 @@ def test_non_cluster():
     assert slaves.next() == ('testinstance', 1002)
     assert slaves.next() == ('testinstance', 1001)
     assert slaves.next() == ('testinstance', 1002)
+
+    # slaves are picked by weight and what's in flight with them
+    assert sorted(master_with_slaves.pick_slaves('email')) == [('testinstance', 1001), ('testinstance', 1002)]
+    with master_with_slaves.sending_to_slave(('testinstance', 1001)):
+        assert master_with_slaves.pick_slaves('email')[0] == ('testinstance', 1002)
+    assert not master_with_slaves.balancer.inflight
+
+    weighted = Coordinator(True, [{'host': 'testinstance', 'port': 1001, 'weight': 10},
+                                  {'host': 'testinstance', 'port': 1002}])
+    assert weighted.pick_slaves('email')[0] == ('testinstance', 1001)
+
+
+def test_slave_balancer():
+    from iris.coordinator.balance import SlaveBalancer
+
+    balancer = SlaveBalancer()
+    assert balancer.pick('email') == []
+
+    balancer.update([('a', 1)])
+    assert balancer.pick('email') == [('a', 1)]
+
+    busy, idle, slow = ('busy', 1), ('idle', 1), ('slow', 1)
+    balancer.update([busy, idle, slow], loads={
+        busy: {'modes': {'email': {'depth': 10000, 'workers': 10, 'latency': 0.1}}},
+        idle: {'modes': {'email': {'depth': 0, 'workers': 10, 'latency': 0.1}}},
+        slow: {'modes': {'email': {'depth': 0, 'workers': 10, 'latency': 5}}},
+    })
+    # whichever two get picked, the busy one never goes first and everybody is there to fall back to
+    for _ in xrange(20):
+        picked = balancer.pick('email')
+        assert picked[0] != busy
+        assert sorted(picked) == sorted([busy, idle, slow])
+
+    # other modes without load info are all alike
+    assert sorted(balancer.pick('sms')) == sorted([busy, idle, slow])
+
+
+def test_hash_ring():
+    from iris.coordinator.ring import HashRing
+
+    assert HashRing().get(1) is None
+    assert HashRing(['a:1']).get(1) == 'a:1'
+
+    members = ['a:1', 'b:1', 'c:1']
+    ring = HashRing(members)
+    owners = {incident_id: ring.get(incident_id) for incident_id in xrange(3000)}
+
+    # everybody gets a fair share
+    for member in members:
+        assert 700 < sum(1 for owner in owners.itervalues() if owner == member) < 1300
+
+    # and when somebody leaves, only their incidents move
+    smaller = HashRing(['a:1', 'b:1'])
+    for incident_id, owner in owners.iteritems():
+        if owner != 'c:1':
+            assert smaller.get(incident_id) == owner
+
+    # same members, same shards, whatever order they're listed in
+    assert all(HashRing(reversed(members)).get(incident_id) == owner for incident_id, owner in owners.iteritems())
@@ -80,3 +80,95 @@ def test_atttachments_construction_for_notification():
         'token': 'abc',
         'channel': '@user1'
     }
+
+
+def test_slack_shared_session(mocker):
+    import requests
+    from iris.vendors.session import sessions
+    mocker.patch('iris.metrics.stats', {})
+    response = requests.Response()
+    response.status_code = 200
+    response._content = '{"ok": true}'
+    mocked_send = mocker.patch('requests.adapters.HTTPAdapter.send', return_value=response)
+    config = {
+        'auth_token': 'abc',
+        'base_url': 'https://slack.example.com/api/chat.postMessage',
+        'http_pool_size': 20,
+    }
+
+    # workers share one session, and so its keep-alive connections
+    vendors = [iris_slack(config) for _ in xrange(2)]
+    assert vendors[0].session is vendors[1].session
+    adapter = vendors[0].session.get_adapter(config['base_url'])
+    assert adapter._pool_maxsize == 20
+
+    pool = mocker.MagicMock(num_connections=1)
+    mocker.patch.object(adapter, 'get_connection', return_value=pool)
+    for vendor in vendors:
+        assert vendor.send_message({'destination': 'user1', 'body': 'hello'}) is not None
+    assert mocked_send.call_count == 2
+
+    # the second request went out over the connection the first opened
+    from iris import metrics
+    assert metrics.stats['slack_http_request_cnt'] == 2
+    assert metrics.stats['slack_http_connect_cnt'] == 1
+    assert metrics.stats['slack_http_request_fail_cnt'] == 0
+
+    for vendor in vendors:
+        vendor.cleanup()
+    assert not [key for key in sessions if key[:2] == ('slack', config['base_url'])]
+
+
+def test_slack_rate_limit(mocker):
+    import requests
+    from iris.vendors import iris_slack as slack_module
+    mocker.patch('iris.metrics.stats', {})
+    mocker.patch.dict(slack_module.limiters, clear=True)
+    clock = [1000.0]
+    mocker.patch('iris.vendors.iris_slack.time.time', side_effect=lambda: clock[0])
+    mocked_sleep = mocker.patch('iris.vendors.iris_slack.sleep',
+                                side_effect=lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+
+    def response(status_code, headers={}):
+        r = requests.Response()
+        r.status_code = status_code
+        r.headers.update(headers)
+        r._content = '{"ok": true}'
+        return r
+
+    mocked_send = mocker.patch('requests.adapters.HTTPAdapter.send')
+    config = {
+        'auth_token': 'abc',
+        'base_url': 'https://slack.example.com/api/chat.postMessage',
+        'rate_limit': 2,
+        'rate_limit_burst': 2,
+    }
+    vendors = [iris_slack(config) for _ in xrange(2)]
+    assert vendors[0].limiter is vendors[1].limiter
+
+    # the burst goes straight through, then messages are spaced out to the rate
+    mocked_send.return_value = response(200)
+    for vendor in vendors * 2:
+        assert vendor.send_message({'destination': 'user1', 'body': 'hello'}) is not None
+    assert [call[0][0] for call in mocked_sleep.call_args_list] == [.5, .5]
+
+    # a 429 holds the message, and the ones after it, for as long as Slack asks
+    mocked_sleep.reset_mock()
+    mocked_send.side_effect = [response(429, {'Retry-After': '30'}), response(200), response(200)]
+    assert vendors[0].send_message({'destination': 'user1', 'body': 'hello'}) is not None
+    assert vendors[1].send_message({'destination': 'user1', 'body': 'hello'}) is not None
+    assert mocked_send.call_count == 7
+    assert sum(call[0][0] for call in mocked_sleep.call_args_list) >= 30
+
+    from iris import metrics
+    assert metrics.stats['slack_rate_limited_cnt'] == 1
+    assert metrics.stats['slack_throttled_cnt'] == 4
+    assert metrics.stats['slack_throttle_waiting'] == 0
+
+    # and it's failed over as before once that takes too long
+    mocked_send.side_effect = None
+    mocked_send.return_value = response(429, {'Retry-After': '600'})
+    assert vendors[0].send_message({'destination': 'user1', 'body': 'hello'}) is None
+
+    for vendor in vendors:
+        vendor.cleanup()
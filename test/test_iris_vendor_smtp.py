@@ -10,6 +10,7 @@ def test_smtp_vendor_init():
     smtp_vendor = iris_smtp(smtp_config)
     assert smtp_vendor.smtp_timeout == 10
     assert smtp_vendor.mx_sorted == [(0, 'foo')]
+    smtp_vendor.cleanup()
 
     smtp_config = {
         'timeout': 20,
@@ -17,6 +18,7 @@ def test_smtp_vendor_init():
     }
     smtp_vendor = iris_smtp(smtp_config)
     assert smtp_vendor.smtp_timeout == 20
+    smtp_vendor.cleanup()
 
 
 def test_smtp_send_email(mocker):
@@ -59,3 +61,124 @@ def test_smtp_unicode(mocker):
         'subject': 'hello',
         'body': u'\u201c',
     })
+    smtp_vendor.cleanup()
+
+
+def test_smtp_connection_pool(mocker):
+    from iris.vendors.iris_smtp import iris_smtp, pools
+    mocker.patch('iris.metrics.stats', {})
+    mocked_SMTP = mocker.patch('iris.vendors.iris_smtp.SMTP')
+    mocked_time = mocker.patch('iris.vendors.iris_smtp.time.time', return_value=1000)
+    smtp_config = {
+        'smtp_server': 'foo',
+        'from': 'iris@bar',
+        'port': 2525,
+        'username': 'user',
+        'password': 'pass',
+        'connection_max_messages': 2,
+    }
+
+    # workers share one connection per MX, logged in with the configured port and credentials
+    vendors = [iris_smtp(smtp_config) for _ in xrange(3)]
+    for vendor in vendors:
+        assert vendor.send_email({'destination': 'foo@bar', 'subject': 'hello', 'body': 'world'}) is not None
+    assert len(pools) == 1
+    assert mocked_SMTP.call_count == 2  # recycled after two messages
+    mocked_SMTP.return_value.connect.assert_called_with('foo', 2525)
+    mocked_SMTP.return_value.login.assert_called_with('user', 'pass')
+
+    # idle connections get a NOOP first, and a broken one is replaced
+    mocked_SMTP.reset_mock()
+    mocked_SMTP.return_value.noop.return_value = (421, 'closing')
+    mocked_time.return_value = 1100
+    assert vendors[0].send_email({'destination': 'foo@bar', 'subject': 'hello', 'body': 'world'}) is not None
+    mocked_SMTP.return_value.noop.assert_called_once_with()
+    assert mocked_SMTP.call_count == 1
+
+    # a failed send drops the connection and tries once more on a fresh one
+    mocked_SMTP.reset_mock()
+    mocked_SMTP.return_value.sendmail.side_effect = [Exception('gone'), {}]
+    assert vendors[0].send_email({'destination': 'foo@bar', 'subject': 'hello', 'body': 'world'}) is not None
+    assert mocked_SMTP.call_count == 1
+    assert mocked_SMTP.return_value.sendmail.call_count == 2
+
+    for vendor in vendors:
+        vendor.cleanup()
+    assert not pools
+
+
+def test_smtp_group_identical_emails(mocker):
+    from email import message_from_string
+    from gevent import spawn
+    from iris.vendors.iris_smtp import iris_smtp, email_groups
+    mocker.patch('iris.metrics.stats', {})
+    mocked_SMTP = mocker.patch('iris.vendors.iris_smtp.SMTP')
+    mocked_SMTP.return_value.sendmail.return_value = {'baz@bar': (550, 'no such user')}
+    smtp_config = {
+        'smtp_server': 'foo',
+        'from': 'iris@bar',
+        'group_window': 50,
+        'group_max_recipients': 3,
+    }
+    vendor = iris_smtp(smtp_config)
+
+    def send(destination, body='world'):
+        return spawn(vendor.send_email, {'destination': destination, 'subject': 'hello', 'body': body})
+
+    # same email to four people goes out in two transactions; a different one on its own
+    workers = [send(dest) for dest in ('foo@bar', 'bar@bar', 'baz@bar', 'qux@bar')]
+    other = send('foo@bar', 'other')
+    for worker in workers + [other]:
+        worker.join()
+
+    sendmail = mocked_SMTP.return_value.sendmail
+    assert sendmail.call_count == 3
+    assert [call[0][1] for call in sendmail.call_args_list] == [
+        ['foo@bar', 'bar@bar', 'baz@bar'], ['qux@bar'], ['foo@bar']]
+    # recipients of a group don't see each other's addresses
+    assert message_from_string(sendmail.call_args_list[0][0][2])['to'] == 'undisclosed-recipients:;'
+    assert message_from_string(sendmail.call_args_list[1][0][2])['to'] == 'qux@bar'
+
+    # each message gets its own result, and a refused recipient fails only its own message
+    assert [worker.value is not None for worker in workers] == [True, True, False, True]
+    assert other.value is not None
+    assert not email_groups
+    vendor.cleanup()
+
+
+def test_smtp_group_rendered_emails(mocker):
+    from gevent import spawn
+    from iris.bin import sender
+    from iris.sender import cache
+    from iris.vendors.iris_smtp import iris_smtp
+    mocker.patch('iris.metrics.stats', {})
+    mocked_SMTP = mocker.patch('iris.vendors.iris_smtp.SMTP')
+    mocked_SMTP.return_value.sendmail.return_value = {}
+    templates = cache.Templates(None)
+    mocker.patch.object(cache, 'rendered_templates', cache.RenderCache())
+    mocker.patch.object(cache, 'templates', {'tpl': {'id': 1, 'app': {'email': {
+        'subject': templates.env.from_string('{{ summary }}'), 'subject_fields': (), 'prefix_message_id': True,
+        'body': templates.env.from_string('{{ summary }}'), 'body_fields': ()}}}})
+    mocker.patch.object(sender, 'config', {})
+    vendor = iris_smtp({'smtp_server': 'foo', 'from': 'iris@bar', 'group_window': 50})
+
+    def send(destination, message_id=None):
+        context = {'summary': 'disk full'}
+        if message_id:
+            context['iris'] = {'message_id': message_id}
+        message = {'message_id': message_id, 'template': 'tpl', 'application': 'app', 'mode': 'email',
+                   'destination': destination, 'context': context}
+        sender.render(message)
+        return spawn(vendor.send_email, message)
+
+    # incident messages each have their id in the subject, so go out one by one
+    workers = [send('foo@bar', 10), send('bar@bar', 11)]
+    # out of band notifications to a team are the same for everyone
+    workers += [send('foo@bar'), send('bar@bar')]
+    for worker in workers:
+        worker.join()
+    assert all(worker.value is not None for worker in workers)
+
+    sendmail = mocked_SMTP.return_value.sendmail
+    assert sorted(call[0][1] for call in sendmail.call_args_list) == [['bar@bar'], ['foo@bar'], ['foo@bar', 'bar@bar']]
+    vendor.cleanup()
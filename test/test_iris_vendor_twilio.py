@@ -79,3 +79,50 @@ def test_twilio_incident_call_generate(mocker):
             'message_id=1&loop=3'),
         status_callback=relay_base_url + '/api/v0/twilio/status'
     )
+
+
+def test_twilio_sms_shared_session(mocker):
+    import requests_mock
+    from iris.vendors import iris_twilio as twilio_module
+    from iris.vendors.session import sessions
+    mocked_db = mocker.patch('iris.vendors.iris_twilio.db')
+    mocker.patch('iris.vendors.iris_twilio.status_writer', None)
+    config = {
+        'account_sid': 'AC123',
+        'auth_token': 'secret',
+        'twilio_number': '123-123-1234',
+        'relay_base_url': 'http://foo/relay',
+        'status_flush_interval': 60000,
+    }
+
+    # workers share one session, and so its keep-alive connections
+    vendors = [twilio_module.iris_twilio(config) for _ in xrange(2)]
+    assert vendors[0].get_twilio_client().session is vendors[1].get_twilio_client().session
+    assert len([key for key in sessions if key[:2] == ('twilio', 'AC123')]) == 1
+
+    with requests_mock.mock() as m:
+        url = 'https://api.twilio.com/2010-04-01/Accounts/AC123/Messages.json'
+        m.post(url, [{'json': {'sid': 'SM1'}}, {'json': {'sid': 'SM2'}}])
+        for message_id, vendor in enumerate(vendors, 1):
+            vendor.send_sms({'message_id': message_id, 'destination': '123-123-1235', 'subject': 'Hello', 'body': 'World'})
+        assert m.call_count == 2
+        assert sorted(m.last_request.text.split('&')) == [
+            'Body=Hello.+World', 'From=123-123-1234',
+            'StatusCallback=http%3A%2F%2Ffoo%2Frelay%2Fapi%2Fv0%2Ftwilio%2Fstatus', 'To=123-123-1235']
+
+        # errors from Twilio fail the send, so another vendor can be tried
+        m.post(url, status_code=400, json={'code': 21211, 'message': 'Invalid To number'})
+        try:
+            vendors[0].send_sms({'message_id': 3, 'destination': 'nope', 'body': 'World'})
+        except twilio_module.TwilioError as e:
+            assert 'Invalid To number' in str(e)
+        else:
+            assert False
+
+    # status rows of both messages go to the DB in one insert
+    for vendor in vendors:
+        vendor.cleanup()
+    cursor = mocked_db.engine.raw_connection.return_value.cursor.return_value
+    cursor.execute.assert_called_once_with(twilio_module.STATUS_SQL % '(%s, %s), (%s, %s)',
+                                           ['SM1', 1, 'SM2', 2])
+    assert not [key for key in sessions if key[:2] == ('twilio', 'AC123')]
@@ -0,0 +1,62 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+
+def test_fcm_batched_push(mocker):
+    from iris.push import fcm as fcm_module, devices
+    mocker.patch('iris.metrics.stats', {})
+    mocker.patch.dict(fcm_module.dispatchers, clear=True)
+    mocker.patch('iris.push.devices.registry', None)
+    mocked_db = mocker.patch('iris.push.devices.db')
+    cursor = mocked_db.engine.raw_connection.return_value.cursor.return_value
+    rows = [('alice', 'a1', 'Android'), ('alice', 'a2', 'iOS'), ('bob', 'b1', 'Android')]
+    found = []
+
+    def execute(sql, params):
+        found[:] = [row for row in rows if sql == devices.DEVICES_QUERY and row[0] in params[0]]
+
+    cursor.execute.side_effect = execute
+    cursor.__iter__.side_effect = lambda: iter(found)
+
+    def respond(registration_ids, **kwargs):
+        return {'results': [{'error': 'NotRegistered'} if registration_id == 'b1' else {}
+                            for registration_id in registration_ids]}
+
+    android = mocker.patch('iris.push.fcm.PooledFCMNotification.multiple_devices_data_message', side_effect=respond)
+    ios = mocker.patch('iris.push.fcm.PooledFCMNotification.notify_multiple_devices', side_effect=respond)
+
+    vendors = [fcm_module.fcm({'api_key': 'key', 'batch_window': 60000}) for _ in xrange(2)]
+    assert vendors[0].dispatcher is vendors[1].dispatcher
+    page = {'incident_id': 1, 'subject': 'Disk full', 'body': 'on db01'}
+    # rendered with prefix_message_id, which pushes leave out
+    vendors[0].send_push(dict(page, target='alice', message_id=1, subject='1 Disk full'))
+    vendors[1].send_push(dict(page, target='bob', message_id=2, subject='2 Disk full'))
+    vendors[0].send_push({'message_id': 3, 'body': 'tracking'})
+    # queued, not sent on the way
+    assert not android.called and not cursor.execute.called
+
+    # same page to a team goes to all their Android devices at once, with one device lookup
+    vendors[0].cleanup()
+    assert cursor.execute.call_args_list[0][0][0] == devices.DEVICES_QUERY
+    assert set(cursor.execute.call_args_list[0][0][1][0]) == {'alice', 'bob'}
+    assert android.call_count == 1
+    assert android.call_args[1]['registration_ids'] == ['a1', 'b1']
+    assert android.call_args[1]['data_message']['title'] == 'Disk full'
+    assert ios.call_count == 1
+    assert ios.call_args[1]['registration_ids'] == ['a2']
+    assert ios.call_args[1]['message_title'] == 'Disk full'
+
+    # devices FCM doesn't know anymore are dropped, from the DB and the cache
+    cursor.execute.assert_called_with('''DELETE FROM `device` WHERE `registration_id` IN %s''', (('b1',),))
+    assert devices.registry.devices['bob'][1] == []
+
+    # later pushes come out of the cache, until a user registers a new device
+    cursor.execute.reset_mock()
+    vendors[0].send_push(dict(page, target='alice', message_id=4))
+    vendors[0].cleanup()
+    assert not cursor.execute.called
+    devices.invalidate(['alice'])
+    vendors[0].send_push(dict(page, target='alice', message_id=5))
+    vendors[0].cleanup()
+    cursor.execute.assert_called_once_with(devices.DEVICES_QUERY, (('alice',),))
+    assert android.call_args[1]['registration_ids'] == ['a1']
@@ -10,6 +10,7 @@ from iris.bin.sender import init_sender
 from iris.vendors import IrisVendorManager
 import msgpack
 import gevent.queue
+import pytest
 
 
 def test_configure(mocker):
@@ -191,7 +192,7 @@ def test_message_retry(mocker):
         add_mode_stat
     )
 
-    def fail_send_message(message, vendors=None):
+    def fail_send_message(message, vendors=None, slaves=None):
         add_mode_stat(message['mode'], None)
         return False, True
 
@@ -380,6 +381,83 @@ def test_quotas(mocker):
         assert quotas.allow_send({'application': 'app_without_quota'})
 
 
+def test_worker_process_channel():
+    from datetime import datetime
+    from gevent import socket
+    from iris.sender.workerproc import Channel
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    parent, child = Channel(parent), Channel(child)
+
+    message = {'message_id': 1, 'body': u'caf\xe9', 'raw': 'bytes', 'aggregated_ids': {1, 2},
+               'context': {'iris': {'incident_created': datetime(2017, 1, 2, 3, 4, 5, 6)}}}
+    parent.send('send', 7, message, [('slave', 2321)])
+    parent.sock.close()
+
+    frames = list(child)
+    assert len(frames) == 1
+    kind, request_id, received, slaves = frames[0]
+    assert (kind, request_id, slaves) == ('send', 7, [['slave', 2321]])
+    assert received['body'] == u'caf\xe9' and isinstance(received['body'], unicode)
+    assert received['raw'] == 'bytes' and isinstance(received['raw'], str)
+    assert sorted(received['aggregated_ids']) == [1, 2]
+    assert received['context']['iris']['incident_created'] == datetime(2017, 1, 2, 3, 4, 5, 6)
+
+
+def test_send_through_worker_process(mocker):
+    from iris.bin import sender
+    from iris.sender.workerproc import WorkerProcess, WorkerProcessError
+    mocker.patch('iris.metrics.stats', dict(sender.default_sender_metrics))
+    mocker.patch('iris.bin.sender.quota')
+    mocker.patch('iris.bin.sender.coordinator').am_i_master.return_value = False
+    mock_mark_message_sent = mocker.patch('iris.bin.sender.mark_message_as_sent')
+    mock_update_status = mocker.patch('iris.bin.sender.update_message_sent_status')
+    mock_enqueue = mocker.patch('iris.bin.sender.message_send_enqueue')
+
+    process = WorkerProcess('email', {}, 1)
+    mocker.patch.object(process, 'deliver', return_value=((True, True), dict(fake_message, mode='email', subject='rendered')))
+    message = dict(fake_message, mode='email')
+    sender.send_queued_message(message, process)
+    process.deliver.assert_called_once_with(message, [])
+    assert message['subject'] == 'rendered'
+    mock_mark_message_sent.assert_called_once_with(message)
+    mock_update_status.assert_called_once_with(message, True)
+
+    # the child went away, so try again later
+    mock_mark_message_sent.reset_mock()
+    process.deliver.side_effect = WorkerProcessError('connection closed')
+    sender.send_queued_message(dict(fake_message, mode='email'), process)
+    mock_mark_message_sent.assert_not_called()
+    assert mock_enqueue.call_args[0][0]['retry_count'] == 1
+
+
+def test_quotas_across_shards(mocker):
+    from iris.sender.quota import ApplicationQuota
+    from gevent import sleep
+    mocker.patch('iris.metrics.stats')
+    mocker.patch('iris.sender.quota.ApplicationQuota.get_new_rules',
+                 return_value=[(
+                     u'testapp', 5, 2, 120, 120, u'testuser',
+                     u'user', u'iris-plan', 10
+                 )])
+    mocker.patch('iris.sender.quota.ApplicationQuota.notify_incident')
+    mocker.patch('iris.sender.quota.ApplicationQuota.notify_target')
+    quotas = ApplicationQuota(None, None, None, None)
+    sleep(1)
+
+    assert quotas.allow_send({'application': 'testapp'})
+    assert quotas.usage() == {u'testapp': (1, 1)}
+
+    # the other senders already sent most of this app's quota between them
+    quotas.set_peer_usage({('a', 1): {'quota': {'testapp': [2, 2]}},
+                           ('b', 1): {'quota': {'testapp': [2, 2], 'otherapp': [9, 9]}},
+                           ('c', 1): {}})
+    assert quotas.peer_usage == {'testapp': (4, 4), 'otherapp': (9, 9)}
+    assert not quotas.allow_send({'application': 'testapp'})
+
+    quotas.set_peer_usage({})
+    assert quotas.allow_send({'application': 'testapp'})
+
+
 def test_aggregate_audit_msg(mocker):
     mock_iris_client = mocker.patch('iris.sender.cache.iris_client')
     mock_iris_client.get.return_value.json.return_value = fake_plan
@@ -399,15 +477,14 @@ def test_aggregate_audit_msg(mocker):
         fake_message['application'],
         fake_message['priority'],
         fake_message['target'])
-    from collections import defaultdict
-    plan_aggregate_windows[msg_aggregate_key] = defaultdict(int)
-    plan_aggregate_windows[msg_aggregate_key][now] = 10
-    plan_aggregate_windows[msg_aggregate_key][now - 60] = 10
+    from iris.sender.rate import RateCounter
+    plan_aggregate_windows[msg_aggregate_key] = RateCounter(fake_plan['threshold_window'])
+    plan_aggregate_windows[msg_aggregate_key].add(now, 10)
+    plan_aggregate_windows[msg_aggregate_key].add(now - 60, 10)
 
     mocker.patch('iris.bin.sender.cache').plans = {fake_plan['id']: fake_plan}
 
-    mocker.patch('iris.bin.sender.spawn')
-    from iris.bin.sender import spawn as mock_spawn
+    mock_message_change = mocker.patch('iris.bin.sender.auditlog.message_change')
 
     # run code to test
     fetch_and_prepare_message()
@@ -415,8 +492,7 @@ def test_aggregate_audit_msg(mocker):
     # examine results
     assert send_queue.qsize() == 0
     from iris.sender import auditlog
-    mock_spawn.assert_called_with(
-        auditlog.message_change,
+    mock_message_change.assert_called_with(
         fake_message['message_id'],
         auditlog.SENT_CHANGE,
         '',
@@ -424,6 +500,182 @@ def test_aggregate_audit_msg(mocker):
         "Aggregated with key (19546, test-app, high, test-user)")
 
 
+def test_rate_counter():
+    from iris.sender.rate import RateCounter
+    counter = RateCounter(60)
+    counter.add(1000)
+    counter.add(1010, 3)
+    assert counter.count(1030) == 4
+    assert counter.count(1065) == 3
+    assert counter.count(1075) == 0
+    counter.add(5000)
+    assert counter.count(5000) == 1
+
+    # buckets age by the clock, not by refresh loops
+    counter = RateCounter.with_resolution(86400)
+    assert counter.resolution == 10
+    counter.add(1000, 5)
+    assert counter.count(1000 + 86395) == 5
+    assert counter.count(1000 + 86410) == 0
+
+
+def test_target_reprioritization(mocker):
+    from iris.sender.cache import TargetReprioritization
+    from iris.sender.rate import RateCounter
+    update_message_mode = mocker.patch('iris.sender.cache.update_message_mode')
+    mocker.patch('iris.sender.cache.auditlog.message_change')
+    reprioritization = TargetReprioritization(None)
+    reprioritization.rates[('test-user', 'email')] = ('sms', '+1 555', 2, RateCounter.with_resolution(300))
+
+    messages = [{'message_id': i, 'target': 'test-user', 'mode': 'email'} for i in xrange(3)]
+    for message in messages:
+        reprioritization(message)
+    assert [m['mode'] for m in messages] == ['email', 'email', 'sms']
+    assert messages[2]['destination'] == '+1 555'
+    update_message_mode.assert_called_once_with(messages[2])
+
+
+def test_timer_wheel():
+    from iris.sender.aggregation import TimerWheel
+    timers = TimerWheel(size=8)
+    timers.current = 100
+    timers.schedule('a', 103.5)
+    timers.schedule('b', 120)
+    timers.schedule('c', 50)
+    assert 'a' in timers and len(timers) == 3
+    assert timers.advance(101) == ['c']
+    assert timers.advance(103) == []
+    assert timers.advance(104) == ['a']
+    timers.schedule('b', 130)
+    timers.cancel('a')
+    assert timers.advance(129) == []
+    assert timers.advance(200) == ['b']
+    assert len(timers) == 0
+
+
+def test_aggregation_flush(mocker):
+    from iris.bin import sender
+    mocker.patch('iris.metrics.stats')
+    mocker.patch('iris.bin.sender.cache').plans = {fake_plan['id']: fake_plan}
+    mocker.patch('iris.bin.sender.auditlog.message_change')
+    mocker.patch('iris.bin.sender.get_active_message_ids', side_effect=lambda ids: set(ids))
+    enqueue = mocker.patch('iris.bin.sender.message_send_enqueue')
+    mocker.patch.object(sender, 'aggregation_timers', sender.TimerWheel())
+    for state in (sender.plan_aggregate_windows, sender.aggregation, sender.sent, sender.queues,
+                  sender.messages, sender.aggregated_incidents):
+        state.clear()
+
+    key = (fake_plan['id'], 'test-app', 'high', 'test-user')
+    now = time.time()
+    for message_id in xrange(1, 13):
+        sender.message_queue.put(dict(fake_message, message_id=message_id, incident_id=message_id % 3))
+        sender.fetch_and_prepare_message()
+    assert enqueue.call_count == 10
+    assert sender.queues[key] == {11, 12}
+    assert key in sender.aggregation_timers
+
+    sender.drop_claimed_incidents([2])
+    assert sender.queues[key] == {12}
+    assert 11 not in sender.messages
+
+    sender.aggregate(now + fake_plan['aggregation_window'] - 5)
+    assert enqueue.call_count == 10
+    sender.aggregate(now + fake_plan['aggregation_window'] + 1)
+    assert enqueue.call_count == 11
+    assert enqueue.call_args[0][0]['message_id'] == 12
+    assert key not in sender.queues and not sender.messages and not sender.aggregated_incidents
+
+
+def test_priority_send_queue(mocker):
+    from iris.sender.sendqueue import PrioritySendQueue
+    time_mock = mocker.patch('iris.sender.sendqueue.time', return_value=1000)
+    send_queue = PrioritySendQueue(aging_interval=30)
+    for message_id, priority in enumerate(['low', 'medium', 'high', None, 'urgent', 'high']):
+        send_queue.put({'message_id': message_id, 'priority': priority})
+    assert send_queue.qsize() == 6
+    assert [send_queue.get()['message_id'] for _ in xrange(6)] == [4, 2, 5, 1, 3, 0]
+    with pytest.raises(gevent.queue.Empty):
+        send_queue.get(True, 0.01)
+
+    # low priority messages age past high but never past urgent
+    send_queue.put({'message_id': 'low', 'priority': 'low'})
+    time_mock.return_value = 1065
+    send_queue.put({'message_id': 'high', 'priority': 'high'})
+    send_queue.put({'message_id': 'urgent', 'priority': 'urgent'})
+    stats = send_queue.stats()
+    assert stats['low'] == (1, 65)
+    assert stats['high'] == (1, 0)
+    assert [send_queue.get()['message_id'] for _ in xrange(3)] == ['urgent', 'low', 'high']
+
+
+def test_priority_send_queue_fairness(mocker):
+    from iris.sender.sendqueue import PrioritySendQueue
+    time_mock = mocker.patch('iris.sender.sendqueue.time', return_value=1000)
+    send_queue = PrioritySendQueue(application_weights={'busy': 2, 'slow': 0.5})
+    for i in xrange(6):
+        send_queue.put({'message_id': 'noisy%s' % i, 'application': 'noisy', 'priority': 'high'})
+    for application in ('quiet', 'busy', 'busy', 'busy', 'slow', 'slow'):
+        send_queue.put({'message_id': application, 'application': application, 'priority': 'high'})
+
+    time_mock.return_value = 1010
+    assert send_queue.application_stats() == {'noisy': (6, 10), 'quiet': (1, 10), 'busy': (3, 10), 'slow': (2, 10)}
+    assert [send_queue.get()['message_id'] for _ in xrange(12)] == [
+        'noisy0', 'quiet', 'busy', 'busy', 'noisy1', 'busy', 'slow', 'noisy2', 'noisy3', 'slow', 'noisy4', 'noisy5']
+    assert send_queue.application_stats()['quiet'] == (0, 10)
+    assert send_queue.application_stats() == {}
+
+
+def test_message_journal(mocker, tmpdir):
+    from iris.sender.journal import MessageJournal
+    mocker.patch('iris.metrics.stats')
+    path = str(tmpdir.join('journal'))
+
+    journal = MessageJournal(path, segment_size=200)
+    journal_ids = [journal.append({'message_id': None, 'body': 'message %s' % i}) for i in xrange(6)]
+    for journal_id in journal_ids[:4]:
+        journal.ack(journal_id)
+    journal.sync()
+    # Segments only holding acked messages are gone
+    assert len(tmpdir.join('journal').listdir()) < 4
+    journal.close()
+
+    # with a torn write at the end
+    with open(journal.segment_path(journal.segment), 'ab') as f:
+        f.write(msgpack.packb(('e', 99, {'body': 'torn'}))[:-3])
+
+    journal = MessageJournal(path, segment_size=200)
+    replayed = journal.replay()
+    assert [m['body'] for m in replayed] == ['message 4', 'message 5']
+    assert journal.append(replayed[0]) == 6
+    journal.finish_replay()
+    assert [segment.basename for segment in tmpdir.join('journal').listdir()] == [journal.segment_path(journal.segment).split('/')[-1]]
+
+
+def test_message_journal_keeps_acks_of_older_segments(mocker, tmpdir):
+    from iris.sender.journal import MessageJournal
+    mocker.patch('iris.metrics.stats')
+    path = str(tmpdir.join('journal'))
+    journal = MessageJournal(path, segment_size=200)
+
+    def fill_segment():
+        segment = journal.segment
+        while journal.segment == segment:
+            journal.ack(journal.append({'message_id': None, 'body': 'filler'}))
+
+    # held is sent long after the messages around it, keeping the first segment around
+    journal.append({'message_id': None, 'body': 'held'})
+    sent = journal.append({'message_id': None, 'body': 'sent'})
+    fill_segment()
+    # sent's ack goes to the second segment, which only holds acked messages of its own
+    journal.ack(sent)
+    fill_segment()
+    fill_segment()
+    journal.close()
+
+    journal = MessageJournal(path, segment_size=200)
+    assert [m['body'] for m in journal.replay()] == ['held']
+
+
 def test_handle_api_notification_request_invalid_message(mocker):
     mocker.patch('iris.bin.sender.set_target_contact').return_value = True
     mocker.patch('iris.metrics.stats')
@@ -510,6 +762,38 @@ def test_handle_api_notification_request_invalid_message(mocker):
         send_queue.get()
 
 
+def test_handle_api_notification_batch_request(mocker):
+    mocker.patch('iris.bin.sender.set_target_contact').return_value = True
+    mocker.patch('iris.metrics.stats')
+
+    from iris.bin.sender import message_send_enqueue
+    from iris.sender.rpc import handle_api_notification_batch_request, send_funcs
+    from iris.sender.shared import per_mode_send_queues
+
+    send_funcs['message_send_enqueue'] = message_send_enqueue
+    send_queue = per_mode_send_queues.setdefault('email', gevent.queue.Queue())
+    mocker.patch('iris.sender.rpc.cache').targets_for_role.return_value = ['foo']
+
+    mock_socket = mocker.MagicMock()
+    handle_api_notification_batch_request(mock_socket, mocker.MagicMock(), {'data': {'role': 'user'}})
+    mock_socket.sendall.assert_called_with(msgpack.packb('INVALID batch'))
+
+    # each notification is judged on its own
+    handle_api_notification_batch_request(mock_socket, mocker.MagicMock(), {
+        'data': [
+            {'target': 'foo', 'role': 'user', 'application': 'test_app', 'body': 'test', 'mode': 'email'},
+            {'target': 'foo', 'application': 'test_app', 'body': 'test', 'mode': 'email'},
+            {'target': 'foo', 'role': 'user', 'application': 'test_app', 'body': 'test2', 'mode': 'email'},
+        ]
+    })
+    mock_socket.sendall.assert_called_with(msgpack.packb(['OK', 'INVALID role', 'OK']))
+    assert send_queue.qsize() == 2
+
+    # drain out send queue
+    while send_queue.qsize() > 0:
+        send_queue.get()
+
+
 def test_sanitize_unicode_dict():
     import pytest
     from jinja2.sandbox import SandboxedEnvironment
@@ -524,3 +808,488 @@ def test_sanitize_unicode_dict():
         template.render(**bad_context)
 
     template.render(**sanitize_unicode_dict(bad_context))
+
+
+def test_handle_api_request_v0_new_incident(mocker):
+    from iris.sender.rpc import handle_api_request, send_funcs
+    mocker.patch('iris.metrics.stats')
+
+    mock_escalate = mocker.MagicMock(return_value=True)
+    send_funcs['escalate_new_incident'] = mock_escalate
+
+    mock_socket = mocker.MagicMock()
+    mock_socket.recv.return_value = msgpack.packb({
+        'endpoint': 'v0/new_incident',
+        'data': {'incident_id': 1234},
+    })
+    handle_api_request(mock_socket, mocker.MagicMock())
+    mock_escalate.assert_called_once_with(1234, False)
+    mock_socket.sendall.assert_called_with(msgpack.packb('OK'))
+
+    mock_escalate.return_value = False
+    handle_api_request(mock_socket, mocker.MagicMock())
+    mock_socket.sendall.assert_called_with(msgpack.packb('NOT MASTER'))
+
+    mock_escalate.reset_mock()
+    mock_socket.recv.return_value = msgpack.packb({
+        'endpoint': 'v0/new_incident',
+        'data': {'incident_id': 'foo'},
+    })
+    handle_api_request(mock_socket, mocker.MagicMock())
+    mock_escalate.assert_not_called()
+    mock_socket.sendall.assert_called_with(msgpack.packb('INVALID incident_id'))
+
+
+def test_multiplexed_rpc(mocker):
+    from gevent.server import StreamServer
+    from iris.sender import rpc
+    from iris.sender.client import MultiplexedConnection, RPCError
+    mocker.patch('iris.metrics.stats')
+    mocker.patch.object(rpc, 'rpc_timeout', 5)
+
+    def slow_escalate(incident_id, forwarded):
+        gevent.sleep(0.1 if incident_id == 1 else 0)
+        return True
+    mocker.patch.dict(rpc.send_funcs, {'escalate_new_incident': slow_escalate})
+
+    accepted = mocker.MagicMock(wraps=rpc.handle_api_request)
+    server = StreamServer(('127.0.0.1', 0), accepted)
+    server.start()
+    connection = MultiplexedConnection(('127.0.0.1', server.server_port), max_inflight=2)
+
+    # pipelined on one connection, answered out of order
+    requests = [gevent.spawn(connection.request, 'v0/new_incident', {'incident_id': incident_id})
+                for incident_id in (1, 2, 'foo')]
+    requests.append(gevent.spawn(connection.request, 'v0/ping', {}))
+    gevent.joinall(requests, timeout=5)
+    assert [r.value for r in requests] == ['OK', 'OK', 'INVALID incident_id', 'OK']
+    assert accepted.call_count == 1
+    assert not connection.pending
+
+    # a connection that goes away is noticed, and reconnects back off while the sender is down
+    server.stop()
+    connection.sock.shutdown(2)
+    gevent.sleep(0.1)
+    assert connection.sock is None
+    with pytest.raises(RPCError):
+        connection.request('v0/ping', {})
+    assert connection.backoff > 0
+    with pytest.raises(RPCError) as e:
+        connection.request('v0/ping', {})
+    assert 'not reconnecting' in str(e.value)
+
+
+def test_notify_sender(mocker):
+    from gevent.server import StreamServer
+    from iris.sender import rpc, client
+    mocker.patch('iris.metrics.stats')
+    mocker.patch.object(rpc, 'rpc_timeout', 5)
+    mocker.patch.dict(client.connections, clear=True)
+    mock_escalate = mocker.MagicMock(return_value=True)
+    mocker.patch.dict(rpc.send_funcs, {'escalate_new_incident': mock_escalate})
+
+    accepted = mocker.MagicMock(wraps=rpc.handle_api_request)
+    server = StreamServer(('127.0.0.1', 0), accepted)
+    server.start()
+    sender_addr = ('127.0.0.1', server.server_port)
+
+    # notifications share the pooled connection
+    assert client.send_incident_notification(1234, sender_addr)
+    assert client.send_incident_notification(1235, sender_addr, forwarded=True)
+    assert not client.send_incident_notification('foo', sender_addr)
+    assert mock_escalate.call_args_list == [((1234, False),), ((1235, True),)]
+    assert accepted.call_count == 1
+
+    server.stop()
+    client.connections[sender_addr].sock.shutdown(2)
+    gevent.sleep(0.1)
+    assert not client.send_incident_notification(1236, sender_addr)
+
+
+def test_escalate_new_incident(mocker):
+    from iris.bin import sender
+    mocker.patch('iris.metrics.stats')
+    mock_spawn = mocker.patch('iris.bin.sender.spawn')
+    mock_coordinator = mocker.patch('iris.bin.sender.coordinator')
+
+    mock_coordinator.owns_incident.return_value = False
+    mock_coordinator.incident_owner.return_value = None
+    assert not sender.escalate_new_incident(1234)
+    mock_spawn.assert_not_called()
+
+    mock_coordinator.owns_incident.return_value = True
+    assert sender.escalate_new_incident(1234)
+    mock_spawn.assert_called_once_with(sender.escalate_incident, 1234)
+
+    # sharded, and some other sender's incident: hand it over, but only once
+    mock_spawn.reset_mock()
+    mock_coordinator.owns_incident.return_value = False
+    mock_coordinator.incident_owner.return_value = ('otherhost', 2321)
+    assert sender.escalate_new_incident(1234)
+    mock_spawn.assert_called_once_with(sender.sender_client.send_incident_notification, 1234, ('otherhost', 2321), True)
+
+    mock_spawn.reset_mock()
+    assert not sender.escalate_new_incident(1234, forwarded=True)
+    mock_spawn.assert_not_called()
+
+
+def test_create_messages_batch(mocker):
+    from iris.bin import sender
+    from iris.sender import auditlog
+    mocker.patch('iris.metrics.stats')
+    mock_cache = mocker.patch('iris.bin.sender.cache')
+    mocker.patch('iris.bin.sender.api_cache.priorities', {'low': {'id': 4}})
+    mock_scheduler = mocker.patch('iris.bin.sender.escalation_scheduler')
+    mock_changes = mocker.patch('iris.bin.sender.auditlog.message_changes')
+    mock_cursor = mocker.patch('iris.bin.sender.db').engine.raw_connection.return_value.cursor.return_value
+    mock_cursor.lastrowid = 500
+    mock_cursor.__iter__.return_value = iter([(500, 1, 11), (501, 1, 11), (502, 2, 12)])
+
+    mock_cache.plan_notifications = {
+        11: {'plan_id': 10, 'role_id': 1, 'target_id': 1, 'priority_id': 1, 'optional': 0},
+        12: {'plan_id': 10, 'role_id': 2, 'target_id': 1, 'priority_id': 1, 'optional': 0},
+        13: {'plan_id': 10, 'role_id': 3, 'target_id': 1, 'priority_id': 1, 'optional': 1},
+    }
+    mock_cache.roles = {1: {'name': 'user'}, 2: {'name': 'oncall'}, 3: {'name': 'manager'}}
+    mock_cache.targets = {1: {'name': 'foo'}}
+    mock_cache.plans = {10: {'creator': 'creator'}}
+    mock_cache.incidents = {1: {'application_id': 7}, 2: {'application_id': 7}}
+    mock_cache.target_names = {'abc': {'id': 100}, 'def': {'id': 101}, 'creator': {'id': 102}}
+    mock_cache.target_names = mocker.MagicMock(**{'__getitem__.side_effect': mock_cache.target_names.get})
+    mock_cache.targets_for_role.side_effect = lambda role, target: {'user': ['abc', 'def']}.get(role)
+
+    handled = sender.create_messages([(1, 11), (2, 12), (2, 13)])
+    assert handled == {(1, 11), (2, 12), (2, 13)}
+    mock_cache.target_names.prefetch.assert_called_once_with({'abc', 'def', 'creator'})
+
+    # all three messages go out in a single multi-row insert
+    insert_sql, insert_args = mock_cursor.execute.call_args_list[0][0]
+    assert insert_sql.startswith('INSERT INTO `message`')
+    assert insert_sql.count('NOW()') == 3
+    assert insert_args == [10, 11, 1, 7, 100, 1, '', 10, 11, 1, 7, 101, 1, '',
+                           10, 12, 2, 7, 102, 4, insert_args[-1]]
+
+    # only the message redirected to the plan creator gets audited
+    mock_changes.assert_called_once_with([(502, auditlog.TARGET_CHANGE, 'oncall|foo', 'creator',
+                                           'Changing target to plan owner as we failed resolving original target')])
+    assert sorted(call[0] for call in mock_scheduler.messages_created.call_args_list) == [(1, 11), (2, 12)]
+
+
+def test_escalation_claims(mocker):
+    from iris.bin import sender
+    mocker.patch('iris.metrics.stats')
+    mock_cache = mocker.patch('iris.bin.sender.cache')
+    mock_scheduler = mocker.patch('iris.bin.sender.escalation_scheduler')
+    mock_connection = mocker.MagicMock()
+    mock_cursor = mock_connection.cursor.return_value
+
+    # another sender already moved incident 2 to its first step
+    def claim(sql, params):
+        mock_cursor.rowcount = int(params[1] != 2)
+    mock_cursor.execute.side_effect = claim
+    assert sender.claim_escalations(mock_connection, {1: (10, 1), 2: (10, 1)}) == {1: (10, 1)}
+    assert sorted(call[0][1] for call in mock_cursor.execute.call_args_list) == [(1, 1, 0), (1, 2, 0)]
+    mock_connection.commit.assert_called_once_with()
+
+    # repeats another sender made in the meantime aren't made again
+    mock_cache.plan_notifications = {11: {'plan_id': 10, 'role_id': 1, 'target_id': 1, 'priority_id': 1, 'optional': 0}}
+    mock_cache.roles = {1: {'name': 'user'}}
+    mock_cache.targets = {1: {'name': 'foo'}}
+    mock_cache.incidents = {1: {'application_id': 7}, 2: {'application_id': 7}}
+    mock_cache.target_names = mocker.MagicMock(**{'__getitem__.side_effect': {'abc': {'id': 100}}.get})
+    mock_cache.targets_for_role.return_value = ['abc']
+    mock_cursor = mocker.patch('iris.bin.sender.db').engine.raw_connection.return_value.cursor.return_value
+    mock_cursor.__iter__.return_value = iter([(1, 11, 1), (2, 11, 2)])
+
+    handled = sender.create_messages([(1, 11), (2, 11)], {(1, 11): 1, (2, 11): 1})
+    assert handled == {(1, 11)}
+    queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert queries[0] == sender.LOCK_INCIDENTS_SQL
+    assert queries[1] == sender.NOTIFICATION_ROUNDS_SQL
+    assert queries[2].startswith('INSERT INTO `message`')
+    assert mock_cursor.execute.call_args_list[2][0][1] == [10, 11, 1, 7, 100, 1, '']
+    mock_scheduler.messages_created.assert_called_once_with(1, 11)
+    mock_scheduler.invalidate.assert_called_once_with()
+
+
+def test_message_writeback(mocker):
+    from iris.sender.writeback import MessageWriteback
+    mocker.patch('iris.metrics.stats')
+    mocker.patch('iris.sender.writeback.spawn')
+    mock_db = mocker.MagicMock()
+    mock_cursor = mock_db.engine.raw_connection.return_value.cursor.return_value
+
+    writeback = MessageWriteback(mock_db, batch_size=2)
+    writeback.mark_sent([1, 2], 'foo@example.com', 1, 5, 'batchid', 'subject', 'body')
+    writeback.mark_sent([3], 'bar@example.com', 1, 5, None, 'subject', 'body')
+    writeback.set_sent_status(3, True)
+    assert writeback.flush_now.is_set()
+    assert writeback.pending() == 3
+    mock_cursor.execute.assert_not_called()
+
+    writeback.flush()
+    assert writeback.pending() == 0
+
+    # sent state and bodies of 3 messages in chunks of 2, plus one status insert
+    queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert len(queries) == 5
+    assert [query.count('SELECT') for query in queries[:4]] == [2, 1, 2, 1]
+    assert queries[4].startswith('INSERT INTO `generic_message_sent_status`')
+    assert mock_cursor.execute.call_args_list[4][0][1] == [3, True]
+
+    # a deadlocked batch is retried as a whole
+    mock_cursor.execute.reset_mock()
+    mocker.patch('iris.sender.writeback.sleep')
+    mock_cursor.execute.side_effect = [Exception('Deadlock found'), None]
+    writeback.set_sent_status(4, False)
+    writeback.flush()
+    assert mock_cursor.execute.call_count == 2
+
+
+def test_message_writeback_unwritten(mocker):
+    from iris.sender.writeback import MessageWriteback
+    from pymysql import DataError
+    mocker.patch('iris.metrics.stats')
+    mocker.patch('iris.sender.writeback.spawn')
+    mocker.patch('iris.sender.writeback.sleep')
+    mock_db = mocker.MagicMock()
+    mock_cursor = mock_db.engine.raw_connection.return_value.cursor.return_value
+
+    writeback = MessageWriteback(mock_db, batch_size=2)
+    writeback.mark_sent([1, 2], 'foo@example.com', 1, 5, None, 'subject', 'body')
+    assert writeback.unwritten() == {1, 2}
+
+    # messages stay unwritten while the DB is unavailable, to be written on the next flush
+    mock_cursor.execute.side_effect = Exception('Lost connection')
+    writeback.flush()
+    assert writeback.unwritten() == {1, 2}
+
+    # a row the DB refuses doesn't hold back the rest of its batch
+    def execute(sql, params):
+        if sql.count('SELECT') > 1 or (params[0] == 2 and 'destination' in sql):
+            raise DataError()
+    mock_cursor.execute.side_effect = execute
+    writeback.flush()
+    assert writeback.unwritten() == {2}
+
+    mock_cursor.execute.side_effect = None
+    writeback.flush()
+    assert writeback.unwritten() == set()
+
+
+def test_auditlog_buffer(mocker):
+    from iris.sender import auditlog
+    mocker.patch('iris.metrics.stats', {'auditlog_dropped_cnt': 0})
+    mock_db = mocker.patch('iris.sender.auditlog.db')
+    mock_cursor = mock_db.engine.raw_connection.return_value.cursor.return_value
+    mocker.patch.multiple(auditlog, pending=[], max_pending=3, batch_size=2, task=mocker.MagicMock())
+
+    for message_id in (1, 2, 3, 4):
+        auditlog.message_change(message_id, auditlog.MODE_CHANGE, 'sms', 'email', 'foo')
+    auditlog.message_change(None, auditlog.MODE_CHANGE, 'sms', 'email', 'foo')
+    assert [change[0] for change in auditlog.pending] == [1, 2, 3]
+    assert auditlog.flush_now.is_set()
+    auditlog.flush_now.clear()
+    from iris import metrics
+    assert metrics.stats['auditlog_dropped_cnt'] == 1
+    mock_cursor.execute.assert_not_called()
+
+    auditlog.flush()
+    assert auditlog.pending == []
+    assert [call[0][0].count('FROM_UNIXTIME') for call in mock_cursor.execute.call_args_list] == [2, 1]
+    assert mock_cursor.execute.call_args_list[1][0][1][:5] == [3, auditlog.MODE_CHANGE, 'sms', 'email', 'foo']
+
+    # a failed write doesn't leak its connection
+    mock_cursor.execute.side_effect = Exception('gone away')
+    mock_cursor.close.reset_mock()
+    mock_db.engine.raw_connection.return_value.close.reset_mock()
+    auditlog.message_change(5, auditlog.MODE_CHANGE, 'sms', 'email', 'foo')
+    auditlog.flush()
+    assert metrics.stats['auditlog_dropped_cnt'] == 2
+    mock_cursor.close.assert_called_once_with()
+    mock_db.engine.raw_connection.return_value.close.assert_called_once_with()
+
+
+def test_target_contacts(mocker):
+    from iris.sender import cache
+    tables = {
+        cache.USER_CONTACTS_SQL: [('alice', 1, 'alice@example.com'), ('alice', 2, '+1 555'), ('bob', None, None)],
+        cache.USER_MODES_SQL: [('alice', 10, 2)],
+        cache.USER_APPLICATION_MODES_SQL: [('alice', 100, 11, 1)],
+        cache.APPLICATIONS_SQL: [('app', 100)],
+        cache.APPLICATION_MODES_SQL: [('app', 1), ('app', 2)],
+        cache.DEFAULT_APPLICATION_MODES_SQL: [('app', 12, 1)],
+        'SELECT `id`, `name` FROM `mode`': [(1, 'email'), (2, 'sms'), (3, 'call')],
+        'SELECT `id`, `mode_id` FROM `priority`': [(10, 1), (11, 1), (12, 2), (13, 3)],
+    }
+    contacts = cache.TargetContacts(mocker.MagicMock(), 600)
+    mock_query = mocker.patch.object(contacts, 'query', side_effect=lambda sql, column=None, names=None: tables[sql])
+    contacts.rebuild()
+
+    # user's app setting, app default, user default
+    assert contacts.by_priority('alice', 'app', 11) == ('alice@example.com', 'email', 1)
+    assert contacts.by_priority('alice', 'app', 12) == ('alice@example.com', 'email', 1)
+    assert contacts.by_priority('alice', 'app', 10) == ('+1 555', 'sms', 2)
+    # priority default, which isn't allowed for this app
+    assert contacts.by_priority('alice', 'app', 13) is None
+    # user without contacts
+    assert contacts.by_priority('bob', 'app', 11) == (None, 'email', 1)
+    assert contacts.by_mode('alice', mode='sms') == '+1 555'
+    assert contacts.by_mode('alice', mode_id=1) == 'alice@example.com'
+    assert contacts.by_mode('bob', mode='email') is None
+
+    # targets we don't know of are looked up once, and remembered as not being users
+    mock_query.reset_mock()
+    assert contacts.by_priority('team', 'app', 11) is None
+    assert contacts.by_priority('team', 'app', 11) is None
+    assert mock_query.call_count == 3
+
+    tables[cache.USER_MODES_SQL] = [('alice', 10, 1)]
+    contacts.invalidate(users=['alice'])
+    assert contacts.by_priority('alice', 'app', 10) == ('alice@example.com', 'email', 1)
+
+
+def test_render_cache(mocker):
+    from iris.sender import cache
+    from iris.bin import sender
+    mocker.patch('iris.metrics.stats')
+    templates = cache.Templates(None)
+    assert templates.message_fields('{{ foo }} {{ iris.incident_id }} {{ iris["target"] }}') == ('incident_id', 'target')
+    assert templates.message_fields('{{ foo }}') == ()
+    assert templates.message_fields('{{ iris[foo] }}') is None
+    assert templates.message_fields('{% set x = iris %}{{ x.target }}') is None
+
+    body = mocker.MagicMock(wraps=templates.env.from_string('{{ summary }} for {{ iris.incident_id }}'))
+    subject = mocker.MagicMock(wraps=templates.env.from_string('{{ summary }}'))
+    mocker.patch.object(cache, 'rendered_templates', cache.RenderCache())
+    mocker.patch.object(cache, 'templates', {'tpl': {'id': 1, 'app': {'email': {
+        'subject': subject, 'subject_fields': (), 'prefix_message_id': True,
+        'body': body, 'body_fields': ('incident_id',)}}}})
+    mocker.patch.object(sender, 'config', {})
+
+    messages = []
+    for message_id in (10, 11, 12):
+        iris = {'message_id': message_id, 'target': 'user%s' % message_id, 'incident_id': 5}
+        message = {'message_id': message_id, 'template': 'tpl', 'application': 'app', 'mode': 'email',
+                   'incident_id': 5, 'context': {'summary': 'disk full', 'iris': iris}}
+        sender.render(message)
+        messages.append(message)
+
+    assert [m['subject'] for m in messages] == ['10 disk full', '11 disk full', '12 disk full']
+    assert all(m['body'] == 'disk full for 5' for m in messages)
+    assert all(m['template_id'] == 1 for m in messages)
+    assert subject.render.call_count == 1
+    assert body.render.call_count == 1
+    assert cache.rendered_templates.hits == 4
+    assert cache.rendered_templates.misses == 2
+
+
+def test_escalation_scheduler(mocker):
+    from iris.sender.escalation import EscalationScheduler
+    mocker.patch('iris.metrics.stats')
+    mock_cache = mocker.patch('iris.sender.escalation.cache')
+    mock_cache.plan_notifications = {
+        1: {'plan_id': 10, 'step': 1, 'repeat': 1, 'wait': 60},
+        2: {'plan_id': 10, 'step': 2, 'repeat': 0, 'wait': 300},
+    }
+    mock_cache.plans = {10: {'steps': {1: [1], 2: [2]}}}
+
+    mock_repeat = mocker.MagicMock()
+    mock_escalate = mocker.MagicMock()
+    mock_deactivate = mocker.MagicMock()
+    scheduler = EscalationScheduler(mocker.MagicMock(), mock_repeat, mock_escalate, mock_deactivate)
+    active_incidents = {100}
+    mocker.patch.object(scheduler, 'get_active_incidents', side_effect=lambda ids: active_incidents & set(ids))
+    scheduler.loaded = True
+
+    # first step, with one repeat left
+    scheduler.messages_created(100, 1, now=0)
+    scheduler.step_changed(100, 10, 1)
+    scheduler.fire_due(59)
+    mock_repeat.assert_not_called()
+    scheduler.fire_due(60)
+    mock_repeat.assert_called_once_with([(100, 1)])
+    mock_escalate.assert_not_called()
+
+    # repeats exhausted, so escalate to the second step
+    scheduler.messages_created(100, 1, now=60)
+    scheduler.fire_due(120)
+    mock_escalate.assert_called_once_with({100: (10, 2)})
+    scheduler.messages_created(100, 2, now=120)
+    scheduler.step_changed(100, 10, 2)
+
+    # last step exhausted, so deactivate
+    scheduler.fire_due(419)
+    mock_deactivate.assert_not_called()
+    scheduler.fire_due(420)
+    mock_deactivate.assert_called_once_with({100})
+    assert not scheduler.incidents
+    assert not scheduler.notifications
+
+    # claimed incidents are dropped without firing anything
+    mock_repeat.reset_mock()
+    scheduler.messages_created(200, 1, now=0)
+    scheduler.fire_due(60)
+    mock_repeat.assert_not_called()
+    assert 200 not in scheduler.incidents
+
+    # repeats that didn't create any messages are tried again
+    active_incidents.add(300)
+    scheduler.messages_created(300, 1, now=0)
+    scheduler.fire_due(60)
+    mock_repeat.assert_called_once_with([(300, 1)])
+    scheduler.fire_due(119)
+    assert mock_repeat.call_count == 1
+    scheduler.fire_due(120)
+    assert mock_repeat.call_count == 2
+    scheduler.messages_created(300, 1, now=120)
+    scheduler.fire_due(180)
+    mock_escalate.assert_called_with({300: (10, 2)})
+
+
+def test_size_vendor_pools():
+    from iris.bin.sender import size_vendor_pools
+    config = {'vendors': [{'type': 'iris_smtp', 'name': 'email'},
+                          {'type': 'iris_smtp', 'name': 'relay', 'pool_size': 20},
+                          {'type': 'iris_slack', 'name': 'slack'}]}
+    size_vendor_pools(config, {'email': 500, 'im': 10, 'slack': 30})
+    # as many connections per MX server as there are workers sending email through it
+    assert config['vendors'][0]['pool_size'] == 510
+    assert config['vendors'][1]['pool_size'] == 20
+    assert config['vendors'][2]['http_pool_size'] == 30
+    assert 'pool_size' not in config['vendors'][2]
+
+
+def test_worker_autoscaler():
+    from iris.sender.autoscale import WorkerAutoscaler
+    autoscaler = WorkerAutoscaler(min_workers=5, max_workers=200, target_wait=10)
+
+    # enough workers to get through the queue in time, at the vendors' pace
+    assert autoscaler.desired(10, depth=1000, wait=2, latency=.5) == 50
+    # falling behind grows at most twofold a round, and never past max
+    assert autoscaler.desired(10, depth=0, wait=40, latency=.5) == 20
+    assert autoscaler.desired(150, depth=10000, wait=40, latency=.5) == 200
+    # shrinks a step at a time while keeping up, down to min
+    assert autoscaler.desired(40, depth=0, wait=0, latency=.5) == 30
+    assert autoscaler.desired(6, depth=0, wait=0, latency=.5) == 5
+    # but not while messages are already waiting a while
+    assert autoscaler.desired(40, depth=10, wait=6, latency=.5) == 40
+
+
+def test_scale_workers(mocker):
+    from collections import defaultdict
+    from iris.bin import sender
+    mocker.patch('iris.metrics.stats', {'autoscale_sms_up_cnt': 0, 'autoscale_sms_down_cnt': 0})
+    mocker.patch.object(sender, 'worker_tasks', defaultdict(list))
+    spawn_worker = mocker.patch('iris.bin.sender.spawn_worker')
+
+    sender.scale_workers('sms', 3)
+    assert spawn_worker.call_count == 3
+    assert len(sender.worker_tasks['sms']) == 3
+    kill_sets = [task['kill_set'] for task in sender.worker_tasks['sms']]
+
+    # workers scaled away are told to stop once they're done with their message
+    sender.scale_workers('sms', 1)
+    assert len(sender.worker_tasks['sms']) == 1
+    assert [kill_set.is_set() for kill_set in kill_sets] == [False, True, True]
+    assert sender.metrics.stats == {'autoscale_sms_up_cnt': 3, 'autoscale_sms_down_cnt': 2}
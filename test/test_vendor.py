@@ -5,3 +5,55 @@ def test_send_through_dummy():
     vendor_manager = IrisVendorManager([{'type': 'iris_dummy'}], ['dummy_app'])
     assert vendor_manager.send_message({'mode': 'call'}) == 1
     assert vendor_manager.send_message({'application': 'dummy app', 'mode': 'call'}) == 2
+
+
+def test_vendor_circuit_breaker(mocker):
+    from iris import metrics
+    mocker.patch('iris.metrics.stats', {})
+    mocker.patch.dict('iris.vendors.vendor_health', clear=True)
+    mocker.patch('iris.vendors.random.choice', side_effect=lambda population: population[0])
+    clock = [1000.0]
+    mocker.patch('iris.vendors.time.time', side_effect=lambda: clock[0])
+    vendor_manager = IrisVendorManager([
+        {'type': 'iris_dummy', 'name': 'flaky', 'circuit_failure_threshold': 2, 'circuit_open_timeout': 30},
+        {'type': 'iris_dummy', 'name': 'steady'},
+    ], [])
+    flaky, steady = [vendor for vendor, _ in vendor_manager.mode_vendors['call']]
+    mocker.patch.object(flaky, 'send', side_effect=Exception('down'))
+    mocker.spy(steady, 'send')
+
+    # failed tries move on to the next vendor, until the failing one gets ejected
+    for _ in xrange(5):
+        assert vendor_manager.send_message({'mode': 'call'}) == 1
+    assert flaky.send.call_count == 2
+    assert steady.send.call_count == 5
+    assert metrics.stats['vendor_flaky_call_ejected_cnt'] == 1
+    assert metrics.stats['vendor_flaky_call_circuit_state'] == 1
+    assert metrics.stats['vendor_flaky_call_error_rate'] > 0
+
+    # once it's been out for a while, it gets probed and back in if it's healthy
+    clock[0] += 31
+    flaky.send.side_effect = None
+    flaky.send.return_value = 1
+    assert vendor_manager.send_message({'mode': 'call'}) == 1
+    assert flaky.send.call_count == 3
+    assert metrics.stats['vendor_flaky_call_circuit_state'] == 0
+
+
+def test_vendor_pick_spreads_load(mocker):
+    import random
+    mocker.patch('iris.metrics.stats', {})
+    mocker.patch.dict('iris.vendors.vendor_health', clear=True)
+    vendor_manager = IrisVendorManager([
+        {'type': 'iris_dummy', 'name': 'fast'},
+        {'type': 'iris_dummy', 'name': 'slow'},
+    ], [])
+    candidates = vendor_manager.mode_vendors['call']
+    fast, slow = candidates
+    fast[1].succeeded(0.1)
+    slow[1].succeeded(0.11)
+
+    # the marginally slower of two vendors keeps getting some of the traffic
+    random.seed(0)
+    picks = [vendor_manager.pick_vendor(candidates, set()) for _ in xrange(1000)]
+    assert 150 < picks.count(slow) < 350